@@ -1,23 +1,51 @@
 import logging
 import json
+import html
+import io
 import copy
 import uuid
 import secrets
 import string
-import requests
+import httpx
 import asyncio
+import threading
 import time
+import os
+import sys
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 import telegram
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.panel_dialects import PanelDialects, call_with_dialect
+from common.panel_health import PanelHealth, guarded_request
+from common.singleflight import SingleFlight
+from common.config_loader import ConfigLoader
+from common.config_store import ConfigConflict, ConfigStore, config_version, next_server_name
+from common.trial_store import TrialStore
+from common.broadcast_store import BroadcastStore
+from common.customers import is_warm_trial
+from common.telegram_dispatch import Dispatcher, PRIORITY_NOTICE
+from common import serving
+from common.panel_scan import (
+    classify, inactive_for, is_disabled, is_expired, is_unused, scan_servers, used_bytes,
+)
+
 # --- CONFIGURATION ---
+# Re-parsed only when ../config.json changes on disk (see common/config_loader.py).
+CONFIG_LOADER = ConfigLoader()
+# Every write to config.json goes through CONFIG_STORE: locked, versioned and
+# atomic, so edits from vpn_bot are not lost (see common/config_store.py).
+CONFIG_STORE = ConfigStore(loader=CONFIG_LOADER)
+
+
 def load_config():
-    with open('../config.json', 'r') as f:
-        return json.load(f)
+    """Mutable copy of the current config; handlers edit it and write it back."""
+    return CONFIG_LOADER.get().thaw()
 
 CONFIG = load_config()
+CONFIG_VERSION = CONFIG_LOADER.get().version
 # The admin bot uses its own token stored under `admin_bot_token` in the
 # parent config file.  Previously we were overwriting `CONFIG['bot_token']`
 # with this value on startup, which meant that any time the admin endpoint
@@ -30,11 +58,48 @@ ADMIN_TOKEN = CONFIG.get('admin_bot_token', '8408777363:AAGgMfiFZidu55AmeQTMtLLH
 SERVERS = CONFIG['servers']
 ADMIN_IDS = CONFIG['admin_ids']
 
+
+def refresh_config():
+    """Pick up edits made by either bot; a stat() unless config.json changed."""
+    global CONFIG, SERVERS, CONFIG_VERSION
+    snapshot = CONFIG_LOADER.get()
+    if snapshot.version != CONFIG_VERSION:
+        CONFIG = snapshot.thaw()
+        SERVERS = CONFIG['servers']
+        CONFIG_VERSION = snapshot.version
+
+
+def save_config(mutate, expected_version=None):
+    """Locked read-modify-write of config.json, then refresh CONFIG/SERVERS."""
+    version = CONFIG_STORE.update(mutate, expected_version)
+    if version is not None:
+        refresh_config()
+    return version
+
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
 INACTIVE_DAYS_THRESHOLD = 7
 INACTIVE_CACHE_TTL_SECONDS = 30 * 60
 INACTIVE_CARD_LIMIT = 40
+PANEL_SCAN_CONCURRENCY = 8
+BULK_GENERATE_MAX_USERS = 5000
+BULK_ADD_CHUNK_SIZE = 100
+BULK_PROGRESS_EDIT_SECONDS = 2
+BULK_LINKS_INLINE_MAX = 20
+# Broadcasts share the customer bot's ~30 msg/s budget with vpn_bot itself.
+BROADCAST_RATE_PER_SECOND = 15
+BROADCAST_BATCH_SIZE = 200
+BROADCAST_PROGRESS_EDIT_SECONDS = 3
+XUI_POOL_MAXSIZE = 8
+XUI_TIMEOUT_SECONDS = 15
+XUI_LOGIN_TIMEOUT_SECONDS = 10
+# Successful panel reads are shared for this long unless we write to the panel.
+XUI_READ_FRESHNESS_SECONDS = 2
+
+# Remembered route/encoding per panel, shared with vpn_bot via ../panel_dialects.json.
+PANEL_DIALECTS = PanelDialects()
+# Circuit breaker per panel; see common/panel_health.py.
+PANEL_HEALTH = PanelHealth()
 
 AUTO_INBOUND_TEMPLATE = {
     "listen": "",
@@ -114,97 +179,63 @@ def format_last_online(last_online_ms):
         return "Unknown"
 
 
-def normalize_last_online_ms(raw_value):
-    """Normalize last-online timestamp to milliseconds if present."""
-    try:
-        value = int(raw_value or 0)
-    except Exception:
-        return 0
-    if value <= 0:
-        return 0
-    # Heuristic: values smaller than 10^12 are very likely seconds.
-    if value < 10**12:
-        return value * 1000
-    return value
-
-
-def collect_inactive_users():
+async def collect_inactive_users():
     """Return users that are expired, disabled, unused, or inactive for 7+ days."""
     gb = 1024 * 1024 * 1024
-    now_ms = int(time.time() * 1000)
-    week_ms = INACTIVE_DAYS_THRESHOLD * 24 * 60 * 60 * 1000
-    inactive = []
-
+    servers = []
     for server in get_active_servers():
-        try:
-            client = XUIClient(server)
-            inbound_url = f"{client.base_url}/panel/api/inbounds/get/{client.inbound_id}"
-            r = client.session.get(inbound_url, verify=False, timeout=15)
-            rj = r.json()
-
-            if not rj.get('success'):
-                client.login()
-                r = client.session.get(inbound_url, verify=False, timeout=15)
-                rj = r.json()
-
-            if not rj.get('success'):
-                logging.warning(f"Inactive scan failed on {server.get('name')}: {rj}")
-                continue
-
-            inbound = rj.get('obj', {})
-            settings = json.loads(inbound.get('settings', '{}'))
-            stats_by_email = {}
-            for stat in inbound.get('clientStats') or []:
-                email = stat.get('email')
-                if email:
-                    stats_by_email[email] = stat
-
-            for c in settings.get('clients', []):
-                email = c.get('email', 'N/A')
-                expiry_ms = int(c.get('expiryTime', 0) or 0)
-                enabled = bool(c.get('enable', True))
-                total = int(c.get('totalGB', 0) or 0)
-
-                stat = stats_by_email.get(email, {})
-                up = int(stat.get('up', c.get('up', 0)) or 0)
-                down = int(stat.get('down', c.get('down', 0)) or 0)
-                used = up + down
-                remaining = max(0, total - used)
-                last_online_ms = normalize_last_online_ms(stat.get('lastOnline') or c.get('lastOnline'))
-
-                is_expired = expiry_ms > 0 and expiry_ms <= now_ms
-                is_disabled = not enabled
-                is_unused = used == 0
-                expired_over_week = expiry_ms > 0 and (now_ms - expiry_ms) >= week_ms
-                inactive_over_week = last_online_ms > 0 and (now_ms - last_online_ms) >= week_ms
-
-                reasons = []
-                if is_expired:
-                    reasons.append('expired')
-                if is_disabled:
-                    reasons.append('disabled')
-                if is_unused:
-                    reasons.append('unused')
-                if expired_over_week or inactive_over_week:
-                    reasons.append('inactive_7d')
-
-                if reasons:
-                    inactive.append({
-                        'email': email,
-                        'server': server.get('name', 'Unknown'),
-                        'panel_url': server.get('panel_url', ''),
-                        'inbound_id': int(server.get('inbound_id', 0) or 0),
-                        'reasons': reasons,
-                        'used_gb': round(used / gb, 2),
-                        'total_gb': round(total / gb, 2),
-                        'remaining_gb': round(remaining / gb, 2),
-                        'status': 'Inactive',
-                        'last_online_ms': last_online_ms,
-                        'last_online': format_last_online(last_online_ms),
-                        'expiry': format_expiry(expiry_ms),
-                    })
-        except Exception as e:
-            logging.warning(f"Inactive scan exception on {server.get('name')}: {e}")
+        client = get_xui_client(server)
+        if PANEL_HEALTH.is_open(client.base_url):
+            logging.warning(f"Inactive scan skipped {server.get('name')}: {PANEL_HEALTH.describe(client.base_url)}")
+            continue
+        servers.append(server)
+
+    async def fetch(server):
+        client = get_xui_client(server)
+        inbound = await client.get_inbound()
+        if not inbound:
+            logging.warning(f"Inactive scan failed on {server.get('name')}: {client.last_error}")
+            return None
+        return [inbound]
+
+    # All panels are fetched in parallel and parsed once; the reasons below are
+    # classifiers over that one snapshot (see common/panel_scan.py).
+    records, _ = await scan_servers(servers, fetch, PANEL_SCAN_CONCURRENCY)
+    # vpn_bot's warm trial pool is disabled and unused by design.
+    records = [r for r in records if not is_warm_trial(r['email'])]
+    matches = classify(records, {
+        'expired': is_expired,
+        'disabled': is_disabled,
+        'unused': is_unused,
+        'inactive_7d': inactive_for(INACTIVE_DAYS_THRESHOLD * 24 * 60 * 60),
+    })
+    reasons_by_record = {}
+    for reason, matched in matches.items():
+        for record in matched:
+            reasons_by_record.setdefault(id(record), []).append(reason)
+
+    servers_by_name = {s.get('name', 'Unknown'): s for s in servers}
+    inactive = []
+    for record in records:
+        reasons = reasons_by_record.get(id(record))
+        if not reasons:
+            continue
+        server = servers_by_name[record['server_name']]
+        used = used_bytes(record)
+        inactive.append({
+            'email': record['email'] or 'N/A',
+            'server': record['server_name'],
+            'panel_url': server.get('panel_url', ''),
+            'inbound_id': int(server.get('inbound_id', 0) or 0),
+            'reasons': reasons,
+            'used_gb': round(used / gb, 2),
+            'total_gb': round(record['total'] / gb, 2),
+            'remaining_gb': round(max(0, record['total'] - used) / gb, 2),
+            'status': 'Inactive',
+            'last_online_ms': record['last_online'],
+            'last_online': format_last_online(record['last_online']),
+            'expiry': format_expiry(record['expiry']),
+        })
 
     inactive.sort(key=lambda x: (x['server'], x['email']))
     return inactive
@@ -295,19 +326,25 @@ async def send_inactive_cards(chat_id: int, context: ContextTypes.DEFAULT_TYPE,
 
 
 async def send_inactive_report(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
-    rows = collect_inactive_users()
+    rows = await collect_inactive_users()
     report = build_inactive_report(rows)
     await context.bot.send_message(chat_id=chat_id, text=report, parse_mode='HTML')
 
 # --- X-UI API CLIENT ---
-class XUIClient:
+def _successful_read(result):
+    body, _status = result
+    return isinstance(body, dict) and bool(body.get('success'))
+
+
+class AsyncXUIClient:
+    """Non-blocking X-UI panel client; one pooled instance per panel via get_xui_client()."""
+
     def __init__(self, server_config):
         self.base_url = server_config['panel_url'].rstrip('/')
         self.username = server_config['username']
         self.password = server_config['password']
         self.inbound_id = server_config['inbound_id']
         self.api_token = str(server_config.get('api_token', '') or '').strip()
-        self.session = requests.Session()
         self.last_error = ""
 
         # Some 3x-ui builds expose API on host root (without web base path).
@@ -321,19 +358,45 @@ class XUIClient:
         except Exception:
             pass
 
+        headers = {}
         if self.api_token:
-            self.session.headers.update({
+            headers.update({
                 'Authorization': f'Bearer {self.api_token}',
                 'X-API-Key': self.api_token,
                 'x-ui-token': self.api_token,
             })
-        self.login()
 
-    def login(self):
+        self.http = httpx.AsyncClient(
+            verify=False,
+            headers=headers,
+            timeout=XUI_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=XUI_POOL_MAXSIZE, max_keepalive_connections=XUI_POOL_MAXSIZE),
+        )
+        self._login_lock = asyncio.Lock()
+        self._session_started = False
+        self._reads = SingleFlight(ttl=XUI_READ_FRESHNESS_SECONDS)
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def _http(self, method, url, **kwargs):
+        """Every panel request goes through the circuit breaker (raises PanelUnavailable while open)."""
+        return await guarded_request(PANEL_HEALTH, self.base_url, self.http, method, url, **kwargs)
+
+    async def _ensure_login(self):
+        """Log in once before the first request; later rejections re-login explicitly."""
+        if self._session_started:
+            return
+        async with self._login_lock:
+            if not self._session_started:
+                self._session_started = True
+                await self.login()
+
+    async def login(self):
         login_url = f"{self.base_url}/login"
         payload = {'username': self.username, 'password': self.password}
         try:
-            r = self.session.post(login_url, data=payload, verify=False, timeout=10)
+            r = await self._http('POST', login_url, data=payload, timeout=XUI_LOGIN_TIMEOUT_SECONDS)
             if r.json().get('success'):
                 logging.info(f"Logged in to {self.base_url}")
                 return True
@@ -343,50 +406,61 @@ class XUIClient:
             self.last_error = f"Login failed: {e}"
         return False
 
-    def _try_get_json(self, url):
-        try:
-            r = self.session.get(url, verify=False, timeout=15)
-            try:
-                body = r.json()
-                if isinstance(body, dict) and not body.get('success') and body.get('msg'):
-                    self.last_error = str(body.get('msg'))
-                return body
-            except Exception:
-                self.last_error = f"HTTP {r.status_code}: {r.text[:200]}"
-                return None
-        except Exception as e:
-            self.last_error = f"GET error: {e}"
-            return None
+    async def _request(self, url, payload=None, encoding='json'):
+        """GET (no payload) or POST as JSON/form; returns (json_body_or_None, http_status_or_None).
 
-    def _try_post_json(self, url, payload):
+        Identical concurrent GETs share one request; any POST invalidates shared reads.
+        """
+        await self._ensure_login()
+        if payload is None:
+            return await self._reads.do(url, lambda: self._send_request(url), cacheable=_successful_read)
         try:
-            r = self.session.post(url, json=payload, verify=False, timeout=15)
-            try:
-                body = r.json()
-                if isinstance(body, dict) and not body.get('success') and body.get('msg'):
-                    self.last_error = str(body.get('msg'))
-                return body
-            except Exception:
-                self.last_error = f"HTTP {r.status_code}: {r.text[:200]}"
-                return None
-        except Exception as e:
-            self.last_error = f"POST error: {e}"
-            return None
+            return await self._send_request(url, payload, encoding)
+        finally:
+            self._reads.invalidate()
 
-    def _try_post_form(self, url, payload):
+    async def _send_request(self, url, payload=None, encoding='json'):
+        label = 'GET' if payload is None else ('POST(form)' if encoding == 'form' else 'POST')
         try:
-            r = self.session.post(url, data=payload, verify=False, timeout=15)
-            try:
-                body = r.json()
-                if isinstance(body, dict) and not body.get('success') and body.get('msg'):
-                    self.last_error = str(body.get('msg'))
-                return body
-            except Exception:
-                self.last_error = f"HTTP {r.status_code}: {r.text[:200]}"
-                return None
+            if payload is None:
+                r = await self._http('GET', url)
+            elif encoding == 'form':
+                r = await self._http('POST', url, data=payload)
+            else:
+                r = await self._http('POST', url, json=payload)
         except Exception as e:
-            self.last_error = f"POST(form) error: {e}"
-            return None
+            self.last_error = f"{label} error: {e}"
+            return None, None
+        try:
+            body = r.json()
+        except Exception:
+            self.last_error = f"HTTP {r.status_code}: {r.text[:200]}"
+            return None, r.status_code
+        if isinstance(body, dict) and not body.get('success') and body.get('msg'):
+            self.last_error = str(body.get('msg'))
+        return body, r.status_code
+
+    @staticmethod
+    def _succeeded(body):
+        return isinstance(body, dict) and bool(body.get('success'))
+
+    async def _call(self, op, templates, payload=None, encodings=('json',), accept=None, inbound_id=None, responses=None):
+        """Run one operation through the panel's remembered route (see common.panel_dialects).
+
+        Templates may contain `{inbound_id}`; non-empty bodies are appended to
+        `responses` so callers can surface the panel's error message.
+        """
+        async def send(template, encoding):
+            url = template.format(inbound_id=inbound_id) if inbound_id is not None else template
+            body, status = await self._request(url, payload, encoding)
+            if body and responses is not None:
+                responses.append(body)
+            return body, status
+
+        return await call_with_dialect(
+            PANEL_DIALECTS, self.base_url, op, templates, send,
+            accept or self._succeeded, encodings=encodings, relogin=self.login,
+        )
 
     def _inbound_get_urls(self, inbound_id):
         urls = []
@@ -485,28 +559,47 @@ class XUIClient:
             ])
         return urls
 
-    def _fetch_inbound(self, inbound_id):
-        tried = []
-        for url in self._inbound_get_urls(inbound_id):
-            tried.append(url)
-            data = self._try_get_json(url)
-            if isinstance(data, dict) and data.get('success') and data.get('obj'):
-                return data.get('obj')
+    async def _fetch_inbound(self, inbound_id):
+        data = await self._call(
+            'get', self._inbound_get_urls('{inbound_id}'), inbound_id=inbound_id,
+            accept=lambda body: self._succeeded(body) and bool(body.get('obj')),
+        )
+        if data:
+            return data.get('obj')
+        tried = self._inbound_get_urls(inbound_id)
         self.last_error = (
             self.last_error or
             f"Inbound fetch failed. Tried: {'; '.join(tried[:4])}"
         )
         return None
 
-    def discover_preferred_inbound_id(self):
-        for url in self._inbound_list_urls():
-            data = self._try_get_json(url)
-            if not isinstance(data, dict) or not data.get('success'):
-                continue
-            inbounds = data.get('obj') or []
-            if not isinstance(inbounds, list) or not inbounds:
-                continue
-
+    async def _list_inbounds(self):
+        """Return the panel's inbound list, or None when no route answered."""
+        data = await self._call(
+            'list', self._inbound_list_urls(),
+            accept=lambda body: self._succeeded(body) and isinstance(body.get('obj'), list),
+        )
+        return data.get('obj') if data else None
+
+    async def list_inbounds(self):
+        """Return every inbound on the panel, re-logging in once if the panel rejects the session."""
+        inbounds = await self._list_inbounds()
+        if inbounds is None:
+            await self.login()
+            inbounds = await self._list_inbounds()
+        return inbounds
+
+    async def get_inbound(self):
+        """Return the configured inbound, re-logging in once if the panel rejects the session."""
+        inbound = await self._fetch_inbound(self.inbound_id)
+        if not inbound:
+            await self.login()
+            inbound = await self._fetch_inbound(self.inbound_id)
+        return inbound
+
+    async def discover_preferred_inbound_id(self):
+        inbounds = await self._list_inbounds()
+        if inbounds:
             vless_reality = []
             vless_any = []
             enabled_any = []
@@ -547,16 +640,9 @@ class XUIClient:
 
         return self.inbound_id
 
-    def list_inbounds_brief(self):
-        for url in self._inbound_list_urls():
-            data = self._try_get_json(url)
-            if not isinstance(data, dict) or not data.get('success'):
-                continue
-
-            inbounds = data.get('obj') or []
-            if not isinstance(inbounds, list):
-                continue
-
+    async def list_inbounds_brief(self):
+        inbounds = await self._list_inbounds()
+        if inbounds is not None:
             rows = []
             for ib in inbounds:
                 if not isinstance(ib, dict):
@@ -577,7 +663,7 @@ class XUIClient:
         self.last_error = self.last_error or "Failed to list inbounds from server API."
         return []
 
-    def create_auto_inbound(self, remark: str = "Auto-Inbound", port: int = 443):
+    async def create_auto_inbound(self, remark: str = "Auto-Inbound", port: int = 443):
         base = copy.deepcopy(AUTO_INBOUND_TEMPLATE)
         base["remark"] = remark
         base["port"] = int(port)
@@ -605,27 +691,16 @@ class XUIClient:
         }
 
         responses = []
-        tried = []
         for payload in (payload_legacy, payload_object):
-            for url in self._inbound_create_urls():
-                resp = self._try_post_json(url, payload)
-                tried.append(url + " [json]")
-                if resp:
-                    responses.append(resp)
-                if isinstance(resp, dict) and resp.get("success"):
-                    detected_id = self.discover_preferred_inbound_id()
-                    self.inbound_id = int(detected_id)
-                    return True, int(detected_id), "Inbound created"
-
-                # Some 3x-ui routes accept form-encoded body instead of JSON.
-                resp = self._try_post_form(url, payload)
-                tried.append(url + " [form]")
-                if resp:
-                    responses.append(resp)
-                if isinstance(resp, dict) and resp.get("success"):
-                    detected_id = self.discover_preferred_inbound_id()
-                    self.inbound_id = int(detected_id)
-                    return True, int(detected_id), "Inbound created"
+            # Some 3x-ui routes accept form-encoded body instead of JSON.
+            resp = await self._call(
+                'create', self._inbound_create_urls(), payload=payload,
+                encodings=('json', 'form'), responses=responses,
+            )
+            if resp:
+                detected_id = await self.discover_preferred_inbound_id()
+                self.inbound_id = int(detected_id)
+                return True, int(detected_id), "Inbound created"
 
         err_msg = ""
         for resp in responses:
@@ -638,49 +713,135 @@ class XUIClient:
             err_msg = "Failed to create inbound (API rejected request)."
 
         # Keep it short enough for Telegram while still showing endpoint coverage.
-        tried_preview = "; ".join(tried[:4])
+        tried_preview = "; ".join(self._inbound_create_urls()[:4])
         if tried_preview:
             err_msg = f"{err_msg} Tried: {tried_preview}"
 
         self.last_error = err_msg
         return False, None, self.last_error
 
-    def add_client(self, email, limit_gb=0, expire_days=0):
-        try:
-            inbound = self._fetch_inbound(self.inbound_id)
-            if not inbound:
-                self.login()
-                inbound = self._fetch_inbound(self.inbound_id)
+    async def _update_inbound(self, *payloads):
+        """POST the first payload the panel's update route accepts; True on success."""
+        for payload in payloads:
+            if await self._call(
+                'update', self._inbound_update_urls('{inbound_id}'), payload=payload,
+                encodings=('json', 'form'), inbound_id=self.inbound_id,
+            ):
+                return True
+        return False
 
-            # Auto-detect inbound for newer/changed 3x-ui setups.
-            if not inbound:
-                detected_id = self.discover_preferred_inbound_id()
-                if detected_id != self.inbound_id:
-                    logging.info(f"Auto-switched inbound id from {self.inbound_id} to {detected_id} on {self.base_url}")
-                    self.inbound_id = detected_id
-                inbound = self._fetch_inbound(self.inbound_id)
+    @staticmethod
+    def _parse_clients(inbound_obj):
+        raw_settings = inbound_obj.get('settings', '{}') if isinstance(inbound_obj, dict) else '{}'
+        if isinstance(raw_settings, str):
+            try:
+                settings_obj = json.loads(raw_settings)
+            except Exception:
+                settings_obj = {}
+        elif isinstance(raw_settings, dict):
+            settings_obj = raw_settings
+        else:
+            settings_obj = {}
+        return settings_obj.get('clients') or []
+
+    def _build_link(self, inbound, stream_settings, client_uuid, remark):
+        """Build the vless:// share link for one client of `inbound`."""
+        ip = self.base_url.split('://')[1].split(':')[0]
+        port = inbound.get('port')
+
+        reality = stream_settings.get('realitySettings') if isinstance(stream_settings, dict) else None
+        pbk = sni = sid = None
+        if isinstance(reality, dict):
+            settings_obj = reality.get('settings')
+            if isinstance(settings_obj, str):
+                try:
+                    settings_obj = json.loads(settings_obj)
+                except Exception:
+                    settings_obj = None
+            if isinstance(settings_obj, dict):
+                pbk = settings_obj.get('publicKey')
+            if not pbk:
+                pbk = reality.get('publicKey')
+            names = reality.get('serverNames') or []
+            shorts = reality.get('shortIds') or []
+            sni = names[0] if names else None
+            sid = shorts[0] if shorts else None
+
+        if pbk and sni and sid:
+            return (f"vless://{client_uuid}@{ip}:{port}"
+                    f"?type=tcp&security=reality&encryption=none&pbk={pbk}&fp=chrome"
+                    f"&sni={sni}&sid={sid}&spx=%2F&flow=xtls-rprx-vision#{remark}")
+        return f"vless://{client_uuid}@{ip}:{port}?type=tcp&security=none&encryption=none#{remark}"
+
+    async def _resolve_inbound(self):
+        """Load the configured inbound, auto-detecting the id on newer/changed 3x-ui setups."""
+        inbound = await self.get_inbound()
+
+        if not inbound:
+            detected_id = await self.discover_preferred_inbound_id()
+            if detected_id != self.inbound_id:
+                logging.info(f"Auto-switched inbound id from {self.inbound_id} to {detected_id} on {self.base_url}")
+                self.inbound_id = detected_id
+            inbound = await self._fetch_inbound(self.inbound_id)
+
+        if not inbound:
+            self.last_error = "Failed to load inbound (check inbound ID or API path compatibility)."
+        return inbound
+
+    @staticmethod
+    def _json_field(inbound, key):
+        raw = inbound.get(key, '{}')
+        if isinstance(raw, str):
+            try:
+                parsed = json.loads(raw)
+            except Exception:
+                return {}
+            return parsed if isinstance(parsed, dict) else {}
+        return dict(raw) if isinstance(raw, dict) else {}
+
+    def _update_payloads(self, inbound, settings_obj):
+        """Return (payload_min, payload_full) that replace `inbound`'s settings with `settings_obj`."""
+        if str(inbound.get('protocol', '')).lower() == 'vless':
+            settings_obj.setdefault('decryption', 'none')
+            settings_obj.setdefault('encryption', 'none')
+
+        settings_str = json.dumps(settings_obj)
+        payload_min = {
+            "id": self.inbound_id,
+            "settings": settings_str,
+        }
+        payload_full = {
+            "id": self.inbound_id,
+            "up": inbound.get('up', 0),
+            "down": inbound.get('down', 0),
+            "total": inbound.get('total', 0),
+            "remark": inbound.get('remark', ''),
+            "enable": inbound.get('enable', True),
+            "expiryTime": inbound.get('expiryTime', 0),
+            "listen": inbound.get('listen', ''),
+            "port": inbound.get('port', 0),
+            "protocol": inbound.get('protocol', 'vless'),
+            "settings": settings_str,
+            "streamSettings": inbound.get('streamSettings', '{}'),
+            "sniffing": inbound.get('sniffing', '{}'),
+            "allocate": inbound.get('allocate', '{"strategy":"always","refresh":5,"concurrency":3}'),
+            "tag": inbound.get('tag', f"in-{inbound.get('port', 0)}-tcp"),
+        }
+        return payload_min, payload_full
 
+    async def add_client(self, email, limit_gb=0, expire_days=0):
+        try:
+            inbound = await self._resolve_inbound()
             if not inbound:
-                self.last_error = "Failed to load inbound (check inbound ID or API path compatibility)."
                 return None
 
-            raw_stream_settings = inbound.get('streamSettings', '{}')
-            if isinstance(raw_stream_settings, str):
-                try:
-                    stream_settings = json.loads(raw_stream_settings)
-                except Exception:
-                    stream_settings = {}
-            elif isinstance(raw_stream_settings, dict):
-                stream_settings = raw_stream_settings
-            else:
-                stream_settings = {}
+            stream_settings = self._json_field(inbound, 'streamSettings')
             
             new_uuid = str(uuid.uuid4())
             sub_id = ''.join(secrets.choice(string.ascii_lowercase + string.digits) for _ in range(16))
             
             expiry_time = 0
             if expire_days > 0:
-                import time
                 expiry_time = int((time.time() * 1000) + (expire_days * 86400 * 1000))
 
             def build_payload(include_flow=True):
@@ -701,59 +862,17 @@ class XUIClient:
                     "settings": json.dumps({"clients": [client_obj]})
                 }
 
-            def parse_clients_from_inbound(inbound_obj):
-                raw_settings = inbound_obj.get('settings', '{}') if isinstance(inbound_obj, dict) else '{}'
-                if isinstance(raw_settings, str):
-                    try:
-                        settings_obj = json.loads(raw_settings)
-                    except Exception:
-                        settings_obj = {}
-                elif isinstance(raw_settings, dict):
-                    settings_obj = raw_settings
-                else:
-                    settings_obj = {}
-                return settings_obj.get('clients') or []
-
-            def client_exists(client_email, client_uuid=None):
-                fresh = self._fetch_inbound(self.inbound_id)
+            async def client_exists(client_email, client_uuid=None):
+                fresh = await self._fetch_inbound(self.inbound_id)
                 if not fresh:
                     return False
-                for c in parse_clients_from_inbound(fresh):
+                for c in self._parse_clients(fresh):
                     if str(c.get('email', '')) == str(client_email):
                         if client_uuid and str(c.get('id', '')) != str(client_uuid):
                             continue
                         return True
                 return False
 
-            def build_link_for_uuid(client_uuid):
-                remark = email
-                ip = self.base_url.split('://')[1].split(':')[0]
-                port = inbound.get('port')
-
-                reality = stream_settings.get('realitySettings') if isinstance(stream_settings, dict) else None
-                pbk = sni = sid = None
-                if isinstance(reality, dict):
-                    settings_obj = reality.get('settings')
-                    if isinstance(settings_obj, str):
-                        try:
-                            settings_obj = json.loads(settings_obj)
-                        except Exception:
-                            settings_obj = None
-                    if isinstance(settings_obj, dict):
-                        pbk = settings_obj.get('publicKey')
-                    if not pbk:
-                        pbk = reality.get('publicKey')
-                    names = reality.get('serverNames') or []
-                    shorts = reality.get('shortIds') or []
-                    sni = names[0] if names else None
-                    sid = shorts[0] if shorts else None
-
-                if pbk and sni and sid:
-                    return (f"vless://{client_uuid}@{ip}:{port}"
-                            f"?type=tcp&security=reality&encryption=none&pbk={pbk}&fp=chrome"
-                            f"&sni={sni}&sid={sid}&spx=%2F&flow=xtls-rprx-vision#{remark}")
-                return f"vless://{client_uuid}@{ip}:{port}?type=tcp&security=none&encryption=none#{remark}"
-
             # If client already exists, return its link instead of failing hard.
             try:
                 existing_settings = json.loads(inbound.get('settings', '{}'))
@@ -763,38 +882,26 @@ class XUIClient:
                 if str(c.get('email', '')) == str(email):
                     existing_uuid = c.get('id')
                     if existing_uuid:
-                        return build_link_for_uuid(existing_uuid)
+                        return self._build_link(inbound, stream_settings, existing_uuid, email)
 
             # Try with flow first, then retry without flow for newer variants.
             responses = []
             add_success = False
             for include_flow in (True, False):
-                payload = build_payload(include_flow=include_flow)
-                for add_url in self._inbound_add_urls():
-                    resp = self._try_post_json(add_url, payload)
-                    if resp:
-                        responses.append(resp)
-                    if isinstance(resp, dict) and resp.get('success'):
-                        if client_exists(email, new_uuid):
-                            add_success = True
-                            break
-
-                    # Some panels accept addClient as form body only.
-                    resp = self._try_post_form(add_url, payload)
-                    if resp:
-                        responses.append(resp)
-                    if isinstance(resp, dict) and resp.get('success'):
-                        if client_exists(email, new_uuid):
-                            add_success = True
-                            break
-                if add_success:
+                # Some panels accept addClient as form body only.
+                resp = await self._call(
+                    'add', self._inbound_add_urls(), payload=build_payload(include_flow=include_flow),
+                    encodings=('json', 'form'), responses=responses,
+                )
+                if resp and await client_exists(email, new_uuid):
+                    add_success = True
                     break
 
             if not add_success:
                 # Fallback: append client to inbound settings and call update endpoint.
                 clients = list(existing_settings.get('clients') or [])
 
-                def try_update(include_flow=True):
+                async def try_update(include_flow=True):
                     client_obj = {
                         "id": new_uuid,
                         "email": email,
@@ -808,60 +915,13 @@ class XUIClient:
                     if include_flow:
                         client_obj["flow"] = "xtls-rprx-vision"
 
-                    new_clients = clients + [client_obj]
-
                     # Keep existing inbound settings fields (especially VLESS
                     # decryption/encryption) and only update clients list.
-                    raw_existing_settings = inbound.get('settings', '{}')
-                    if isinstance(raw_existing_settings, str):
-                        try:
-                            existing_settings_obj = json.loads(raw_existing_settings)
-                        except Exception:
-                            existing_settings_obj = {}
-                    elif isinstance(raw_existing_settings, dict):
-                        existing_settings_obj = dict(raw_existing_settings)
-                    else:
-                        existing_settings_obj = {}
-
-                    existing_settings_obj['clients'] = new_clients
-                    if str(inbound.get('protocol', '')).lower() == 'vless':
-                        existing_settings_obj.setdefault('decryption', 'none')
-                        existing_settings_obj.setdefault('encryption', 'none')
+                    existing_settings_obj = self._json_field(inbound, 'settings')
+                    existing_settings_obj['clients'] = clients + [client_obj]
+                    return await self._update_inbound(*self._update_payloads(inbound, existing_settings_obj))
 
-                    settings_str = json.dumps(existing_settings_obj)
-                    payload_min = {
-                        "id": self.inbound_id,
-                        "settings": settings_str,
-                    }
-                    payload_full = {
-                        "id": self.inbound_id,
-                        "up": inbound.get('up', 0),
-                        "down": inbound.get('down', 0),
-                        "total": inbound.get('total', 0),
-                        "remark": inbound.get('remark', ''),
-                        "enable": inbound.get('enable', True),
-                        "expiryTime": inbound.get('expiryTime', 0),
-                        "listen": inbound.get('listen', ''),
-                        "port": inbound.get('port', 0),
-                        "protocol": inbound.get('protocol', 'vless'),
-                        "settings": settings_str,
-                        "streamSettings": inbound.get('streamSettings', '{}'),
-                        "sniffing": inbound.get('sniffing', '{}'),
-                        "allocate": inbound.get('allocate', '{"strategy":"always","refresh":5,"concurrency":3}'),
-                        "tag": inbound.get('tag', f'in-{inbound.get("port", 0)}-tcp'),
-                    }
-
-                    for update_url in self._inbound_update_urls(self.inbound_id):
-                        for payload in (payload_min, payload_full):
-                            resp = self._try_post_json(update_url, payload)
-                            if isinstance(resp, dict) and resp.get('success'):
-                                return True
-                            resp = self._try_post_form(update_url, payload)
-                            if isinstance(resp, dict) and resp.get('success'):
-                                return True
-                    return False
-
-                updated = try_update(include_flow=True) or try_update(include_flow=False)
+                updated = await try_update(include_flow=True) or await try_update(include_flow=False)
                 if not updated:
                     msg = ""
                     for resp in responses:
@@ -871,23 +931,112 @@ class XUIClient:
                     self.last_error = msg or self.last_error or "Add client API rejected request."
                     return None
 
-                if not client_exists(email, new_uuid):
+                if not await client_exists(email, new_uuid):
                     self.last_error = "Client update reported success but client was not persisted."
                     return None
 
-            return build_link_for_uuid(new_uuid)
+            return self._build_link(inbound, stream_settings, new_uuid, email)
         except Exception as e:
             logging.error(f"XUI Client Error: {e}")
             self.last_error = str(e)
             return None
 
-    def delete_client_by_email(self, email):
+    async def add_clients_bulk(self, emails, limit_gb=0, expire_days=0, progress=None):
+        """Create many clients with one addClient call per chunk and a single verification read.
+
+        Returns (created, existing, failed): created/existing are [(email, link)],
+        failed is [email]. `progress(done, total)` is awaited after every chunk.
+        """
+        inbound = await self._resolve_inbound()
+        if not inbound:
+            return [], [], list(emails)
+
+        stream_settings = self._json_field(inbound, 'streamSettings')
+        current = {str(c.get('email', '')): c for c in self._parse_clients(inbound)}
+        existing = []
+        for email in emails:
+            if email in current and current[email].get('id'):
+                existing.append((email, self._build_link(inbound, stream_settings, current[email]['id'], email)))
+
+        expiry_time = int((time.time() * 1000) + (expire_days * 86400 * 1000)) if expire_days > 0 else 0
+        pending = [{
+            "id": str(uuid.uuid4()),
+            "email": email,
+            "totalGB": limit_gb * 1024 * 1024 * 1024,
+            "expiryTime": expiry_time,
+            "enable": True,
+            "tgId": "",
+            "subId": ''.join(secrets.choice(string.ascii_lowercase + string.digits) for _ in range(16)),
+            "limitIp": 1,
+        } for email in emails if email not in current]
+
+        total = len(emails)
+        done = len(existing)
+        flow_modes = [True, False]  # narrowed to whichever the panel accepts first
+
+        async def add_chunk(chunk):
+            for include_flow in list(flow_modes):
+                clients = [dict(c, flow="xtls-rprx-vision") if include_flow else c for c in chunk]
+                payload = {"id": self.inbound_id, "settings": json.dumps({"clients": clients})}
+                if await self._call('add', self._inbound_add_urls(), payload=payload, encodings=('json', 'form')):
+                    flow_modes[:] = [include_flow]
+                    return True
+            return False
+
+        add_route_works = [True]
+
+        async def add_or_split(chunk):
+            """Add a chunk; if it is rejected, bisect so one bad email does not sink the rest."""
+            if not add_route_works[0]:
+                return chunk
+            if await add_chunk(chunk):
+                return []
+            if PANEL_DIALECTS.get(self.base_url, 'add') is None:
+                # No addClient route answered at all; leave the rest to the update fallback.
+                add_route_works[0] = False
+                return chunk
+            if len(chunk) == 1:
+                return chunk
+            mid = len(chunk) // 2
+            return await add_or_split(chunk[:mid]) + await add_or_split(chunk[mid:])
+
+        rejected = []
+        for start in range(0, len(pending), BULK_ADD_CHUNK_SIZE):
+            chunk = pending[start:start + BULK_ADD_CHUNK_SIZE]
+            rejected.extend(await add_or_split(chunk))
+            done += len(chunk)
+            if progress:
+                await progress(done, total)
+
+        if rejected:
+            # Panels without a usable addClient route: append everything left in one inbound update.
+            fresh = await self._fetch_inbound(self.inbound_id)
+            if fresh:
+                for include_flow in list(flow_modes):
+                    settings_obj = self._json_field(fresh, 'settings')
+                    settings_obj['clients'] = list(settings_obj.get('clients') or []) + [
+                        dict(c, flow="xtls-rprx-vision") if include_flow else c for c in rejected
+                    ]
+                    if await self._update_inbound(*self._update_payloads(fresh, settings_obj)):
+                        break
+
+        # One read verifies the whole batch.
+        verify = await self._fetch_inbound(self.inbound_id)
+        persisted = {str(c.get('email', '')): str(c.get('id', '')) for c in self._parse_clients(verify)} if verify else {}
+        created, failed = [], []
+        for c in pending:
+            if persisted.get(c['email']) == c['id']:
+                created.append((c['email'], self._build_link(inbound, stream_settings, c['id'], c['email'])))
+            else:
+                failed.append(c['email'])
+        if failed and not self.last_error:
+            self.last_error = "Bulk add: some clients were not persisted."
+        return created, existing, failed
+
+    async def delete_client_by_email(self, email):
         """Delete one client from this inbound by email."""
         try:
-            inbound = self._fetch_inbound(self.inbound_id)
-            if not inbound:
-                self.login()
-                inbound = self._fetch_inbound(self.inbound_id)
+            inbound = await self.get_inbound()
 
             if not inbound:
                 logging.error(f"Delete failed to fetch inbound for id={self.inbound_id}")
@@ -911,54 +1060,13 @@ class XUIClient:
                 return False
 
             settings_obj['clients'] = kept_clients
-            if str(inbound.get('protocol', '')).lower() == 'vless':
-                settings_obj.setdefault('decryption', 'none')
-                settings_obj.setdefault('encryption', 'none')
-
-            settings_str = json.dumps(settings_obj)
-
-            payload_min = {
-                "id": self.inbound_id,
-                "settings": settings_str,
-            }
-            payload_full = {
-                "id": self.inbound_id,
-                "up": inbound.get('up', 0),
-                "down": inbound.get('down', 0),
-                "total": inbound.get('total', 0),
-                "remark": inbound.get('remark', ''),
-                "enable": inbound.get('enable', True),
-                "expiryTime": inbound.get('expiryTime', 0),
-                "listen": inbound.get('listen', ''),
-                "port": inbound.get('port', 0),
-                "protocol": inbound.get('protocol', 'vless'),
-                "settings": settings_str,
-                "streamSettings": inbound.get('streamSettings', '{}'),
-                "sniffing": inbound.get('sniffing', '{}'),
-                "allocate": inbound.get('allocate', '{"strategy":"always","refresh":5,"concurrency":3}'),
-                "tag": inbound.get('tag', f"in-{inbound.get('port', 0)}-tcp"),
-            }
-
-            updated = False
-            for update_url in self._inbound_update_urls(self.inbound_id):
-                for payload in (payload_min, payload_full):
-                    resp = self._try_post_json(update_url, payload)
-                    if isinstance(resp, dict) and resp.get('success'):
-                        updated = True
-                        break
-                    resp = self._try_post_form(update_url, payload)
-                    if isinstance(resp, dict) and resp.get('success'):
-                        updated = True
-                        break
-                if updated:
-                    break
-
+            updated = await self._update_inbound(*self._update_payloads(inbound, settings_obj))
             if not updated:
                 logging.error(f"Delete update failed for {email} on all safe endpoints")
                 return False
 
             # Verify target user is removed and inbound is still healthy.
-            fresh = self._fetch_inbound(self.inbound_id)
+            fresh = await self._fetch_inbound(self.inbound_id)
             if not fresh:
                 logging.error("Delete verification failed: inbound missing after update")
                 return False
@@ -985,6 +1093,195 @@ class XUIClient:
             logging.error(f"delete_client_by_email exception: {e}")
             return False
 
+# --- X-UI CLIENT POOL ---
+_XUI_CLIENTS = {}
+_XUI_CLIENTS_LOCK = threading.Lock()
+
+
+def _server_pool_key(server):
+    # Display names are not unique; the panel and inbound are.
+    return str(server.get('panel_url', '')).rstrip('/'), server.get('inbound_id')
+
+
+def _server_fingerprint(server):
+    return (
+        str(server.get('panel_url', '')).rstrip('/'),
+        server.get('username'),
+        server.get('password'),
+        server.get('inbound_id'),
+        str(server.get('api_token', '') or '').strip(),
+    )
+
+
+def get_xui_client(server):
+    """Return the shared AsyncXUIClient for a server, replacing it if its credentials changed."""
+    key = _server_pool_key(server)
+    fingerprint = _server_fingerprint(server)
+    with _XUI_CLIENTS_LOCK:
+        entry = _XUI_CLIENTS.get(key)
+        if entry and entry[0] == fingerprint:
+            return entry[1]
+        client = AsyncXUIClient(server)
+        _XUI_CLIENTS[key] = (fingerprint, client)
+    if entry:
+        try:
+            asyncio.get_running_loop().create_task(entry[1].aclose())
+        except RuntimeError:
+            pass
+    return client
+
+
+# --- BROADCASTS ---
+TRIALS = TrialStore()
+BROADCASTS = BroadcastStore()
+# Customers only ever started the customer bot, so broadcasts are sent with its
+# token; this bot just drives the flow and shows progress.
+CUSTOMER_BOT = telegram.Bot(CONFIG['bot_token'])
+BROADCAST_OUTBOX = Dispatcher(rate_per_second=BROADCAST_RATE_PER_SECOND)
+_BROADCAST_TASKS = {}  # broadcast id -> asyncio.Task
+
+
+async def collect_broadcast_audience():
+    """Customer IDs from trial tracking plus the clients of every inbound on enabled panels.
+
+    Returns (sorted user ids, names of servers that could not be read).
+    """
+    user_ids = set(TRIALS.user_ids())
+    servers, skipped = [], []
+    for server in SERVERS:
+        if not server.get('enabled', True):
+            continue
+        if PANEL_HEALTH.is_open(get_xui_client(server).base_url):
+            skipped.append(server.get('name', 'Unknown'))
+            continue
+        servers.append(server)
+
+    async def fetch(server):
+        client = get_xui_client(server)
+        inbounds = await client.list_inbounds()
+        if inbounds is None:
+            logging.warning(f"Broadcast audience scan failed on {server.get('name')}: {client.last_error}")
+        return inbounds
+
+    records, failed = await scan_servers(servers, fetch, PANEL_SCAN_CONCURRENCY)
+    user_ids.update(r['user_id'] for r in records if r['user_id'])
+    return sorted(user_ids), skipped + failed
+
+
+def build_broadcast_status(broadcast):
+    counts = BROADCASTS.counts(broadcast['id'])
+    total = sum(counts.values())
+    state = {
+        'running': '⏳ Sending', 'done': '✅ Finished', 'cancelled': '⏹ Stopped', 'failed': '⚠️ Failed',
+    }.get(broadcast['status'], broadcast['status'])
+    msg = (
+        f"📣 <b>Broadcast #{broadcast['id']}</b> — {state}\n\n"
+        f"📬 Progress: {total - counts['pending']}/{total}\n"
+        f"✅ Sent: {counts['sent']}\n"
+        f"🚫 Blocked: {counts['blocked']}\n"
+        f"❌ Failed: {counts['failed']}"
+    )
+    if broadcast['status'] == 'running':
+        keyboard = [[InlineKeyboardButton("⏹ Stop", callback_data=f"admin_bc_stop_{broadcast['id']}")]]
+    else:
+        keyboard = [[InlineKeyboardButton("📄 Delivery Report", callback_data=f"admin_bc_report_{broadcast['id']}")]]
+    return msg, InlineKeyboardMarkup(keyboard)
+
+
+async def show_broadcast_status(bot, broadcast_id):
+    broadcast = BROADCASTS.get(broadcast_id)
+    if not broadcast or not broadcast['message_id']:
+        return
+    msg, markup = build_broadcast_status(broadcast)
+    try:
+        await bot.edit_message_text(
+            chat_id=broadcast['chat_id'], message_id=broadcast['message_id'],
+            text=msg, parse_mode='HTML', reply_markup=markup
+        )
+    except Exception:
+        pass  # unchanged text, or the admin deleted the message
+
+
+async def _send_broadcast(broadcast_id, bot):
+    """Deliver every still-pending recipient of a broadcast, batch by batch."""
+    broadcast = BROADCASTS.get(broadcast_id)
+    await CUSTOMER_BOT.initialize()
+    last_edit = 0.0
+
+    async def deliver(user_id, sent):
+        try:
+            await sent
+            BROADCASTS.mark(broadcast_id, user_id, 'sent')
+        except telegram.error.Forbidden as e:
+            BROADCASTS.mark(broadcast_id, user_id, 'blocked', e)
+        except Exception as e:
+            BROADCASTS.mark(broadcast_id, user_id, 'failed', e)
+
+    while BROADCASTS.get(broadcast_id)['status'] == 'running':
+        batch = BROADCASTS.pending(broadcast_id, BROADCAST_BATCH_SIZE)
+        if not batch:
+            BROADCASTS.finish(broadcast_id, 'done')
+            break
+        await asyncio.gather(*(
+            deliver(user_id, BROADCAST_OUTBOX.submit(
+                CUSTOMER_BOT.send_message, user_id, priority=PRIORITY_NOTICE,
+                text=broadcast['text'], parse_mode='HTML'
+            ))
+            for user_id in batch
+        ))
+        if time.monotonic() - last_edit >= BROADCAST_PROGRESS_EDIT_SECONDS:
+            last_edit = time.monotonic()
+            await show_broadcast_status(bot, broadcast_id)
+
+
+async def run_broadcast(broadcast_id, bot):
+    """Send a broadcast; if sending breaks off, mark it failed instead of leaving it running."""
+    try:
+        await _send_broadcast(broadcast_id, bot)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # e.g. a bad bot_token in CUSTOMER_BOT.initialize() or a broadcasts.db error.
+        # Left 'running', it would be resumed and die again on every restart.
+        logging.error(f"📣 Broadcast #{broadcast_id} stopped: {e}")
+        try:
+            BROADCASTS.finish(broadcast_id, 'failed')
+        except Exception as store_error:
+            logging.error(f"📣 Could not mark broadcast #{broadcast_id} failed: {store_error}")
+
+    try:
+        logging.info(f"📣 Broadcast #{broadcast_id} ended: {BROADCASTS.counts(broadcast_id)}")
+        await show_broadcast_status(bot, broadcast_id)
+    except Exception as e:
+        logging.error(f"📣 Broadcast #{broadcast_id} status update failed: {e}")
+
+
+def start_broadcast(application, broadcast_id):
+    if broadcast_id in _BROADCAST_TASKS:
+        return
+    # A plain task, not application.create_task(): PTB would make shutdown wait for
+    # the whole broadcast. Unsent recipients stay pending and resume on restart.
+    task = asyncio.get_running_loop().create_task(run_broadcast(broadcast_id, application.bot))
+    _BROADCAST_TASKS[broadcast_id] = task
+    task.add_done_callback(lambda t: _BROADCAST_TASKS.pop(broadcast_id, None))
+
+
+async def resume_broadcasts(application: Application):
+    """post_init hook: pick up broadcasts interrupted by a restart."""
+    for broadcast in BROADCASTS.running():
+        logging.info(f"📣 Resuming broadcast #{broadcast['id']}")
+        start_broadcast(application, broadcast['id'])
+
+
+async def stop_broadcasts(application: Application):
+    """post_shutdown hook: stop sending; whatever is unsent stays pending."""
+    for task in list(_BROADCAST_TASKS.values()):
+        task.cancel()
+    await asyncio.gather(*_BROADCAST_TASKS.values(), return_exceptions=True)
+    await BROADCAST_OUTBOX.close(timeout=5)
+    await CUSTOMER_BOT.shutdown()
+
+
 # --- TELEGRAM BOT LOGIC ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -998,6 +1295,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("⚡️ Generate Trial Key", callback_data='admin_gen_trial')],
         [InlineKeyboardButton("📦 Bulk Generate Users", callback_data='admin_bulk_gen')],
         [InlineKeyboardButton("🧊 Inactive Users", callback_data='admin_inactive_users')],
+        [InlineKeyboardButton("📣 Broadcast To Customers", callback_data='admin_broadcast')],
         [InlineKeyboardButton("⚙️ Manage Servers", callback_data='admin_manage_menu')],
         [InlineKeyboardButton("🔌 Add New Server", callback_data='admin_add_server')]
     ]
@@ -1011,7 +1309,7 @@ async def inactive_users_command(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     wait_msg = await update.message.reply_text("🔍 Scanning inactive users across servers...")
-    rows = collect_inactive_users()
+    rows = await collect_inactive_users()
     await wait_msg.edit_text(f"✅ Found {len(rows)} inactive users. Sending cards...")
     await send_inactive_cards(update.effective_chat.id, context, rows)
 
@@ -1025,6 +1323,7 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query.from_user.id not in ADMIN_IDS:
         await query.edit_message_text("⛔️ This bot is for Admins only.")
         return
+    refresh_config()
     
     # Cancel button handler
     if query.data == 'admin_cancel':
@@ -1113,17 +1412,14 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith('toggle_srv_'):
         idx = int(query.data.split('_')[-1])
-        # Reload latest config before modify
-        CONFIG = load_config()
-        SERVERS = CONFIG['servers']
-        
-        s = SERVERS[idx]
-        current = s.get('enabled', True)
-        s['enabled'] = not current
-        SERVERS[idx] = s
-        CONFIG['servers'] = SERVERS
-        with open('../config.json', 'w') as f:
-            json.dump(CONFIG, f, indent=4)
+
+        def toggle(config):
+            if idx >= len(config['servers']):
+                return False
+            s = config['servers'][idx]
+            s['enabled'] = not s.get('enabled', True)
+
+        save_config(toggle)
         
         # Refresh Menu
         query.data = f'manage_srv_{idx}'
@@ -1132,10 +1428,11 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith('set_def_'):
         idx = int(query.data.split('_')[-1])
-        CONFIG = load_config()
-        CONFIG['default_server_id'] = idx
-        with open('../config.json', 'w') as f:
-            json.dump(CONFIG, f, indent=4)
+
+        def set_default(config):
+            config['default_server_id'] = idx
+
+        save_config(set_default)
         
         query.data = f'manage_srv_{idx}'
         await admin_handler(update, context)
@@ -1143,60 +1440,51 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith('toggle_scope_'):
         idx = int(query.data.split('_')[-1])
-        CONFIG = load_config()
-        SERVERS = CONFIG['servers']
 
-        if idx >= len(SERVERS):
+        def toggle(config):
+            if idx >= len(config['servers']):
+                return False
+            s = config['servers'][idx]
+            s['vpn_status_scope'] = not bool(s.get('vpn_status_scope', False))
+
+        if save_config(toggle) is None:
             await query.edit_message_text("❌ Server not found.")
             return
 
-        s = SERVERS[idx]
-        s['vpn_status_scope'] = not bool(s.get('vpn_status_scope', False))
-        SERVERS[idx] = s
-        CONFIG['servers'] = SERVERS
-        with open('../config.json', 'w') as f:
-            json.dump(CONFIG, f, indent=4)
-
         query.data = f'manage_srv_{idx}'
         await admin_handler(update, context)
         return
 
     elif query.data.startswith('toggle_vpn_new_'):
         idx = int(query.data.split('_')[-1])
-        CONFIG = load_config()
-        SERVERS = CONFIG['servers']
 
-        if idx >= len(SERVERS):
+        def toggle(config):
+            if idx >= len(config['servers']):
+                return False
+            s = config['servers'][idx]
+            s['vpn_block_new_profiles'] = not bool(s.get('vpn_block_new_profiles', False))
+
+        if save_config(toggle) is None:
             await query.edit_message_text("❌ Server not found.")
             return
 
-        s = SERVERS[idx]
-        s['vpn_block_new_profiles'] = not bool(s.get('vpn_block_new_profiles', False))
-        SERVERS[idx] = s
-        CONFIG['servers'] = SERVERS
-        with open('../config.json', 'w') as f:
-            json.dump(CONFIG, f, indent=4)
-
         query.data = f'manage_srv_{idx}'
         await admin_handler(update, context)
         return
 
     elif query.data.startswith('toggle_vpn_renew_'):
         idx = int(query.data.split('_')[-1])
-        CONFIG = load_config()
-        SERVERS = CONFIG['servers']
 
-        if idx >= len(SERVERS):
+        def toggle(config):
+            if idx >= len(config['servers']):
+                return False
+            s = config['servers'][idx]
+            s['vpn_block_renewals'] = not bool(s.get('vpn_block_renewals', False))
+
+        if save_config(toggle) is None:
             await query.edit_message_text("❌ Server not found.")
             return
 
-        s = SERVERS[idx]
-        s['vpn_block_renewals'] = not bool(s.get('vpn_block_renewals', False))
-        SERVERS[idx] = s
-        CONFIG['servers'] = SERVERS
-        with open('../config.json', 'w') as f:
-            json.dump(CONFIG, f, indent=4)
-
         query.data = f'manage_srv_{idx}'
         await admin_handler(update, context)
         return
@@ -1211,8 +1499,8 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         s = SERVERS[idx]
-        client = XUIClient(s)
-        ok, detected_id, detail = client.create_auto_inbound(
+        client = get_xui_client(s)
+        ok, detected_id, detail = await client.create_auto_inbound(
             remark=s.get('name', f"Server {idx+1}"),
             port=443
         )
@@ -1228,10 +1516,13 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         s['inbound_id'] = int(detected_id)
-        SERVERS[idx] = s
-        CONFIG['servers'] = SERVERS
-        with open('../config.json', 'w') as f:
-            json.dump(CONFIG, f, indent=4)
+
+        def set_inbound(config):
+            if idx >= len(config['servers']):
+                return False
+            config['servers'][idx]['inbound_id'] = s['inbound_id']
+
+        save_config(set_inbound)
 
         await query.edit_message_text(
             f"✅ Inbound created on <b>{s.get('name')}</b>.\n"
@@ -1252,8 +1543,8 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         s = SERVERS[idx]
-        client = XUIClient(s)
-        inbounds = client.list_inbounds_brief()
+        client = get_xui_client(s)
+        inbounds = await client.list_inbounds_brief()
 
         if not inbounds:
             await query.edit_message_text(
@@ -1290,18 +1581,15 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         idx = int(parts[2])
         inbound_id = int(parts[3])
 
-        CONFIG = load_config()
-        SERVERS = CONFIG['servers']
-        if idx >= len(SERVERS):
+        def set_inbound(config):
+            if idx >= len(config['servers']):
+                return False
+            config['servers'][idx]['inbound_id'] = inbound_id
+
+        if save_config(set_inbound) is None:
             await query.edit_message_text("❌ Server not found.")
             return
-
         s = SERVERS[idx]
-        s['inbound_id'] = inbound_id
-        SERVERS[idx] = s
-        CONFIG['servers'] = SERVERS
-        with open('../config.json', 'w') as f:
-            json.dump(CONFIG, f, indent=4)
 
         await query.edit_message_text(
             f"✅ Updated <b>{s.get('name')}</b> inbound_id to <b>{inbound_id}</b>.",
@@ -1313,9 +1601,11 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith('del_srv_'):
         idx = int(query.data.split('_')[-1])
-        CONFIG = load_config() # Reload
-        SERVERS = CONFIG['servers']
-        s = SERVERS[idx]
+        snapshot = CONFIG_LOADER.get()
+        s = snapshot.servers[idx]
+        # confirm_del only deletes if nothing changed since this prompt, so a
+        # server added/removed by the other bot cannot shift `idx` under us.
+        context.user_data['del_srv_version'] = config_version(snapshot.data)
         msg = f"⚠️ <b>Delete Server?</b>\n\nAre you sure you want to delete <b>{s.get('name')}</b>?\nThis cannot be undone."
         keyboard = [
             [InlineKeyboardButton("✅ Yes, Delete", callback_data=f'confirm_del_{idx}')],
@@ -1326,19 +1616,24 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith('confirm_del_'):
         idx = int(query.data.split('_')[-1])
-        CONFIG = load_config()
-        SERVERS = CONFIG['servers']
-        if idx < len(SERVERS):
-            deleted = SERVERS.pop(idx)
-            CONFIG['servers'] = SERVERS
-            
+        deleted = {}
+
+        def delete(config):
+            if idx >= len(config['servers']):
+                return False
+            deleted.update(config['servers'].pop(idx))
             # Reset default if needed
-            if CONFIG.get('default_server_id', 0) >= idx:
-                CONFIG['default_server_id'] = max(0, CONFIG.get('default_server_id', 0) - 1)
-                
-            with open('../config.json', 'w') as f:
-                json.dump(CONFIG, f, indent=4)
-            
+            if config.get('default_server_id', 0) >= idx:
+                config['default_server_id'] = max(0, config.get('default_server_id', 0) - 1)
+
+        try:
+            done = save_config(delete, expected_version=context.user_data.pop('del_srv_version', None))
+        except ConfigConflict:
+            await query.edit_message_text("⚠️ Server list changed since you opened this menu. Please try again.")
+            keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data='admin_manage_menu')]]
+            await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+        if done is not None:
             await query.edit_message_text(f"🗑 Deleted <b>{deleted.get('name')}</b>.", parse_mode='HTML')
             keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data='admin_manage_menu')]]
             await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
@@ -1427,25 +1722,29 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ip_label = s.get('name', f"Server {i+1}")
 
             is_enabled = s.get('enabled', True)
+            client = get_xui_client(s)
             status_emoji = "✅"
             if not is_enabled:
                 status_emoji = "⛔️ (Disabled)"
+            elif PANEL_HEALTH.is_open(client.base_url):
+                status_emoji = "❌ Offline"
             else:
                 try:
                     # Quick login check
-                    client = XUIClient(s)
-                    status_emoji = "✅ Online"
+                    status_emoji = "✅ Online" if await client.login() else "❌ Offline"
                 except:
                     status_emoji = "❌ Offline"
             
             msg += f"{ip_label}: {status_emoji}\n"
+            if is_enabled:
+                msg += f"   └ {html.escape(PANEL_HEALTH.describe(client.base_url))}\n"
             
         keyboard = [[InlineKeyboardButton("🔙 Back", callback_data='admin_back')]]
         await query.edit_message_text(msg, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
 
     elif query.data == 'admin_inactive_users':
         await query.edit_message_text("🔍 Scanning inactive users across servers...", parse_mode='HTML')
-        rows = collect_inactive_users()
+        rows = await collect_inactive_users()
         keyboard = [[InlineKeyboardButton("🔙 Back", callback_data='admin_back')]]
         await query.edit_message_text(
             f"✅ Found {len(rows)} inactive users. Sending cards below.",
@@ -1487,8 +1786,8 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        client = XUIClient(target_server)
-        deleted = client.delete_client_by_email(email)
+        client = get_xui_client(target_server)
+        deleted = await client.delete_client_by_email(email)
         cache.pop(token, None)
 
         if deleted:
@@ -1504,6 +1803,45 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode='HTML'
             )
 
+    elif query.data == 'admin_broadcast':
+        context.user_data['gen_type'] = 'broadcast'
+        keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data='admin_cancel')]]
+        await query.edit_message_text(
+            "📣 <b>Broadcast To Customers</b>\n\n"
+            "Send the announcement as your next message. Formatting (bold, links...) is kept.\n"
+            "You will see a preview and the audience size before anything is sent.",
+            parse_mode='HTML',
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    elif query.data == 'admin_bc_send':
+        draft = context.user_data.pop('broadcast_draft', None)
+        if not draft:
+            await query.edit_message_text("⚠️ This broadcast draft has expired. Please start again.")
+            return
+        broadcast_id = BROADCASTS.create(draft['text'], query.from_user.id, query.message.chat_id, draft['user_ids'])
+        BROADCASTS.set_message(broadcast_id, query.message.message_id)
+        msg, markup = build_broadcast_status(BROADCASTS.get(broadcast_id))
+        await query.edit_message_text(msg, parse_mode='HTML', reply_markup=markup)
+        logging.info(f"📣 Broadcast #{broadcast_id} started by {query.from_user.id} for {len(draft['user_ids'])} users")
+        start_broadcast(context.application, broadcast_id)
+
+    elif query.data.startswith('admin_bc_stop_'):
+        broadcast_id = int(query.data.split('_')[-1])
+        BROADCASTS.finish(broadcast_id, 'cancelled')
+        await show_broadcast_status(context.bot, broadcast_id)
+
+    elif query.data.startswith('admin_bc_report_'):
+        broadcast_id = int(query.data.split('_')[-1])
+        rows = BROADCASTS.report(broadcast_id)
+        lines = [f"{user_id}\t{status}\t{error}".rstrip() for user_id, status, error in rows]
+        document = io.BytesIO("\n".join(lines).encode('utf-8'))
+        document.name = f"broadcast_{broadcast_id}_report.txt"
+        await context.bot.send_document(
+            chat_id=query.message.chat_id, document=document,
+            caption=f"📄 Broadcast #{broadcast_id}: {len(rows)} recipients"
+        )
+
     elif query.data == 'admin_back':
         await start(update, context) # Reuse start logic
 
@@ -1551,7 +1889,6 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 url = "https://" + url
 
             new_server = {
-                "name": f"Server {len(SERVERS)+1}",
                 "panel_url": url.strip(),
                 "username": user.strip(),
                 "password": pwd.strip(),
@@ -1565,23 +1902,24 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             }
 
             # Try to auto-detect the most suitable inbound for this panel.
+            probe_client = AsyncXUIClient(new_server)
             try:
-                probe_client = XUIClient(new_server)
-                detected_id = probe_client.discover_preferred_inbound_id()
+                detected_id = await probe_client.discover_preferred_inbound_id()
                 new_server["inbound_id"] = int(detected_id)
             except Exception:
                 pass
-
-            # Reload the config just before writing to ensure we don't persist any
-            # accidental in-memory changes.
-            CONFIG = load_config()
-            SERVERS = CONFIG.get('servers', [])
-            SERVERS.append(new_server)
-            CONFIG['servers'] = SERVERS
-            # Write back to parent config.json (root)
-            with open('../config.json', 'w') as f:
-                json.dump(CONFIG, f, indent=4)
-            await update.message.reply_text("✅ Server Added Successfully!")
+            finally:
+                await probe_client.aclose()
+
+            # Named and appended inside the locked edit, from the file's own server
+            # list, so a server vpn_bot just added can't end up with the same name.
+            def append_server(config):
+                servers = config.setdefault('servers', [])
+                new_server['name'] = next_server_name(servers)
+                servers.append(new_server)
+
+            save_config(append_server)
+            await update.message.reply_text(f"✅ Server Added Successfully!\nName: {new_server['name']}")
             context.user_data['gen_type'] = None
             return
         except Exception as e:
@@ -1595,55 +1933,73 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             count = int(count_raw)
             limit_gb = int(gb_raw)
             expire_days = int(days_raw)
-            if count <= 0 or count > 30:
-                raise ValueError("count must be between 1 and 30")
+            if count <= 0 or count > BULK_GENERATE_MAX_USERS:
+                raise ValueError(f"count must be between 1 and {BULK_GENERATE_MAX_USERS}")
             if limit_gb <= 0:
                 raise ValueError("gb must be greater than 0")
             if expire_days <= 0:
                 raise ValueError("days must be greater than 0")
             if not prefix:
                 raise ValueError("prefix cannot be empty")
+        except Exception as e:
+            await update.message.reply_text(
+                f"❌ Invalid bulk format: {e}\n\n"
+                "Use: <code>prefix|count|gb|days</code>\n"
+                "Example: <code>teamA|5|200|30</code>",
+                parse_mode='HTML'
+            )
+            return
 
-            server_idx = context.user_data.get('gen_server_idx', CONFIG.get('default_server_id', 0))
-            target_server = SERVERS[server_idx] if server_idx < len(SERVERS) else SERVERS[0]
-            status_msg = await update.message.reply_text("⚙️ Generating bulk users...")
-
-            client = XUIClient(target_server)
-            created = []
-            skipped = []
-            failed = []
-            fail_reason = ""
-
-            for i in range(1, count + 1):
-                username = f"{prefix}_{i}"
-                result = client.add_client(email=username, limit_gb=limit_gb, expire_days=expire_days)
-                if isinstance(result, tuple):
-                    link, existed = result
-                else:
-                    link = result
-                    existed = False
-
-                if link and not existed:
-                    created.append((username, link))
-                elif link and existed:
-                    skipped.append(username)
-                else:
-                    failed.append(username)
-                    if not fail_reason:
-                        fail_reason = client.last_error
+        server_idx = context.user_data.get('gen_server_idx', CONFIG.get('default_server_id', 0))
+        target_server = SERVERS[server_idx] if server_idx < len(SERVERS) else SERVERS[0]
+        context.user_data['gen_type'] = None
+        status_msg = await update.message.reply_text("⚙️ Generating bulk users...")
 
-            context.user_data['gen_type'] = None
-            summary = (
-                f"✅ <b>Bulk Generation Finished</b>\n\n"
-                f"🖥 Server: {target_server.get('name')}\n"
-                f"📦 Requested: {count}\n"
-                f"✅ Created: {len(created)}\n"
-                f"⚠️ Duplicate: {len(skipped)}\n"
-                f"❌ Failed: {len(failed)}\n"
-                f"📊 Plan: {limit_gb} GB / {expire_days} days"
-            )
-            await status_msg.edit_text(summary, parse_mode='HTML')
+        last_edit = [0.0]
+
+        async def show_progress(done, total):
+            now = time.monotonic()
+            if done < total and now - last_edit[0] < BULK_PROGRESS_EDIT_SECONDS:
+                return
+            last_edit[0] = now
+            try:
+                await status_msg.edit_text(f"⚙️ Generating bulk users... {done}/{total}")
+            except Exception:
+                pass
 
+        client = get_xui_client(target_server)
+        emails = [f"{prefix}_{i}" for i in range(1, count + 1)]
+        try:
+            created, existing, failed = await client.add_clients_bulk(
+                emails, limit_gb=limit_gb, expire_days=expire_days, progress=show_progress
+            )
+        except Exception as e:
+            logging.error(f"Bulk generation failed on {target_server.get('name')}: {e}")
+            await status_msg.edit_text(f"❌ Bulk generation failed: {e}")
+            return
+        skipped = [name for name, _ in existing]
+        fail_reason = client.last_error if failed else ""
+
+        summary = (
+            f"✅ <b>Bulk Generation Finished</b>\n\n"
+            f"🖥 Server: {target_server.get('name')}\n"
+            f"📦 Requested: {count}\n"
+            f"✅ Created: {len(created)}\n"
+            f"⚠️ Duplicate: {len(skipped)}\n"
+            f"❌ Failed: {len(failed)}\n"
+            f"📊 Plan: {limit_gb} GB / {expire_days} days"
+        )
+        await status_msg.edit_text(summary, parse_mode='HTML')
+
+        if len(created) + len(skipped) + len(failed) > BULK_LINKS_INLINE_MAX:
+            # Too many for chat messages; send one text file instead.
+            lines = [f"{name}\t{link}" for name, link in created]
+            lines += [f"{name}\tDUPLICATE" for name in skipped]
+            lines += [f"{name}\tFAILED" for name in failed]
+            document = io.BytesIO("\n".join(lines).encode('utf-8'))
+            document.name = f"{prefix}_{len(created)}_keys.txt"
+            await update.message.reply_document(document=document, caption=f"📦 {prefix}: {len(created)} keys")
+        else:
             if created:
                 lines = [f"{name}:\n<code>{link}</code>" for name, link in created]
                 await update.message.reply_text("\n\n".join(lines), parse_mode='HTML')
@@ -1657,21 +2013,40 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "❌ Failed users:\n" + "\n".join(failed),
                     parse_mode='HTML'
                 )
-                if fail_reason:
-                    await update.message.reply_text(
-                        f"⚠️ Failure reason: <code>{fail_reason}</code>",
-                        parse_mode='HTML'
-                    )
-            return
-        except Exception as e:
+        if fail_reason:
             await update.message.reply_text(
-                f"❌ Invalid bulk format: {e}\n\n"
-                "Use: <code>prefix|count|gb|days</code>\n"
-                "Example: <code>teamA|5|200|30</code>",
+                f"⚠️ Failure reason: <code>{html.escape(fail_reason)}</code>",
                 parse_mode='HTML'
             )
+        return
+
+    if context.user_data.get('gen_type') == 'broadcast':
+        context.user_data['gen_type'] = None
+        text = update.message.text_html
+        status_msg = await update.message.reply_text("🔍 Building audience from trials and all panels...")
+        user_ids, skipped = await collect_broadcast_audience()
+        if not user_ids:
+            await status_msg.edit_text("❌ No customers found to broadcast to.")
             return
 
+        try:
+            await update.message.reply_text(text, parse_mode='HTML')
+        except Exception as e:
+            await status_msg.edit_text(f"❌ Telegram rejected this message: {e}")
+            return
+
+        context.user_data['broadcast_draft'] = {'text': text, 'user_ids': user_ids}
+        summary = f"👆 <b>Preview</b>\n\n👥 Audience: <b>{len(user_ids)}</b> customers"
+        if skipped:
+            summary += f"\n⚠️ Could not read: {html.escape(', '.join(skipped))} (their customers are not included)"
+        keyboard = [
+            [InlineKeyboardButton(f"✅ Send To {len(user_ids)} Customers", callback_data='admin_bc_send')],
+            [InlineKeyboardButton("❌ Cancel", callback_data='admin_cancel')]
+        ]
+        await status_msg.delete()
+        await update.message.reply_text(summary, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
     # Check if waiting for username
     if context.user_data.get('gen_type'):
         username = update.message.text
@@ -1689,8 +2064,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Safely get target server
             target_server = SERVERS[server_idx] if server_idx < len(SERVERS) else SERVERS[0]
             
-            client = XUIClient(target_server)
-            result = client.add_client(email=username, limit_gb=limit_gb, expire_days=days)
+            client = get_xui_client(target_server)
+            result = await client.add_client(email=username, limit_gb=limit_gb, expire_days=days)
             if isinstance(result, tuple):
                 link, existed = result
             else:
@@ -1717,7 +2092,13 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 def main():
     # use the explicit admin token, not whatever `bot_token` happens to be in
     # the JSON file.
-    app = Application.builder().token(ADMIN_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(ADMIN_TOKEN)
+        .post_init(resume_broadcasts)
+        .post_shutdown(stop_broadcasts)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("inactive_users", inactive_users_command))
     app.add_handler(CommandHandler("inactive", inactive_users_command))
@@ -1733,11 +2114,11 @@ def main():
         # Provide helpful guidance for Conflict errors
         err = getattr(context, 'error', None)
         if err and isinstance(err, telegram.error.Conflict):
-            logging.error("Conflict: terminated by other getUpdates request; ensure only one bot instance is running or switch to webhooks.")
+            logging.error("Conflict: terminated by other getUpdates request; ensure only one bot instance is running or enable webhook mode for this bot in config.json (see common/serving.py).")
 
     app.add_error_handler(error_handler)
     print("Admin Bot is running...")
-    app.run_polling()
+    serving.run(app, CONFIG, 'admin_bot')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1 @@
+"""Helpers shared by vpn_bot, admin_bot and the dashboard."""
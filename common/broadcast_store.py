@@ -0,0 +1,136 @@
+"""
+Durable state for admin broadcasts to the whole customer base.
+
+Each broadcast keeps one row per recipient with its delivery status
+('pending', 'sent', 'failed' or 'blocked'). The sender works through the
+pending rows in batches and marks each recipient as soon as Telegram
+answers. A restart therefore resumes with the recipients that are still
+pending. At most the sends that were in flight at the crash are repeated.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DB_PATH = os.path.join(REPO_DIR, 'admin_bot', 'broadcasts.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    text        TEXT NOT NULL,
+    created_by  INTEGER NOT NULL,
+    chat_id     INTEGER NOT NULL,
+    message_id  INTEGER,
+    status      TEXT NOT NULL DEFAULT 'running',
+    created_at  INTEGER NOT NULL,
+    finished_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS recipients (
+    broadcast_id INTEGER NOT NULL,
+    user_id      INTEGER NOT NULL,
+    status       TEXT NOT NULL DEFAULT 'pending',
+    error        TEXT NOT NULL DEFAULT '',
+    updated_at   INTEGER NOT NULL,
+    PRIMARY KEY (broadcast_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS recipients_status ON recipients (broadcast_id, status);
+"""
+
+BROADCAST_COLUMNS = ('id', 'text', 'created_by', 'chat_id', 'message_id', 'status', 'created_at', 'finished_at')
+
+
+class BroadcastStore:
+    """Broadcasts and their per-recipient delivery status."""
+
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+
+    def create(self, text, created_by, chat_id, user_ids):
+        """Record a new running broadcast with every recipient pending; returns its id."""
+        now = int(time.time())
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                cur = self._db.execute(
+                    'INSERT INTO broadcasts (text, created_by, chat_id, created_at) VALUES (?, ?, ?, ?)',
+                    (text, int(created_by), int(chat_id), now),
+                )
+                broadcast_id = cur.lastrowid
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO recipients (broadcast_id, user_id, updated_at) VALUES (?, ?, ?)',
+                    ((broadcast_id, int(uid), now) for uid in user_ids),
+                )
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return broadcast_id
+
+    def get(self, broadcast_id):
+        with self._lock:
+            row = self._db.execute(
+                f'SELECT {", ".join(BROADCAST_COLUMNS)} FROM broadcasts WHERE id = ?', (int(broadcast_id),)
+            ).fetchone()
+        return dict(zip(BROADCAST_COLUMNS, row)) if row else None
+
+    def running(self):
+        """Broadcasts that were still sending, oldest first (to resume after a restart)."""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {', '.join(BROADCAST_COLUMNS)} FROM broadcasts WHERE status = 'running' ORDER BY id"
+            ).fetchall()
+        return [dict(zip(BROADCAST_COLUMNS, r)) for r in rows]
+
+    def set_message(self, broadcast_id, message_id):
+        """Remember the admin chat message that shows live progress."""
+        with self._lock:
+            self._db.execute('UPDATE broadcasts SET message_id = ? WHERE id = ?', (int(message_id), int(broadcast_id)))
+
+    def finish(self, broadcast_id, status='done'):
+        """Mark a running broadcast 'done', 'cancelled' or 'failed'; True if it was still running."""
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status = 'running'",
+                (status, int(time.time()), int(broadcast_id)),
+            )
+        return cur.rowcount > 0
+
+    def pending(self, broadcast_id, limit):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT user_id FROM recipients WHERE broadcast_id = ? AND status = 'pending' LIMIT ?",
+                (int(broadcast_id), int(limit)),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def mark(self, broadcast_id, user_id, status, error=''):
+        with self._lock:
+            self._db.execute(
+                'UPDATE recipients SET status = ?, error = ?, updated_at = ? WHERE broadcast_id = ? AND user_id = ?',
+                (status, str(error)[:200], int(time.time()), int(broadcast_id), int(user_id)),
+            )
+
+    def counts(self, broadcast_id):
+        """{'pending': n, 'sent': n, 'failed': n, 'blocked': n} for one broadcast."""
+        counts = {'pending': 0, 'sent': 0, 'failed': 0, 'blocked': 0}
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT status, COUNT(*) FROM recipients WHERE broadcast_id = ? GROUP BY status', (int(broadcast_id),)
+            ).fetchall()
+        counts.update(dict(rows))
+        return counts
+
+    def report(self, broadcast_id):
+        """(user_id, status, error) for every recipient, for the delivery report."""
+        with self._lock:
+            return self._db.execute(
+                'SELECT user_id, status, error FROM recipients WHERE broadcast_id = ? ORDER BY status, user_id',
+                (int(broadcast_id),),
+            ).fetchall()
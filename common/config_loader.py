@@ -0,0 +1,89 @@
+"""
+Cached, versioned access to config.json for the bots and the dashboard.
+
+Handlers used to re-open and re-parse config.json several times per update.
+ConfigLoader stats the file instead and re-parses only when its mtime, size
+or inode changes. Each parse publishes a new ConfigSnapshot with a higher
+version number.
+
+Snapshot data is deeply read-only: mappings are MappingProxyType and lists
+are tuples. Code that edits the config takes a mutable copy with thaw(),
+writes it back, and the next get() picks the change up.
+"""
+
+import json
+import logging
+import os
+import threading
+import types
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json')
+
+
+def freeze(obj):
+    if isinstance(obj, dict):
+        return types.MappingProxyType({k: freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+def thaw(obj):
+    if isinstance(obj, (dict, types.MappingProxyType)):
+        return {k: thaw(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [thaw(v) for v in obj]
+    return obj
+
+
+class ConfigSnapshot:
+    """One parsed version of config.json."""
+
+    __slots__ = ('version', 'data')
+
+    def __init__(self, version, data):
+        self.version = version
+        self.data = freeze(data)
+
+    @property
+    def servers(self):
+        return self.data.get('servers', ())
+
+    @property
+    def admin_ids(self):
+        return self.data.get('admin_ids', ())
+
+    def thaw(self):
+        """A plain, mutable deep copy of the config for editing."""
+        return thaw(self.data)
+
+
+class ConfigLoader:
+    """Re-parses config.json only when the file changes on disk."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._snapshot = None
+
+    def get(self):
+        """Return the current snapshot; raises only if no good snapshot has been read yet."""
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self._lock:
+            if stamp != self._stamp or self._snapshot is None:
+                try:
+                    with open(self.path, 'r') as f:
+                        data = json.load(f)
+                except ValueError:
+                    # Caught mid-write by another process: keep serving the last good
+                    # snapshot and re-read on the next call.
+                    if self._snapshot is None:
+                        raise
+                    logging.warning(f"{self.path} is not valid JSON right now; keeping config v{self._snapshot.version}")
+                    return self._snapshot
+                version = self._snapshot.version + 1 if self._snapshot else 1
+                self._snapshot = ConfigSnapshot(version, data)
+                self._stamp = stamp
+            return self._snapshot
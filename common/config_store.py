@@ -0,0 +1,112 @@
+"""
+Locked, versioned writes to config.json shared by admin_bot and vpn_bot.
+
+Both bots used to edit config.json with a plain open('w') + json.dump of a
+copy they had read earlier, so concurrent edits from the two processes
+could overwrite each other or leave a truncated file. ConfigStore.update()
+does each edit as:
+
+    take an exclusive lock on config.json.lock
+    -> re-read the file
+    -> check the expected version (compare-and-swap)
+    -> apply the change
+    -> bump "config_version"
+    -> atomic temp-file + rename
+
+Readers never take the lock. The ConfigLoader stat check already spots a
+replaced file, and the version is stored in the file itself as
+config_version.
+"""
+
+import contextlib
+import json
+
+from common.config_loader import DEFAULT_PATH, ConfigLoader
+from common.json_state import atomic_write_json
+
+try:
+    import fcntl
+except ImportError:  # Windows (run_bots.ps1)
+    fcntl = None
+    import msvcrt
+
+VERSION_KEY = 'config_version'
+
+
+class ConfigConflict(Exception):
+    """The config changed since the caller read it; re-read and try again."""
+
+    def __init__(self, expected, actual):
+        super().__init__(f"config.json is at v{actual}, expected v{expected}")
+        self.expected = expected
+        self.actual = actual
+
+
+@contextlib.contextmanager
+def _locked(lock_path):
+    with open(lock_path, 'a+') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def config_version(config):
+    return int(config.get(VERSION_KEY, 0) or 0)
+
+
+def next_server_name(servers):
+    """"Server N" for a server being added, skipping names already in use.
+
+    Pass the servers read inside ConfigStore.update() so both bots see the
+    same list.
+    """
+    taken = {s.get('name') for s in servers}
+    n = len(servers) + 1
+    while f"Server {n}" in taken:
+        n += 1
+    return f"Server {n}"
+
+
+class ConfigStore:
+    """Serialised read-modify-write of config.json across processes."""
+
+    def __init__(self, path=DEFAULT_PATH, loader=None):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.loader = loader or ConfigLoader(path)
+
+    def version(self):
+        """Version of the config as last seen by the loader; a stat(), no parse."""
+        return config_version(self.loader.get().data)
+
+    def update(self, mutate, expected_version=None):
+        """Apply mutate(config) under the lock and persist it.
+
+        `config` is a fresh mutable copy read while holding the lock, so
+        concurrent edits from the other bot are never lost. If mutate returns
+        False nothing is written. If `expected_version` is given and the file
+        is at another version, ConfigConflict is raised before mutate runs.
+
+        Returns the new version, or None when mutate declined.
+        """
+        with _locked(self.lock_path):
+            with open(self.path, 'r') as f:
+                config = json.load(f)
+            current = config_version(config)
+            if expected_version is not None and expected_version != current:
+                raise ConfigConflict(expected_version, current)
+            if mutate(config) is False:
+                return None
+            config[VERSION_KEY] = current + 1
+            atomic_write_json(self.path, config, indent=4)
+        return current + 1
@@ -0,0 +1,39 @@
+"""
+Mapping panel clients back to the Telegram customers who own them.
+
+Keys issued by vpn_bot carry the buyer's Telegram ID in the email label,
+e.g. Premium_1234_abcd or FreeTrial_1234. Keys made by hand on the panel may
+carry it in tgId instead. Pre-provisioned trial keys that vpn_bot keeps in
+its warm pool are labelled WarmTrial_<hex> and belong to nobody yet.
+"""
+
+import re
+
+_EMAIL_USER_ID = re.compile(r'^(?:Premium|FreeTrial)_(\d+)')
+
+WARM_TRIAL_PREFIX = 'WarmTrial_'
+
+
+def extract_user_id_from_email(email: str):
+    """Extract Telegram user ID from bot-generated email labels, e.g. Premium_1234_abcd."""
+    if not email:
+        return None
+
+    m = _EMAIL_USER_ID.match(str(email))
+    if m:
+        return int(m.group(1))
+    return None
+
+
+def client_user_id(client):
+    """Telegram user ID for a panel client: from its email label, else its tgId; None if neither."""
+    user_id = extract_user_id_from_email(client.get('email', ''))
+    if not user_id:
+        tgid = str(client.get('tgId', '')).strip()
+        user_id = int(tgid) if tgid.isdigit() else None
+    return user_id
+
+
+def is_warm_trial(email):
+    """True for an unclaimed trial key from vpn_bot's warm pool."""
+    return str(email or '').startswith(WARM_TRIAL_PREFIX)
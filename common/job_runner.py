@@ -0,0 +1,102 @@
+"""
+Guarded background jobs for the PTB job queue.
+
+The periodic panel jobs (index refresh, trial clean-up, notices) shared the
+event loop with user handlers and had no protection against themselves.
+A slow run could overlap the next one, and CPU-heavy parsing of large
+inbound listings stalled every user for its duration.
+
+JobRunner.wrap() turns a job callback into one that:
+
+* skips a run while the previous run of the same job is still going;
+* is cancelled once it exceeds its time budget;
+* records run count, skips, timeouts, failures and durations for the admin
+  status view.
+
+JobRunner.run_blocking() hands CPU-bound or blocking work (JSON decoding,
+index rebuilds) to a small dedicated thread pool, so the event loop keeps
+serving users while it runs.
+"""
+
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobRunner:
+    """Per-job overlap lock, time budget and run metrics, plus a worker pool."""
+
+    def __init__(self, max_workers=4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._running = set()
+        self._stats = {}
+
+    def _stat(self, name):
+        return self._stats.setdefault(name, {
+            'runs': 0,
+            'skipped': 0,
+            'timeouts': 0,
+            'failures': 0,
+            'last_seconds': None,
+            'avg_seconds': None,
+            'max_seconds': 0.0,
+            'last_started': 0,
+        })
+
+    def wrap(self, fn, budget_seconds, name=None):
+        """Return a job callback running fn(context) with overlap protection and a time budget."""
+        name = name or fn.__name__
+
+        @functools.wraps(fn)
+        async def job(context):
+            stat = self._stat(name)
+            if name in self._running:
+                stat['skipped'] += 1
+                logging.warning(f"⏭ Job {name} skipped: previous run still going")
+                return
+            self._running.add(name)
+            stat['last_started'] = int(time.time())
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(fn(context), budget_seconds)
+            except asyncio.TimeoutError:
+                stat['timeouts'] += 1
+                logging.error(f"⏱ Job {name} cancelled after its {budget_seconds}s budget")
+            except Exception as e:
+                stat['failures'] += 1
+                logging.error(f"Job {name} failed: {e}")
+            finally:
+                self._running.discard(name)
+                elapsed = time.monotonic() - started
+                stat['runs'] += 1
+                stat['last_seconds'] = elapsed
+                stat['avg_seconds'] = elapsed if stat['avg_seconds'] is None else 0.8 * stat['avg_seconds'] + 0.2 * elapsed
+                stat['max_seconds'] = max(stat['max_seconds'], elapsed)
+
+        return job
+
+    async def run_blocking(self, fn, *args):
+        """Run fn(*args) on the job thread pool and await its result."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def snapshot(self):
+        return {name: dict(stat, running=name in self._running) for name, stat in self._stats.items()}
+
+    def describe(self, name):
+        """One-line human summary of a job's metrics."""
+        stat = self._stats.get(name)
+        if not stat or not stat['runs']:
+            return f"{name}: not run yet"
+        parts = [f"{name}: {stat['runs']} runs, last {stat['last_seconds']:.1f}s, "
+                 f"avg {stat['avg_seconds']:.1f}s, max {stat['max_seconds']:.1f}s"]
+        if name in self._running:
+            parts.append("running")
+        for key in ('skipped', 'timeouts', 'failures'):
+            if stat[key]:
+                parts.append(f"{stat[key]} {key}")
+        return ", ".join(parts)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
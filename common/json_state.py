@@ -0,0 +1,80 @@
+"""
+Small JSON state files kept in memory and written behind, atomically.
+
+The bots used to rewrite state files such as server_rotation_state.json and
+notice_state.json synchronously on the request path, with a plain open('w'),
+so a crash mid-write could lose the whole file. JsonState keeps the data in
+memory. Callers mark it dirty and a periodic job calls flush(), which
+replaces the file via temp-file + fsync + rename.
+"""
+
+import copy
+import json
+import logging
+import os
+import tempfile
+
+
+def atomic_write_json(path, data, indent=2):
+    """Write JSON via a temp file + rename so readers never see a partial file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class JsonState:
+    """In-memory dict mirrored to a JSON file by flush()."""
+
+    def __init__(self, path, default=None):
+        self.path = path
+        self._default = default or {}
+        self.data = self._load()
+        self._dirty = False
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                return data
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable state file {self.path}: {e}")
+        return copy.deepcopy(self._default)
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def compact(self, should_drop):
+        """Remove every key for which should_drop(key, value) is true; returns the count."""
+        stale = [k for k, v in self.data.items() if should_drop(k, v)]
+        for key in stale:
+            del self.data[key]
+        if stale:
+            self._dirty = True
+        return len(stale)
+
+    def flush(self):
+        """Write the file if anything changed since the last flush; True if written."""
+        if not self._dirty:
+            return False
+        self._dirty = False
+        try:
+            atomic_write_json(self.path, self.data)
+        except Exception as e:
+            self._dirty = True
+            logging.warning(f"Failed to persist {self.path}: {e}")
+            return False
+        return True
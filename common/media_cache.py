@@ -0,0 +1,92 @@
+"""
+Upload-once cache of Telegram file_ids for the bot's bundled images.
+
+The installation guides re-uploaded the same JPEGs from disk on every tap.
+Telegram returns a file_id for each uploaded photo, and sending that id
+reuses the stored file without another upload. MediaCache remembers the
+file_id per image path in a JsonState, together with the file's size and
+mtime. Replacing an image on disk therefore uploads it again.
+
+file_ids belong to the bot that uploaded them. If Telegram rejects a cached id
+(e.g. after the bot token changes), the album is sent again from disk and the
+new ids replace the old ones.
+"""
+
+import logging
+import os
+
+from telegram import InputMediaPhoto
+from telegram.error import BadRequest
+
+
+class MediaCache:
+    """path -> file_id for local photos, persisted through a JsonState."""
+
+    def __init__(self, state):
+        self.state = state
+
+    @staticmethod
+    def _signature(path):
+        st = os.stat(path)
+        return [st.st_size, int(st.st_mtime)]
+
+    def file_id(self, path):
+        """Cached file_id for path, or None if never uploaded or changed on disk."""
+        entry = self.state.data.get(path)
+        try:
+            if entry and entry.get('signature') == self._signature(path):
+                return entry['file_id']
+        except OSError:
+            pass
+        return None
+
+    def remember(self, path, file_id):
+        self.state.data[path] = {'file_id': file_id, 'signature': self._signature(path)}
+        self.state.mark_dirty()
+
+    def forget(self, paths):
+        for path in paths:
+            self.state.data.pop(path, None)
+        self.state.mark_dirty()
+
+    def _media(self, items, use_cache):
+        media = []
+        for path, caption in items:
+            cached = self.file_id(path) if use_cache else None
+            if cached:
+                photo = cached
+            else:
+                with open(path, 'rb') as f:
+                    photo = f.read()
+            media.append(InputMediaPhoto(photo, caption=caption, parse_mode='HTML'))
+        return media
+
+    async def _send(self, bot, chat_id, items, use_cache):
+        media = self._media(items, use_cache)
+        if len(media) == 1:
+            # Albums need at least two items.
+            return [await bot.send_photo(chat_id=chat_id, photo=media[0].media,
+                                         caption=media[0].caption, parse_mode='HTML')]
+        return list(await bot.send_media_group(chat_id=chat_id, media=media))
+
+    async def send_album(self, bot, chat_id, items):
+        """Send [(path, caption), ...] as one album; missing files are skipped.
+
+        Returns the sent messages (empty if no file exists).
+        """
+        items = [(path, caption) for path, caption in items if os.path.exists(path)]
+        if not items:
+            return []
+        try:
+            messages = await self._send(bot, chat_id, items, use_cache=True)
+        except BadRequest as e:
+            if not any(self.file_id(path) for path, _ in items):
+                raise
+            logging.warning(f"Cached file_id rejected ({e}); uploading the images again")
+            self.forget([path for path, _ in items])
+            messages = await self._send(bot, chat_id, items, use_cache=False)
+
+        for (path, _), message in zip(items, messages):
+            if message.photo:
+                self.remember(path, message.photo[-1].file_id)
+        return messages
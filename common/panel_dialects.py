@@ -0,0 +1,126 @@
+"""
+Per-panel X-UI API dialect cache shared by vpn_bot and admin_bot.
+
+3x-ui / x-ui forks expose the same operations under different route families
+(panel/api/inbounds, xui/API/inbound, ...) and some only accept form bodies.
+Each bot probes the candidates for an operation once, then remembers the URL
+template and body encoding that worked, in memory and in panel_dialects.json
+next to config.json. Later calls go straight to the remembered route. It is
+forgotten, and probed for again, only when the panel says the route does not
+exist. 3x-ui also answers 404 to /panel/api/* calls from an expired session,
+so a 404 on the remembered route is retried once after logging in again
+before the route is given up.
+
+Both bots write the same file. Each change is made under panel_dialects.json.lock
+against a fresh read of the file, and only the one panel/op entry is
+touched, so neither bot erases routes the other has learned since it started.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from common.config_store import _locked
+from common.json_state import atomic_write_json
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'panel_dialects.json')
+
+# Statuses that mean "no such route" rather than "route exists but said no".
+ROUTE_MISSING_STATUSES = (404, 405)
+
+
+def route_missing(body, status):
+    """True when a response shows the route itself is wrong for this panel."""
+    if status in ROUTE_MISSING_STATUSES:
+        return True
+    # Some panels serve their HTML shell with 200 for unknown paths.
+    return status == 200 and body is None
+
+
+class PanelDialects:
+    """Remembered (url_template, encoding) per panel and operation."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+                return data if isinstance(data, dict) else {}
+        except Exception:
+            return {}
+
+    def _save(self, panel, op, entry):
+        """Merge one panel/op change (entry None = forget) into the file and reload from it."""
+        try:
+            with _locked(self.path + '.lock'):
+                data = self._load()
+                if entry is None:
+                    data.get(panel, {}).pop(op, None)
+                else:
+                    data.setdefault(panel, {})[op] = entry
+                atomic_write_json(self.path, data)
+            self._data = data
+        except Exception as e:
+            logging.warning(f"Failed to persist panel dialects: {e}")
+
+    def get(self, panel, op):
+        with self._lock:
+            entry = self._data.get(panel, {}).get(op)
+        if not isinstance(entry, dict) or not entry.get('template'):
+            return None
+        return entry['template'], entry.get('encoding', 'json')
+
+    def remember(self, panel, op, template, encoding='json'):
+        entry = {'template': template, 'encoding': encoding}
+        with self._lock:
+            if self._data.get(panel, {}).get(op) == entry:
+                return
+            self._data.setdefault(panel, {})[op] = entry
+            self._save(panel, op, entry)
+        logging.info(f"Panel {panel}: using {template} [{encoding}] for '{op}'")
+
+    def forget(self, panel, op):
+        with self._lock:
+            if self._data.get(panel, {}).pop(op, None) is None:
+                return
+            self._save(panel, op, None)
+        logging.info(f"Panel {panel}: remembered route for '{op}' stopped working; re-detecting")
+
+
+async def call_with_dialect(dialects, panel, op, templates, send, accept, encodings=('json',), relogin=None):
+    """Run one panel operation through the remembered route, probing only when needed.
+
+    `templates` are candidate URLs that may contain `{inbound_id}`-style fields
+    already handled by `send`. `send(template, encoding)` must return
+    (body, http_status). `accept(body)` decides whether the call succeeded.
+    `relogin()`, if given, refreshes the panel session before the remembered
+    route is retried. Returns the accepted body, or None.
+    """
+    cached = dialects.get(panel, op)
+    if cached:
+        body, status = await send(*cached)
+        if route_missing(body, status) and relogin is not None:
+            # Possibly just an expired session; try the same route once more.
+            await relogin()
+            body, status = await send(*cached)
+        if accept(body):
+            return body
+        if not route_missing(body, status):
+            # The route answered; the failure (auth, duplicate, ...) is not a dialect problem.
+            return None
+        dialects.forget(panel, op)
+
+    for template in templates:
+        for encoding in encodings:
+            if cached and (template, encoding) == cached:
+                continue
+            body, status = await send(template, encoding)
+            if accept(body):
+                dialects.remember(panel, op, template, encoding)
+                return body
+    return None
@@ -0,0 +1,148 @@
+"""
+Per-panel circuit breaker shared by vpn_bot and admin_bot.
+
+Every X-UI request goes through guarded_request(), which reports the outcome
+here. After FAILURE_THRESHOLD consecutive transport failures (timeouts,
+refused connections, 5xx) a panel's circuit opens and further requests fail
+immediately instead of waiting out the timeout. Once the cooldown passes, one
+request is let through (half-open). If it succeeds the circuit closes. If it
+fails the circuit re-opens with a longer cooldown.
+"""
+
+import logging
+import threading
+import time
+
+import httpx
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+FAILURE_THRESHOLD = 3
+COOLDOWN_SECONDS = 30
+MAX_COOLDOWN_SECONDS = 10 * 60
+# A half-open probe that never reports back (e.g. its task was cancelled)
+# stops blocking other requests after this long.
+PROBE_TIMEOUT_SECONDS = 30
+
+
+class PanelUnavailable(Exception):
+    """Raised instead of sending a request to a panel whose circuit is open."""
+
+
+class PanelHealth:
+    """Closed / open / half-open state per panel, fed by real request outcomes."""
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, cooldown_seconds=COOLDOWN_SECONDS,
+                 max_cooldown_seconds=MAX_COOLDOWN_SECONDS, probe_timeout_seconds=PROBE_TIMEOUT_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self.probe_timeout_seconds = probe_timeout_seconds
+        self._lock = threading.Lock()
+        self._panels = {}
+
+    def _panel(self, panel):
+        return self._panels.setdefault(panel, {
+            'state': CLOSED,
+            'failures': 0,
+            'cooldown': self.cooldown_seconds,
+            'opened_at': 0.0,
+            'probe_started': 0.0,
+            'last_error': '',
+            'last_success': 0.0,
+        })
+
+    def allow(self, panel):
+        """True if a request to `panel` may be sent now."""
+        now = time.monotonic()
+        with self._lock:
+            p = self._panel(panel)
+            if p['state'] == CLOSED:
+                return True
+            if p['state'] == OPEN:
+                if now - p['opened_at'] < p['cooldown']:
+                    return False
+                p['state'] = HALF_OPEN
+                p['probe_started'] = now
+                logging.info(f"Panel {panel}: circuit half-open, probing")
+                return True
+            # Half-open: one probe at a time.
+            if now - p['probe_started'] >= self.probe_timeout_seconds:
+                p['probe_started'] = now
+                return True
+            return False
+
+    def is_open(self, panel):
+        """True while requests to `panel` would be refused (does not claim the probe)."""
+        now = time.monotonic()
+        with self._lock:
+            p = self._panels.get(panel)
+            if not p or p['state'] == CLOSED:
+                return False
+            if p['state'] == OPEN:
+                return now - p['opened_at'] < p['cooldown']
+            return now - p['probe_started'] < self.probe_timeout_seconds
+
+    def record_success(self, panel):
+        with self._lock:
+            p = self._panel(panel)
+            if p['state'] != CLOSED:
+                logging.info(f"Panel {panel}: circuit closed")
+            p.update(state=CLOSED, failures=0, cooldown=self.cooldown_seconds, last_success=time.time())
+
+    def record_failure(self, panel, error=''):
+        with self._lock:
+            p = self._panel(panel)
+            p['failures'] += 1
+            p['last_error'] = str(error)[:200]
+            if p['state'] == HALF_OPEN:
+                p['cooldown'] = min(p['cooldown'] * 2, self.max_cooldown_seconds)
+            elif p['state'] == OPEN or p['failures'] < self.failure_threshold:
+                return
+            p['state'] = OPEN
+            p['opened_at'] = time.monotonic()
+            cooldown = p['cooldown']
+        logging.warning(f"Panel {panel}: circuit open for {cooldown}s after {error}")
+
+    def snapshot(self, panel):
+        """Return a copy of the panel's state plus `retry_in` seconds while open."""
+        now = time.monotonic()
+        with self._lock:
+            p = dict(self._panel(panel))
+        p['retry_in'] = max(0, int(p['opened_at'] + p['cooldown'] - now)) if p['state'] == OPEN else 0
+        return p
+
+    def describe(self, panel):
+        """Short human-readable state for admin status views."""
+        p = self.snapshot(panel)
+        if p['state'] == CLOSED:
+            return "circuit closed"
+        if p['state'] == HALF_OPEN:
+            return "circuit half-open (probing)"
+        detail = f"circuit open, retry in {p['retry_in']}s, {p['failures']} failures"
+        if p['last_error']:
+            detail += f": {p['last_error'][:80]}"
+        return detail
+
+
+async def guarded_request(health, panel, http, method, url, **kwargs):
+    """Send one httpx request through `health`'s circuit for `panel`.
+
+    Raises PanelUnavailable without touching the network while the circuit is
+    open. Transport errors and 5xx responses count as failures. Any other
+    response, including 4xx and panel-level rejections, counts as success.
+    """
+    if not health.allow(panel):
+        raise PanelUnavailable(f"{panel} is unavailable ({health.describe(panel)})")
+    try:
+        r = await http.request(method, url, **kwargs)
+    except httpx.TransportError as e:
+        health.record_failure(panel, str(e) or type(e).__name__)
+        raise
+    if r.status_code >= 500:
+        health.record_failure(panel, f"HTTP {r.status_code}")
+    else:
+        health.record_success(panel)
+    return r
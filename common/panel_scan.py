@@ -0,0 +1,164 @@
+"""
+One-pass, parallel scanning of X-UI panels into flat client records.
+
+vpn_bot's client index and admin_bot's inactive-user report each walked the
+panels and decoded inbound settings in their own way, server by server.
+This module provides the shared pieces:
+
+* inbound_records() parses an inbound once (settings JSON plus clientStats)
+  into one record per client.
+* scan_servers() fetches every panel concurrently, with a bound, and
+  returns all records plus the servers that failed.
+* classify() runs several named predicates over the same records, e.g.
+  is_expired, is_disabled, is_unused, inactive_for(...), expiring_within(...),
+  low_data(...).
+
+Record fields: server_name, inbound_id, uuid, email, user_id, enable,
+total, expiry (ms), up, down, last_online (ms, 0 if unknown).
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+from common.customers import client_user_id
+
+DEFAULT_CONCURRENCY = 8
+
+
+def normalize_last_online_ms(raw_value):
+    """Normalize last-online timestamp to milliseconds if present."""
+    try:
+        value = int(raw_value or 0)
+    except Exception:
+        return 0
+    if value <= 0:
+        return 0
+    # Heuristic: values smaller than 10^12 are very likely seconds.
+    if value < 10**12:
+        return value * 1000
+    return value
+
+
+def client_record(server_name, inbound_id, client, stat=None):
+    """Flatten one panel client (plus its clientStats row, if any) into a record."""
+    stat = stat or {}
+    return {
+        'server_name': server_name,
+        'inbound_id': inbound_id,
+        'uuid': str(client.get('id', '') or ''),
+        'email': str(client.get('email', '') or ''),
+        'user_id': client_user_id(client),
+        'enable': bool(client.get('enable', True)),
+        'total': int(client.get('totalGB', 0) or 0),
+        'expiry': int(client.get('expiryTime', 0) or 0),
+        'up': int(stat.get('up', client.get('up', 0)) or 0),
+        'down': int(stat.get('down', client.get('down', 0)) or 0),
+        'last_online': normalize_last_online_ms(stat.get('lastOnline') or client.get('lastOnline')),
+    }
+
+
+def inbound_records(server_name, inbound):
+    """All client records of one inbound; its settings JSON is decoded exactly once."""
+    raw = inbound.get('settings', '{}')
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            raw = {}
+    clients = raw.get('clients', []) if isinstance(raw, dict) else []
+    stats_by_email = {s['email']: s for s in inbound.get('clientStats') or [] if s.get('email')}
+    return [client_record(server_name, inbound.get('id'), c, stats_by_email.get(c.get('email')))
+            for c in clients]
+
+
+async def gather_bounded(items, fn, concurrency=DEFAULT_CONCURRENCY):
+    """await fn(item) for every item, at most `concurrency` at once; results in order.
+
+    Exceptions are returned in place of results, as with return_exceptions=True.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(item):
+        async with semaphore:
+            return await fn(item)
+
+    return await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
+
+
+async def scan_servers(servers, fetch, concurrency=DEFAULT_CONCURRENCY):
+    """Fetch every server in parallel and flatten the result.
+
+    `fetch(server)` returns a list of inbound objects, or None on failure.
+    Returns (records, failed_server_names).
+    """
+    results = await gather_bounded(servers, fetch, concurrency)
+    records, failed = [], []
+    for server, inbounds in zip(servers, results):
+        name = server.get('name', 'Unknown')
+        if isinstance(inbounds, Exception) or inbounds is None:
+            if isinstance(inbounds, Exception):
+                logging.warning(f"Panel scan failed on {name}: {inbounds}")
+            failed.append(name)
+            continue
+        for inbound in inbounds:
+            records.extend(inbound_records(name, inbound))
+    return records, failed
+
+
+def classify(records, classifiers):
+    """{name: [records matching classifiers[name]]}, in one pass over the records."""
+    matches = {name: [] for name in classifiers}
+    for record in records:
+        for name, predicate in classifiers.items():
+            if predicate(record):
+                matches[name].append(record)
+    return matches
+
+
+def used_bytes(record):
+    return record['up'] + record['down']
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def is_expired(record):
+    return 0 < record['expiry'] <= _now_ms()
+
+
+def is_disabled(record):
+    return not record['enable']
+
+
+def is_unused(record):
+    return used_bytes(record) == 0
+
+
+def inactive_for(seconds):
+    """Expired, or last seen online, at least `seconds` ago."""
+    window_ms = seconds * 1000
+
+    def predicate(record):
+        now_ms = _now_ms()
+        expired_long_ago = record['expiry'] > 0 and now_ms - record['expiry'] >= window_ms
+        offline_long = record['last_online'] > 0 and now_ms - record['last_online'] >= window_ms
+        return expired_long_ago or offline_long
+    return predicate
+
+
+def expiring_within(seconds):
+    """Not yet expired, but expiring within `seconds`."""
+    def predicate(record):
+        left = record['expiry'] / 1000 - time.time()
+        return record['expiry'] > 0 and 0 < left <= seconds
+    return predicate
+
+
+def low_data(threshold_bytes):
+    """Has a quota and at most `threshold_bytes` of it left."""
+    def predicate(record):
+        return record['total'] > 0 and record['total'] - used_bytes(record) <= threshold_bytes
+    return predicate
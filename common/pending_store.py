@@ -0,0 +1,170 @@
+"""
+Durable pending payments and conversation state for vpn_bot.
+
+Pending purchases and renewals used to live only in bot_data, so a restart
+between the customer's slip and the admin's approval lost them. Per-user
+conversation state in user_data was lost the same way. Both now live in a
+small SQLite database (WAL):
+
+* PendingStore writes one row per (kind, user) as soon as it changes.
+* SqliteUserDataPersistence is a python-telegram-bot persistence backend for
+  user_data only. PTB hands it just the users whose data changed, so each
+  write touches one row instead of pickling everything.
+
+Rows older than the configured TTL are abandoned sessions and are purged.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DB_PATH = os.path.join(REPO_DIR, 'vpn_bot', 'pending.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending (
+    kind       TEXT NOT NULL,
+    user_id    TEXT NOT NULL,
+    payload    TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    PRIMARY KEY (kind, user_id)
+);
+CREATE INDEX IF NOT EXISTS pending_age ON pending (created_at);
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id    INTEGER PRIMARY KEY,
+    data       TEXT NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS user_data_age ON user_data (updated_at);
+"""
+
+
+class PendingStore:
+    """Pending purchase/renewal plans keyed by (kind, user_id), plus persisted user_data rows."""
+
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+
+    def put(self, kind, user_id, payload):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO pending VALUES (?, ?, ?, ?)',
+                (kind, str(user_id), json.dumps(payload), int(time.time())),
+            )
+
+    def get(self, kind, user_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT payload FROM pending WHERE kind = ? AND user_id = ?', (kind, str(user_id))
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def pop(self, kind, user_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT payload FROM pending WHERE kind = ? AND user_id = ?', (kind, str(user_id))
+            ).fetchone()
+            if row:
+                self._db.execute('DELETE FROM pending WHERE kind = ? AND user_id = ?', (kind, str(user_id)))
+        return json.loads(row[0]) if row else None
+
+    def purge_pending(self, older_than_ts):
+        with self._lock:
+            return self._db.execute('DELETE FROM pending WHERE created_at < ?', (int(older_than_ts),)).rowcount
+
+    def load_user_data(self, newer_than_ts=0):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT user_id, data FROM user_data WHERE updated_at >= ?', (int(newer_than_ts),)
+            ).fetchall()
+        return {int(user_id): json.loads(data) for user_id, data in rows}
+
+    def save_user_data(self, user_id, data):
+        with self._lock:
+            if data:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO user_data VALUES (?, ?, ?)',
+                    (int(user_id), json.dumps(data, default=str), int(time.time())),
+                )
+            else:
+                self._db.execute('DELETE FROM user_data WHERE user_id = ?', (int(user_id),))
+
+    def delete_user_data(self, user_id):
+        self.save_user_data(user_id, None)
+
+    def stale_user_ids(self, older_than_ts):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT user_id FROM user_data WHERE updated_at < ?', (int(older_than_ts),)
+            ).fetchall()
+        return [int(r[0]) for r in rows]
+
+
+class SqliteUserDataPersistence(BasePersistence):
+    """PTB persistence for user_data only, one SQLite row per user."""
+
+    def __init__(self, store, ttl_seconds, update_interval=10):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+
+    async def get_user_data(self):
+        # Sessions abandoned longer than the TTL are not brought back.
+        return self.store.load_user_data(newer_than_ts=time.time() - self.ttl_seconds)
+
+    async def update_user_data(self, user_id, data):
+        self.store.save_user_data(user_id, data)
+
+    async def drop_user_data(self, user_id):
+        self.store.delete_user_data(user_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def flush(self):
+        pass
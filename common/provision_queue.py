@@ -0,0 +1,248 @@
+"""
+Durable queue for premium key approvals and renewals.
+
+approval_handler used to create the key inside the admin's callback. Two
+admins approving the same slip, or one admin tapping twice, could each issue
+a Premium_<id>_xxxx client. An approval burst also hit the panels with
+unbounded parallel add_client calls.
+
+Now each approval becomes one job row in vpn_bot/provision.db, keyed by
+kind, user and slip:
+
+* enqueue() inserts a job at most once per key. A second tap finds the job
+  that already exists and creates nothing.
+* ProvisionWorkers runs at most `concurrency` jobs at a time. A failed job is
+  retried with exponential backoff until max_attempts, then marked failed.
+* Jobs that were running during a crash are queued again on start. A job's
+  payload carries its client email, so the handler can recognise a client an
+  earlier attempt already created.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DB_PATH = os.path.join(REPO_DIR, 'vpn_bot', 'provision.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_key    TEXT PRIMARY KEY,
+    kind       TEXT NOT NULL,
+    user_id    INTEGER NOT NULL,
+    payload    TEXT NOT NULL,
+    status     TEXT NOT NULL DEFAULT 'queued',
+    attempts   INTEGER NOT NULL DEFAULT 0,
+    next_at    INTEGER NOT NULL,
+    result     TEXT NOT NULL DEFAULT '{}',
+    error      TEXT NOT NULL DEFAULT '',
+    chat_id    INTEGER,
+    message_id INTEGER,
+    created_at INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, next_at);
+"""
+
+JOB_COLUMNS = ('job_key', 'kind', 'user_id', 'payload', 'status', 'attempts', 'next_at',
+               'result', 'error', 'chat_id', 'message_id', 'created_at', 'updated_at')
+
+
+def _row_to_job(row):
+    job = dict(zip(JOB_COLUMNS, row))
+    job['payload'] = json.loads(job['payload'])
+    job['result'] = json.loads(job['result'])
+    return job
+
+
+class ProvisionQueue:
+    """Approval/renewal jobs with their status ('queued', 'running', 'done', 'failed')."""
+
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+
+    def _select(self, where, args):
+        return self._db.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE {where}', args).fetchall()
+
+    def enqueue(self, job_key, kind, user_id, payload, chat_id=None, message_id=None):
+        """Queue a job unless job_key exists; returns (job, created)."""
+        now = int(time.time())
+        with self._lock:
+            cur = self._db.execute(
+                'INSERT OR IGNORE INTO jobs (job_key, kind, user_id, payload, next_at, chat_id, message_id, '
+                'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_key, kind, int(user_id), json.dumps(payload), now, chat_id, message_id, now, now),
+            )
+            row = self._select('job_key = ?', (job_key,))[0]
+        return _row_to_job(row), cur.rowcount > 0
+
+    def get(self, job_key):
+        with self._lock:
+            rows = self._select('job_key = ?', (job_key,))
+        return _row_to_job(rows[0]) if rows else None
+
+    def claim_due(self, limit, now=None):
+        """Mark up to `limit` due queued jobs running and return them, oldest first."""
+        now = int(now if now is not None else time.time())
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._select("status = 'queued' AND next_at <= ? ORDER BY next_at LIMIT ?", (now, int(limit)))
+                self._db.executemany(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE job_key = ?",
+                    ((now, r[0]) for r in rows),
+                )
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        jobs = [_row_to_job(r) for r in rows]
+        for job in jobs:
+            job['status'] = 'running'
+            job['attempts'] += 1
+        return jobs
+
+    def update_payload(self, job_key, **fields):
+        """Merge fields into a job's payload (progress a retry must see)."""
+        with self._lock:
+            rows = self._select('job_key = ?', (job_key,))
+            if not rows:
+                return
+            payload = json.loads(rows[0][JOB_COLUMNS.index('payload')])
+            payload.update(fields)
+            self._db.execute('UPDATE jobs SET payload = ?, updated_at = ? WHERE job_key = ?',
+                             (json.dumps(payload), int(time.time()), job_key))
+
+    def complete(self, job_key, result):
+        self._set(job_key, 'done', result=json.dumps(result or {}), error='')
+
+    def retry(self, job_key, error, next_at):
+        self._set(job_key, 'queued', error=str(error)[:500], next_at=int(next_at))
+
+    def fail(self, job_key, error):
+        self._set(job_key, 'failed', error=str(error)[:500])
+
+    def _set(self, job_key, status, **fields):
+        fields.update(status=status, updated_at=int(time.time()))
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        with self._lock:
+            self._db.execute(f'UPDATE jobs SET {assignments} WHERE job_key = ?', (*fields.values(), job_key))
+
+    def requeue_running(self):
+        """After a restart, queue again the jobs that were running when the process died."""
+        with self._lock:
+            return self._db.execute(
+                "UPDATE jobs SET status = 'queued', next_at = ?, updated_at = ? WHERE status = 'running'",
+                (int(time.time()), int(time.time())),
+            ).rowcount
+
+    def counts(self):
+        counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+        with self._lock:
+            counts.update(dict(self._db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()))
+        return counts
+
+    def purge_finished(self, older_than_ts):
+        with self._lock:
+            return self._db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (int(older_than_ts),)
+            ).rowcount
+
+
+class ProvisionWorkers:
+    """Runs due jobs from a ProvisionQueue, `concurrency` at a time, with retries.
+
+    handle(job) does the work and returns a result dict; raising schedules a
+    retry. on_finish(job) runs once the job is done or has failed for good,
+    with job['status'], job['result'] and job['error'] filled in.
+    """
+
+    POLL_SECONDS = 5
+
+    def __init__(self, queue, concurrency=3, max_attempts=5, base_delay=30, max_delay=15 * 60):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._wake = None
+        self._loop_task = None
+        self._running = set()
+
+    def start(self, handle, on_finish):
+        self._handle = handle
+        self._on_finish = on_finish
+        self._wake = asyncio.Event()
+        requeued = self.queue.requeue_running()
+        if requeued:
+            logging.warning(f"Re-queued {requeued} provisioning job(s) interrupted by a restart")
+        self._loop_task = asyncio.ensure_future(self._loop())
+
+    def kick(self):
+        """Look for due jobs now instead of at the next poll."""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _loop(self):
+        while True:
+            self._wake.clear()
+            free = self.concurrency - len(self._running)
+            try:
+                jobs = self.queue.claim_due(free) if free > 0 else []
+            except Exception as e:
+                # e.g. "database is locked" while the other bot writes; try again next poll.
+                logging.error(f"Claiming provisioning jobs failed: {e}")
+                jobs = []
+            for job in jobs:
+                task = asyncio.ensure_future(self._run(job))
+                self._running.add(task)
+                task.add_done_callback(self._job_done)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def _job_done(self, task):
+        self._running.discard(task)
+        self.kick()
+
+    async def _run(self, job):
+        key = job['job_key']
+        try:
+            result = await self._handle(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if job['attempts'] < self.max_attempts:
+                delay = min(self.base_delay * 2 ** (job['attempts'] - 1), self.max_delay)
+                logging.warning(f"Provisioning job {key} attempt {job['attempts']} failed: {e}; retrying in {delay}s")
+                self.queue.retry(key, e, time.time() + delay)
+                return
+            logging.error(f"Provisioning job {key} failed after {job['attempts']} attempts: {e}")
+            self.queue.fail(key, e)
+            job.update(status='failed', error=str(e))
+        else:
+            self.queue.complete(key, result)
+            job.update(status='done', result=result or {})
+        try:
+            await self._on_finish(job)
+        except Exception as e:
+            logging.error(f"Provisioning job {key} finish hook failed: {e}")
+
+    async def close(self):
+        """Stop taking jobs; jobs cut short are re-queued on the next start."""
+        tasks = [t for t in (self._loop_task, *self._running) if t]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop_task = None
+        self._running = set()
@@ -0,0 +1,80 @@
+"""
+Polling or webhook serving for the bots, chosen in config.json.
+
+By default a bot long-polls getUpdates as before. Two pollers on one token,
+e.g. during a blue/green restart, make Telegram answer one of them with a 409
+Conflict. If config.json has a "webhook" entry for the bot, Telegram instead
+pushes each update to PTB's built-in async HTTP listener:
+
+    "webhook": {
+        "vpn_bot": {
+            "url": "https://bot.example.com/vpn_bot",
+            "listen": "127.0.0.1",
+            "port": 8081,
+            "secret_token": "long-random-string",
+            "max_connections": 40
+        },
+        "admin_bot": { ... }
+    }
+
+Behind a local reverse proxy (nginx, Caddy) that terminates TLS, listen on
+127.0.0.1 and forward the public path of "url" to that port. Without a
+proxy, set "cert" and "key" to the certificate files and listen publicly on
+port 443, 80, 88 or 8443.
+
+Telegram sends secret_token back in the X-Telegram-Bot-Api-Secret-Token
+header. The listener rejects any request without it. Set "enabled": false to
+go back to polling without deleting the entry.
+"""
+
+import logging
+import re
+from urllib.parse import urlparse
+
+DEFAULT_LISTEN = '127.0.0.1'
+DEFAULT_PORT = 8443
+DEFAULT_MAX_CONNECTIONS = 40
+
+_SECRET_TOKEN = re.compile(r'^[A-Za-z0-9_-]{1,256}$')
+
+
+def webhook_options(settings):
+    """run_webhook() keyword arguments for one bot's "webhook" entry; raises ValueError if invalid."""
+    url = str(settings.get('url', '') or '')
+    parsed = urlparse(url)
+    if parsed.scheme != 'https' or not parsed.netloc:
+        raise ValueError(f"webhook url must be an https:// URL, got {url!r}")
+
+    secret_token = str(settings.get('secret_token', '') or '')
+    if not _SECRET_TOKEN.match(secret_token):
+        raise ValueError("webhook secret_token is required: 1-256 characters of A-Z, a-z, 0-9, _ or -")
+
+    max_connections = int(settings.get('max_connections', DEFAULT_MAX_CONNECTIONS))
+    if not 1 <= max_connections <= 100:
+        raise ValueError(f"webhook max_connections must be 1-100, got {max_connections}")
+
+    return {
+        'listen': settings.get('listen', DEFAULT_LISTEN),
+        'port': int(settings.get('port', DEFAULT_PORT)),
+        # The proxy forwards the public path unchanged unless told otherwise.
+        'url_path': str(settings.get('url_path', parsed.path)).strip('/'),
+        'webhook_url': url,
+        'secret_token': secret_token,
+        'max_connections': max_connections,
+        'cert': settings.get('cert'),
+        'key': settings.get('key'),
+    }
+
+
+def run(app, config, name):
+    """Serve `app` by webhook if config['webhook'][name] is set and enabled, else by polling."""
+    settings = (config.get('webhook') or {}).get(name)
+    if not settings or not settings.get('enabled', True):
+        logging.info(f"Serving {name} by long polling")
+        app.run_polling()
+        return
+
+    options = webhook_options(settings)
+    logging.info(f"Serving {name} by webhook at {options['webhook_url']} "
+                 f"(listening on {options['listen']}:{options['port']}/{options['url_path']})")
+    app.run_webhook(**options)
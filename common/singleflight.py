@@ -0,0 +1,61 @@
+"""
+Request coalescing for X-UI panel reads.
+
+During bursts many handlers ask the same panel for the same inbound list at
+once. SingleFlight lets concurrent callers with the same key share one
+in-flight request. A good result is also reused for a short freshness
+window. Any write to the panel calls invalidate(), so callers never see data
+older than their own changes.
+"""
+
+import asyncio
+import time
+
+
+class SingleFlight:
+    """One in-flight call per key, shared by all concurrent callers."""
+
+    def __init__(self, ttl=2.0):
+        self.ttl = ttl
+        self._inflight = {}   # key -> asyncio.Task
+        self._fresh = {}      # key -> (stored_at, result)
+        self._generation = 0
+
+    async def do(self, key, fn, cacheable=lambda result: True):
+        """Return fn()'s result, sharing it with callers asking for `key` concurrently.
+
+        Results for which `cacheable(result)` is false (errors, rejections) are
+        handed to the callers already waiting but not kept afterwards. All
+        callers get the same object: treat it as read-only and copy whatever
+        part of it you need to change.
+        """
+        hit = self._fresh.get(key)
+        if hit and time.monotonic() - hit[0] < self.ttl:
+            return hit[1]
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(key, fn, cacheable, self._generation))
+            # Mark the exception retrieved even if every waiter was cancelled.
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        # shield(): a cancelled caller must not cancel the request others wait on.
+        return await asyncio.shield(task)
+
+    async def _run(self, key, fn, cacheable, generation):
+        try:
+            result = await fn()
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                del self._inflight[key]
+        # A write that happened while we were in flight makes this result stale.
+        if generation == self._generation and cacheable(result):
+            self._fresh[key] = (time.monotonic(), result)
+        return result
+
+    def invalidate(self):
+        """Drop remembered results; call after every write to the panel."""
+        self._generation += 1
+        self._fresh.clear()
+        # Later callers must not join reads that started before the write.
+        self._inflight.clear()
@@ -0,0 +1,165 @@
+"""
+Rate-limited, prioritised outbound queue for Telegram sends.
+
+Background jobs (expiry notices, trial clean-up) and the admin slip fan-out
+used to await bot.send_* one message at a time, with no flood control. A 429
+was logged and the message was lost.
+
+Dispatcher runs a pool of workers over one priority queue:
+
+* Global limit: a token bucket, by default 25 msgs/s against Telegram's ~30.
+* Per-chat limit: at least `per_chat_interval` seconds between two sends to
+  the same chat. Messages to one chat still go out in the order they were
+  queued, so a key always precedes its instructions.
+* RetryAfter pauses every worker for the time Telegram asks and then
+  retries. Network errors are retried with backoff. Forbidden and BadRequest
+  (blocked bot, deleted chat) fail at once.
+* Lower priority numbers go first, so key delivery overtakes a notice run
+  that is already queued.
+
+Workers start on first use inside the running event loop. close() lets the
+queue drain on shutdown.
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+PRIORITY_KEY = 0      # keys, approvals, anything the customer is waiting for
+PRIORITY_ADMIN = 1    # payment slips and alerts for admins
+PRIORITY_NOTICE = 2   # reminders and other bulk notifications
+
+
+class Dispatcher:
+    """Priority send queue honouring Telegram's global and per-chat limits."""
+
+    def __init__(self, rate_per_second=25, per_chat_interval=1.0, workers=16, max_attempts=5):
+        self.rate = float(rate_per_second)
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._queue = None
+        self._tasks = []
+        self._seq = itertools.count()
+        self._tokens = self.rate
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_locks = {}     # chat_id -> [asyncio.Lock, users] (keeps per-chat order)
+        self._chat_next = {}      # chat_id -> earliest monotonic time for the next send
+        self.sent = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, call, chat_id, priority=PRIORITY_NOTICE, **kwargs):
+        """Queue call(chat_id=chat_id, **kwargs); returns a Future with its result.
+
+        `call` is a bound bot method such as context.bot.send_message.
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._seq), call, chat_id, kwargs, future))
+        return future
+
+    async def send(self, call, chat_id, priority=PRIORITY_KEY, **kwargs):
+        """Queue a send and wait for it; raises what the final attempt raised."""
+        return await self.submit(call, chat_id, priority, **kwargs)
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.rate, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def _worker(self):
+        while True:
+            priority, _, call, chat_id, kwargs, future = await self._queue.get()
+            # Acquire the chat lock before any other await so same-chat sends keep queue order.
+            entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    if not future.done():
+                        await self._deliver(call, chat_id, kwargs, future)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    self._chat_locks.pop(chat_id, None)
+                self._queue.task_done()
+
+    async def _deliver(self, call, chat_id, kwargs, future):
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            wait = self._chat_next.get(chat_id, 0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._take_token()
+            try:
+                result = await call(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                error = e
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+                logging.warning(f"Telegram flood limit hit sending to {chat_id}; pausing all sends for {delay:.0f}s")
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                continue
+            except (Forbidden, BadRequest) as e:
+                self._finish(chat_id, future, error=e)
+                return
+            except NetworkError as e:
+                error = e
+                if attempt < self.max_attempts:
+                    await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+            except Exception as e:
+                self._finish(chat_id, future, error=e)
+                return
+            self._finish(chat_id, future, result=result)
+            return
+        logging.warning(f"Giving up on message to {chat_id} after {self.max_attempts} attempts: {error}")
+        self._finish(chat_id, future, error=error)
+
+    def _finish(self, chat_id, future, result=None, error=None):
+        self._chat_next[chat_id] = time.monotonic() + self.per_chat_interval
+        if len(self._chat_next) > 10000:
+            now = time.monotonic()
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+        if error is None:
+            self.sent += 1
+            if not future.done():
+                future.set_result(result)
+        else:
+            self.failed += 1
+            if not future.done():
+                future.set_exception(error)
+                # Fire-and-forget callers never read it; don't log "exception never retrieved".
+                future.exception()
+
+    async def close(self, timeout=30):
+        """Give queued sends up to `timeout` seconds to go out, then stop the workers."""
+        if self._queue is not None and self._tasks:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Dispatcher closed with {self._queue.qsize()} message(s) unsent")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,171 @@
+"""
+SQLite-backed trial tracking shared by vpn_bot and the dashboard.
+
+Replaces vpn_bot/claimed_users.json. That file was loaded and rewritten whole
+on every trial request and read unlocked by the dashboard. The database runs
+in WAL mode, so the dashboard can read while the bot writes. Lookups by user
+and by age use indexes.
+
+On first open, an existing claimed_users.json is imported, including its
+legacy {user_id: link} string format. The file is then renamed to
+claimed_users.json.migrated.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DB_PATH = os.path.join(REPO_DIR, 'vpn_bot', 'trials.db')
+LEGACY_JSON_PATH = os.path.join(REPO_DIR, 'vpn_bot', 'claimed_users.json')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (
+    user_id     TEXT PRIMARY KEY,
+    link        TEXT NOT NULL DEFAULT '',
+    email       TEXT NOT NULL DEFAULT '',
+    server_name TEXT NOT NULL DEFAULT '',
+    trial_type  TEXT NOT NULL DEFAULT 'free',
+    timestamp   INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trials_type_age ON trials (trial_type, timestamp);
+CREATE INDEX IF NOT EXISTS trials_age ON trials (timestamp);
+CREATE INDEX IF NOT EXISTS trials_email ON trials (email);
+"""
+
+COLUMNS = ('user_id', 'link', 'email', 'server_name', 'trial_type', 'timestamp')
+
+
+def _row_to_dict(row):
+    return dict(zip(COLUMNS, row)) if row else None
+
+
+class TrialStore:
+    """Small repository API over the trials table."""
+
+    def __init__(self, path=DEFAULT_DB_PATH, legacy_json_path=LEGACY_JSON_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        if legacy_json_path and os.path.exists(legacy_json_path):
+            self.migrate_from_json(legacy_json_path)
+
+    def migrate_from_json(self, json_path):
+        """Import a claimed_users.json file once, then rename it out of the way."""
+        try:
+            with open(json_path, 'r') as f:
+                data = json.load(f)
+        except Exception as e:
+            logging.error(f"Trial tracking migration skipped, cannot read {json_path}: {e}")
+            return 0
+
+        now = int(time.time())
+        rows = []
+        for user_id, value in (data or {}).items():
+            if isinstance(value, str):
+                # Legacy format: {user_id: link}; assume "now" like the old loader did.
+                value = {"link": value, "timestamp": now, "trial_type": "free",
+                         "email": f"FreeTrial_{user_id}", "server_name": "Unknown"}
+            if not isinstance(value, dict):
+                continue
+            rows.append((
+                str(user_id),
+                str(value.get('link', '') or ''),
+                str(value.get('email', '') or ''),
+                str(value.get('server_name', '') or ''),
+                str(value.get('trial_type', 'free') or 'free'),
+                int(value.get('timestamp', now) or now),
+            ))
+
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                # Rows already in the database win; the JSON is older.
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO trials VALUES (?, ?, ?, ?, ?, ?)', rows
+                )
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        try:
+            os.replace(json_path, json_path + '.migrated')
+        except FileNotFoundError:
+            pass  # another process (bot or dashboard) migrated it at the same time
+        logging.info(f"Migrated {len(rows)} trial tracking entries from {json_path} into {self.path}")
+        return len(rows)
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._db.execute(
+                f'SELECT {", ".join(COLUMNS)} FROM trials WHERE user_id = ?', (str(user_id),)
+            ).fetchone()
+        return _row_to_dict(row)
+
+    def put(self, user_id, link, email, server_name, trial_type='free', timestamp=None):
+        """Insert or replace one user's trial record."""
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?)',
+                (str(user_id), link or '', email or '', server_name or '', trial_type,
+                 int(timestamp if timestamp is not None else time.time())),
+            )
+
+    def add_if_absent(self, user_id, link, email, server_name, trial_type='free', timestamp=None):
+        """Insert a record unless the user already has one; True if inserted."""
+        with self._lock:
+            cur = self._db.execute(
+                'INSERT OR IGNORE INTO trials VALUES (?, ?, ?, ?, ?, ?)',
+                (str(user_id), link or '', email or '', server_name or '', trial_type,
+                 int(timestamp if timestamp is not None else time.time())),
+            )
+        return cur.rowcount > 0
+
+    def delete(self, user_ids):
+        ids = [(str(u),) for u in user_ids]
+        if not ids:
+            return
+        with self._lock:
+            self._db.executemany('DELETE FROM trials WHERE user_id = ?', ids)
+
+    def older_than(self, trial_type, cutoff_ts):
+        """Records of `trial_type` issued at or before `cutoff_ts`, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                f'SELECT {", ".join(COLUMNS)} FROM trials '
+                'WHERE trial_type = ? AND timestamp <= ? ORDER BY timestamp',
+                (trial_type, int(cutoff_ts)),
+            ).fetchall()
+        return [_row_to_dict(r) for r in rows]
+
+    def user_ids(self):
+        """Every tracked Telegram user ID that is numeric."""
+        with self._lock:
+            rows = self._db.execute('SELECT user_id FROM trials').fetchall()
+        return [int(r[0]) for r in rows if str(r[0]).isdigit()]
+
+    def since(self, since_ts):
+        """(timestamp, trial_type) for every record issued after `since_ts`."""
+        with self._lock:
+            return self._db.execute(
+                'SELECT timestamp, trial_type FROM trials WHERE timestamp > ? ORDER BY timestamp',
+                (int(since_ts),),
+            ).fetchall()
+
+    def counts(self, free_active_after_ts):
+        """Return (total, free_active, free_expired, other) in one indexed pass."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT COUNT(*), '
+                "SUM(trial_type = 'free' AND timestamp > ?), "
+                "SUM(trial_type = 'free' AND timestamp <= ?), "
+                "SUM(trial_type != 'free') FROM trials",
+                (int(free_active_after_ts), int(free_active_after_ts)),
+            ).fetchone()
+        return tuple(int(v or 0) for v in row)
@@ -5,6 +5,7 @@ Run:  python app.py
 """
 
 import os
+import sys
 import json
 import time
 import requests
@@ -15,18 +16,25 @@ from datetime import datetime, timedelta
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.trial_store import TrialStore
+from common.config_loader import ConfigLoader
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 app = Flask(__name__)
 
 BASE_DIR       = os.path.dirname(os.path.abspath(__file__))
 CONFIG_PATH    = os.path.join(BASE_DIR, '..', 'config.json')
-TRACKING_PATH  = os.path.join(BASE_DIR, '..', 'vpn_bot', 'claimed_users.json')
 ROTATION_PATH  = os.path.join(BASE_DIR, '..', 'vpn_bot', 'server_rotation_state.json')
 
 DASHBOARD_USER = os.environ.get('DASH_USER', 'admin')
 DASHBOARD_PASS = os.environ.get('DASH_PASS', 'changeme')
 
+# Trial tracking lives in vpn_bot/trials.db (WAL), safe to read while the bot writes.
+TRIALS = TrialStore()
+CONFIG_LOADER = ConfigLoader(CONFIG_PATH)
+
 # Simple in-memory cache — avoids hammering X-UI on every page load
 _server_cache      = None
 _server_cache_time = 0
@@ -55,17 +63,9 @@ def require_auth(f):
 
 # ── Data helpers ──────────────────────────────────────────────────────────────
 
-def load_config() -> dict:
-    with open(CONFIG_PATH) as f:
-        return json.load(f)
-
-
-def load_tracking() -> dict:
-    try:
-        with open(TRACKING_PATH) as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
+def load_config():
+    """Read-only config snapshot; config.json is re-parsed only when it changes."""
+    return CONFIG_LOADER.get().data
 
 
 def load_rotation() -> dict:
@@ -193,27 +193,14 @@ def api_servers():
 @app.route('/api/stats')
 @require_auth
 def api_stats():
-    tracking    = load_tracking()
     now         = int(time.time())
     three_days  = 3 * 24 * 3600
     rotation    = load_rotation()
 
-    free_active = free_expired = premium = 0
-    for info in tracking.values():
-        if not isinstance(info, dict):
-            continue
-        t   = info.get('trial_type', 'free')
-        age = now - info.get('timestamp', 0)
-        if t == 'free':
-            if age < three_days:
-                free_active += 1
-            else:
-                free_expired += 1
-        else:
-            premium += 1
+    total, free_active, free_expired, premium = TRIALS.counts(now - three_days)
 
     return jsonify({
-        'total_users':     len(tracking),
+        'total_users':     total,
         'free_active':     free_active,
         'free_expired':    free_expired,
         'premium':         premium,
@@ -225,20 +212,14 @@ def api_stats():
 @app.route('/api/timeline')
 @require_auth
 def api_timeline():
-    tracking       = load_tracking()
     now            = int(time.time())
     days           = 30
     free_buckets    = defaultdict(int)
     premium_buckets = defaultdict(int)
 
-    for info in tracking.values():
-        if not isinstance(info, dict):
-            continue
-        ts = info.get('timestamp', 0)
-        if (now - ts) > days * 86400:
-            continue
+    for ts, trial_type in TRIALS.since(now - days * 86400):
         label = datetime.fromtimestamp(ts).strftime('%b %d')
-        if info.get('trial_type', 'free') == 'free':
+        if trial_type == 'free':
             free_buckets[label] += 1
         else:
             premium_buckets[label] += 1
@@ -1,37 +1,66 @@
 import logging
 import json
+import html
 import uuid
 import secrets
 import string
-import requests
+import httpx
 import asyncio
+import threading
+import os
+import sys
 from urllib.parse import urlparse, unquote
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 import telegram
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.panel_dialects import PanelDialects, call_with_dialect
+from common.panel_health import PanelHealth, guarded_request
+from common.singleflight import SingleFlight
+from common.trial_store import TrialStore
+from common.json_state import JsonState
+from common.media_cache import MediaCache
+from common import serving
+from common.pending_store import PendingStore, SqliteUserDataPersistence
+from common.provision_queue import ProvisionQueue, ProvisionWorkers
+from common.config_loader import ConfigLoader
+from common.config_store import ConfigStore, next_server_name
+from common.customers import WARM_TRIAL_PREFIX
+from common.job_runner import JobRunner
+from common.panel_scan import client_record, gather_bounded, inbound_records
+from common.telegram_dispatch import Dispatcher, PRIORITY_ADMIN, PRIORITY_KEY, PRIORITY_NOTICE
+
 # Setup logging FIRST
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
 
 # --- CONFIGURATION ---
-def load_config():
-    with open('../config.json', 'r') as f:
-        return json.load(f)
+# ../config.json is only re-parsed when it changes on disk; CONFIG/SERVERS are
+# read-only snapshots (see common/config_loader.py).
+CONFIG_LOADER = ConfigLoader()
+# Writes go through CONFIG_STORE (locked, versioned, atomic; common/config_store.py).
+CONFIG_STORE = ConfigStore(loader=CONFIG_LOADER)
 
 
 def refresh_runtime_config():
-    global CONFIG, SERVERS, ADMIN_IDS
+    global CONFIG, SERVERS, ADMIN_IDS, CONFIG_VERSION
     try:
-        fresh = load_config()
-        CONFIG = fresh
-        SERVERS = fresh.get('servers', [])
-        ADMIN_IDS = fresh.get('admin_ids', ADMIN_IDS)
+        snapshot = CONFIG_LOADER.get()
+        if snapshot.version == CONFIG_VERSION:
+            return
+        CONFIG = snapshot.data
+        SERVERS = snapshot.servers
+        ADMIN_IDS = snapshot.admin_ids or ADMIN_IDS
+        CONFIG_VERSION = snapshot.version
+        invalidate_xui_clients(SERVERS)
     except Exception as e:
         logging.warning(f"Failed to refresh config: {e}")
 
-CONFIG = load_config()
-SERVERS = CONFIG['servers']
-ADMIN_IDS = CONFIG['admin_ids']
+_snapshot = CONFIG_LOADER.get()
+CONFIG = _snapshot.data
+SERVERS = _snapshot.servers
+ADMIN_IDS = _snapshot.admin_ids
+CONFIG_VERSION = _snapshot.version
 logging.info(f"Configuration loaded: {len(SERVERS)} servers, {len(ADMIN_IDS)} admins")
 for s in SERVERS:
     logging.debug(f"  Server: {s.get('name')}")
@@ -77,9 +106,53 @@ RENEW_INTRO_TEXT = (
 # --- HELPER FUNCTIONS ---
 ROTATION_STATE_FILE = 'server_rotation_state.json'
 NOTICE_STATE_FILE = 'notice_state.json'
+MEDIA_CACHE_FILE = 'media_cache.json'
 EXPIRY_NOTICE_DAYS = 3
 LOW_DATA_NOTICE_GB = 2
 NOTICE_COOLDOWN_SECONDS = 24 * 60 * 60
+NOTICE_STATE_TTL_SECONDS = 14 * 24 * 60 * 60
+# The notice job only pops due entries off NOTICE_SCHEDULER, so it can run often.
+NOTICE_TICK_SECONDS = 60
+# Retry delay for reminders that could not be delivered or whose server is disabled.
+NOTICE_RETRY_SECONDS = 6 * 60 * 60
+STATE_FLUSH_SECONDS = 30
+# Unapproved slips and idle conversations older than this are dropped.
+PENDING_TTL_SECONDS = 7 * 24 * 60 * 60
+XUI_POOL_MAXSIZE = 8
+XUI_TIMEOUT_SECONDS = 15
+XUI_LOGIN_TIMEOUT_SECONDS = 10
+# Successful panel reads are shared for this long unless we write to the panel.
+XUI_READ_FRESHNESS_SECONDS = 2
+LOOKUP_DEADLINE_SECONDS = 20
+CLIENT_INDEX_REFRESH_SECONDS = 5 * 60
+PANEL_SCAN_CONCURRENCY = 8
+SERVER_LOAD_REFRESH_SECONDS = 60
+FREE_TRIAL_LIMIT_GB = 2
+FREE_TRIAL_EXPIRE_DAYS = 1
+# Disabled trial clients kept ready per server so get_free is one updateClient call.
+TRIAL_POOL_SIZE = 3
+TRIAL_POOL_REFILL_SECONDS = 2 * 60
+# Background panel jobs: threads for parsing, and per-job time budgets.
+JOB_WORKER_THREADS = 4
+JOB_BUDGET_SECONDS = {
+    'refresh_client_index': 4 * 60,
+    'refresh_server_loads': 50,
+    'cleanup_expired_trials': 30 * 60,
+    'notify_expiring_or_low_data_keys': 30 * 60,
+    'fill_trial_pool': 90,
+}
+# Approved slips are provisioned by this many workers, with retries and backoff.
+PROVISION_CONCURRENCY = 3
+PROVISION_MAX_ATTEMPTS = 5
+PROVISION_RETRY_SECONDS = 30
+PROVISION_JOB_TTL_SECONDS = 30 * 24 * 60 * 60
+# Panel responses larger than this are JSON-decoded off the event loop.
+LARGE_JSON_BYTES = 256 * 1024
+
+# Remembered route/encoding per panel, shared with admin_bot via ../panel_dialects.json.
+PANEL_DIALECTS = PanelDialects()
+# Circuit breaker per panel; see common/panel_health.py.
+PANEL_HEALTH = PanelHealth()
 
 BASE_MONTH_PRICE_KS = 5000
 MONTHLY_DISCOUNT_STEP_KS = 500
@@ -143,73 +216,137 @@ def find_server_by_name(name: str):
     return None
 
 
-def load_rotation_state():
-    try:
-        with open(ROTATION_STATE_FILE, 'r') as f:
-            return json.load(f)
-    except Exception:
-        return {"next_index": 0}
+def server_is_down(server):
+    """True while the server's panel circuit is open; callers skip it instead of waiting on timeouts."""
+    return PANEL_HEALTH.is_open(get_xui_client(server).base_url)
 
 
-def save_rotation_state(state):
-    try:
-        with open(ROTATION_STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=2)
-    except Exception as e:
-        logging.warning(f"Failed to persist rotation state: {e}")
+# Pending purchase/renewal slips awaiting admin approval, plus persisted user_data.
+PENDING = PendingStore()
 
+# Every bulk or fan-out send goes through OUTBOX so Telegram's flood limits are
+# respected and 429s are retried instead of dropping the message.
+OUTBOX = Dispatcher()
 
-def get_server_active_client_count(server):
-    """Return active client count for one server; None on fetch failure.
+# Overlap protection, time budgets and metrics for the panel jobs, plus the
+# thread pool that parses large panel listings (see common/job_runner.py).
+JOBS = JobRunner(max_workers=JOB_WORKER_THREADS)
 
-    Active means enabled and not expired.
-    """
-    try:
-        client = XUIClient(server)
-        inbound_url = f"{client.base_url}/panel/api/inbounds/get/{client.inbound_id}"
-        r = client.session.get(inbound_url, verify=False, timeout=15)
-        rj = r.json()
+# Approvals and renewals run as durable jobs (vpn_bot/provision.db); see common/provision_queue.py.
+PROVISIONING = ProvisionQueue()
+PROVISION_WORKERS = ProvisionWorkers(
+    PROVISIONING,
+    concurrency=PROVISION_CONCURRENCY,
+    max_attempts=PROVISION_MAX_ATTEMPTS,
+    base_delay=PROVISION_RETRY_SECONDS,
+)
 
-        if not rj.get('success'):
-            client.login()
-            r = client.session.get(inbound_url, verify=False, timeout=15)
-            rj = r.json()
 
-        if not rj.get('success'):
-            return None
+async def purge_abandoned_sessions(context: ContextTypes.DEFAULT_TYPE):
+    """Background task: drop slips and conversations idle longer than PENDING_TTL_SECONDS."""
+    cutoff = time.time() - PENDING_TTL_SECONDS
+    dropped_pending = PENDING.purge_pending(cutoff)
+    stale_users = PENDING.stale_user_ids(cutoff)
+    for user_id in stale_users:
+        context.application.drop_user_data(user_id)
+        PENDING.delete_user_data(user_id)
+    if dropped_pending or stale_users:
+        logging.info(f"🧹 Dropped {dropped_pending} abandoned slip(s) and {len(stale_users)} idle session(s)")
+    PROVISIONING.purge_finished(time.time() - PROVISION_JOB_TTL_SECONDS)
+
+
+# Kept in memory; flush_state_files writes them behind, atomically.
+ROTATION_STATE = JsonState(ROTATION_STATE_FILE, default={"next_index": 0})
+NOTICE_STATE = JsonState(NOTICE_STATE_FILE)
+# Telegram file_ids of the guide images, so each is uploaded only once.
+GUIDE_MEDIA = MediaCache(JsonState(MEDIA_CACHE_FILE))
+
+
+async def flush_state_files(context: ContextTypes.DEFAULT_TYPE = None):
+    """Background task: persist state that changed since the last flush."""
+    ROTATION_STATE.flush()
+    NOTICE_STATE.flush()
+    GUIDE_MEDIA.state.flush()
+
+
+async def on_startup(application: Application):
+    """Start the provisioning workers (they resume jobs left over from the last run)."""
+    PROVISION_WORKERS.start(
+        lambda job: run_provision_job(application.bot, job),
+        lambda job: finish_provision_job(application.bot, job),
+    )
 
-        inbound = rj.get('obj', {})
-        settings = json.loads(inbound.get('settings', '{}'))
-        now_ms = int(time.time() * 1000)
 
-        active_count = 0
-        for c in settings.get('clients', []):
-            enabled = bool(c.get('enable', True))
-            expiry_ms = int(c.get('expiryTime', 0) or 0)
-            not_expired = (expiry_ms <= 0) or (expiry_ms > now_ms)
-            if enabled and not_expired:
-                active_count += 1
+async def on_shutdown(application: Application):
+    """Stop provisioning, let queued messages go out, then persist state."""
+    await PROVISION_WORKERS.close()
+    await OUTBOX.close()
+    await flush_state_files()
+    JOBS.shutdown()
 
+
+def count_active_clients(inbound):
+    """Count enabled, unexpired clients in one inbound object."""
+    settings = parse_json_field(inbound.get('settings', '{}'))
+    now_ms = int(time.time() * 1000)
+
+    active_count = 0
+    for c in settings.get('clients', []):
+        enabled = bool(c.get('enable', True))
+        expiry_ms = int(c.get('expiryTime', 0) or 0)
+        not_expired = (expiry_ms <= 0) or (expiry_ms > now_ms)
+        if enabled and not_expired:
+            active_count += 1
+    return active_count
+
+
+async def get_server_active_client_count(server):
+    """Return active client count for one server; None on fetch failure.
+
+    Active means enabled and not expired. The result is also recorded in SERVER_LOADS.
+    """
+    client = get_xui_client(server)
+    try:
+        inbound = await client.get_inbound()
+        if not isinstance(inbound, dict):
+            SERVER_LOADS.record_failure(client.server_name)
+            return None
+
+        active_count = count_active_clients(inbound)
+        SERVER_LOADS.record_count(client.server_name, active_count)
         return active_count
     except Exception as e:
         logging.warning(f"Failed to fetch active client count for {server.get('name')}: {e}")
+        SERVER_LOADS.record_failure(client.server_name)
         return None
 
 
-def get_round_robin_servers():
-    """Return active servers ordered by least load with round-robin tie-breaks."""
+async def get_round_robin_servers():
+    """Return active servers ordered by least load with round-robin tie-breaks.
+
+    Loads come from SERVER_LOADS, which refresh_server_loads keeps current; only
+    servers never measured yet (e.g. right after startup) are fetched here.
+    """
     servers = get_profile_generation_servers()
     if not servers:
         return []
 
-    state = load_rotation_state()
+    state = ROTATION_STATE.data
     start_idx = int(state.get('next_index', 0)) % len(servers)
     rotated = servers[start_idx:] + servers[:start_idx]
 
+    unmeasured = [
+        s for s in rotated
+        if not server_is_down(s) and not (SERVER_LOADS.get(get_xui_client(s).server_name) or {}).get('updated_at')
+    ]
+    if unmeasured:
+        await asyncio.gather(*(get_server_active_client_count(s) for s in unmeasured))
+
     scored_servers = []
     for server in rotated:
-        count = get_server_active_client_count(server)
-        # Unknown counts go to the end so healthy, measurable servers are preferred.
+        load = SERVER_LOADS.get(get_xui_client(server).server_name) or {}
+        count = load.get('active_count') if load.get('reachable') and not server_is_down(server) else None
+        # Unknown, unreachable or circuit-open servers go to the end so healthy, measurable servers are preferred.
         sort_count = count if count is not None else 10 ** 9
         scored_servers.append((sort_count, server, count))
 
@@ -220,125 +357,158 @@ def get_round_robin_servers():
     logging.info(f"Load-balanced server order: {load_log}")
 
     state['next_index'] = (start_idx + 1) % len(servers)
-    save_rotation_state(state)
+    ROTATION_STATE.mark_dirty()
     return ordered
 
 
-def load_notice_state():
-    try:
-        with open(NOTICE_STATE_FILE, 'r') as f:
-            data = json.load(f)
-            return data if isinstance(data, dict) else {}
-    except Exception:
-        return {}
+def compact_notice_state(now):
+    """Drop notice dedup entries past NOTICE_STATE_TTL_SECONDS or for keys no panel has any more."""
+    index_complete = CLIENT_INDEX.covers([s.get('name') for s in SERVERS])
 
+    def stale(dedup_key, item):
+        stamps = [int(v or 0) for v in item.values()] if isinstance(item, dict) else []
+        if now - max(stamps, default=0) >= NOTICE_STATE_TTL_SECONDS:
+            return True
+        email = dedup_key.split(':', 1)[-1]
+        return index_complete and not CLIENT_INDEX.servers_for_email(email)
 
-def save_notice_state(state):
-    try:
-        with open(NOTICE_STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=2)
-    except Exception as e:
-        logging.warning(f"Failed to persist notice state: {e}")
+    return NOTICE_STATE.compact(stale)
 
 
-def extract_user_id_from_email(email: str):
-    """Extract Telegram user ID from bot-generated email labels, e.g. Premium_1234_abcd."""
-    if not email:
-        return None
+# --- X-UI API CLIENT ---
+def parse_json_field(raw):
+    """Decode an X-UI JSON-string field (settings, streamSettings) that may already be a dict."""
+    if isinstance(raw, dict):
+        return raw
+    if isinstance(raw, str):
+        try:
+            value = json.loads(raw)
+            if isinstance(value, dict):
+                return value
+        except Exception:
+            pass
+    return {}
+
+
+def find_client_stats(inbounds, target_uuid=None, target_email=None):
+    """Find a client by UUID or email across inbounds and return stats (up, down, total, expiry)."""
+    for inbound in inbounds:
+        settings = parse_json_field(inbound.get('settings', '{}'))
+
+        # 1. Find Client in Settings (Config)
+        target_client = None
+        for client in settings.get('clients', []):
+            if target_uuid is not None and str(client.get('id')) == str(target_uuid):
+                target_client = client
+                break
+            if target_email is not None and str(client.get('email', '')) == str(target_email):
+                target_client = client
+                break
+
+        if target_client:
+            # 2. Try to find REAL usage stats from 'clientStats' (dynamic)
+            up = target_client.get('up', 0)
+            down = target_client.get('down', 0)
+
+            client_stats = inbound.get('clientStats')
+            if client_stats:
+                for stat in client_stats:
+                    if stat.get('email') == target_client.get('email'):
+                        up = stat.get('up', 0)
+                        down = stat.get('down', 0)
+                        break
 
-    m = re.match(r'^(?:Premium|FreeTrial)_(\d+)', str(email))
-    if m:
-        return int(m.group(1))
+            return {
+                "email": target_client.get('email', ''),
+                "up": up,
+                "down": down,
+                "total": target_client.get('totalGB', 0),
+                "expiry": target_client.get('expiryTime', 0),
+                "enable": target_client.get('enable', True)
+            }
     return None
 
 
-def collect_notice_candidates():
-    """Scan all active servers and return customers who are near expiry or low remaining data."""
-    now = int(time.time())
-    gb = 1024 * 1024 * 1024
-    alerts = []
+def build_vless_link(base_url, inbound, stream_settings, uuid_val, remark_val):
+    """Construct a vless link from uuid, using Reality settings if available."""
+    try:
+        reality = stream_settings.get('realitySettings') if isinstance(stream_settings, dict) else None
+        rsettings = reality.get('settings') if reality else None
+        if isinstance(rsettings, str):
+            try:
+                rsettings = json.loads(rsettings)
+            except Exception:
+                rsettings = None
+
+        pbk = sni = sid = None
+        if isinstance(rsettings, dict):
+            pbk = rsettings.get('publicKey')
+        if reality and reality.get('serverNames'):
+            sni = reality.get('serverNames')[0]
+        if reality and reality.get('shortIds'):
+            sid = reality.get('shortIds')[0]
+
+        ip = base_url.split('://')[1].split(':')[0]
+        port = inbound.get('port')
+
+        if pbk and sni and sid:
+            return (f"vless://{uuid_val}@{ip}:{port}"
+                    f"?type=tcp&security=reality&encryption=none&pbk={pbk}&fp=chrome"
+                    f"&sni={sni}&sid={sid}&spx=%2F&flow=xtls-rprx-vision#{remark_val}")
+        else:
+            # Fallback for ws or tcp without reality
+            network = stream_settings.get('network') if isinstance(stream_settings, dict) else None
+            if network == 'ws':
+                ws = stream_settings.get('wsSettings') or {}
+                path = ws.get('path', '/')
+                headers = ws.get('headers') or {}
+                host = headers.get('Host') or None
+                params = f"type=ws&security=none&encryption=none&path={path}"
+                if host:
+                    params += f"&host={host}"
+            else:
+                params = "type=tcp&security=none&encryption=none"
+            return f"vless://{uuid_val}@{ip}:{port}?{params}#{remark_val}"
+    except Exception as e:
+        logging.error(f"Failed to build link: {e}")
+        return None
 
-    for server in get_active_servers():
-        try:
-            client = XUIClient(server)
-            list_url = f"{client.base_url}/panel/api/inbounds/list"
-            r = client.session.get(list_url, verify=False, timeout=15)
-            rj = r.json()
-
-            if not rj.get('success'):
-                client.login()
-                r = client.session.get(list_url, verify=False, timeout=15)
-                rj = r.json()
-
-            if not rj.get('success'):
-                logging.warning(f"Notice scan failed on {server.get('name')}: {rj}")
-                continue
 
-            for inbound in rj.get('obj', []):
-                try:
-                    settings = json.loads(inbound.get('settings', '{}'))
-                except Exception:
-                    settings = {'clients': []}
+def _successful_read(result):
+    body, _status = result
+    return isinstance(body, dict) and bool(body.get('success'))
 
-                stats_by_email = {}
-                for stat in inbound.get('clientStats') or []:
-                    email = stat.get('email')
-                    if email:
-                        stats_by_email[email] = stat
 
-                for c in settings.get('clients', []):
-                    email = c.get('email', '')
-                    user_id = extract_user_id_from_email(email)
-                    if not user_id:
-                        tgid = str(c.get('tgId', '')).strip()
-                        user_id = int(tgid) if tgid.isdigit() else None
-                    if not user_id:
-                        continue
-
-                    total = int(c.get('totalGB', 0) or 0)
-                    expiry_ms = int(c.get('expiryTime', 0) or 0)
-                    stat = stats_by_email.get(email, {})
-                    up = int(stat.get('up', c.get('up', 0)) or 0)
-                    down = int(stat.get('down', c.get('down', 0)) or 0)
-                    used = up + down
-                    remaining = max(0, total - used)
-
-                    days_left = None
-                    expiring_soon = False
-                    if expiry_ms > 0:
-                        seconds_left = int(expiry_ms / 1000) - now
-                        if seconds_left > 0:
-                            days_left = max(0, seconds_left // 86400)
-                            expiring_soon = seconds_left <= (EXPIRY_NOTICE_DAYS * 86400)
-
-                    low_data_soon = total > 0 and remaining <= (LOW_DATA_NOTICE_GB * gb)
-
-                    if expiring_soon or low_data_soon:
-                        alerts.append({
-                            'user_id': user_id,
-                            'email': email,
-                            'server_name': server.get('name', 'Unknown'),
-                            'days_left': days_left,
-                            'remaining_gb': round(remaining / gb, 2),
-                            'reasons': {
-                                'expiry': expiring_soon,
-                                'low_data': low_data_soon,
-                            }
-                        })
-        except Exception as e:
-            logging.warning(f"Notice scan exception on {server.get('name')}: {e}")
+def new_panel_client(email, limit_gb=0, expiry_ms=0, enable=True, client_uuid=None):
+    """Client settings object as vpn_bot creates them (fresh uuid and subId unless given)."""
+    return {
+        "id": client_uuid or str(uuid.uuid4()),
+        "email": email,
+        "flow": "xtls-rprx-vision",
+        "totalGB": int(limit_gb) * 1024 * 1024 * 1024,
+        "expiryTime": expiry_ms,
+        "enable": enable,
+        "tgId": "",
+        "subId": ''.join(secrets.choice(string.ascii_lowercase + string.digits) for _ in range(16)),
+        "limitIp": 1
+    }
 
-    return alerts
 
-# --- X-UI API CLIENT ---
-class XUIClient:
+class AsyncXUIClient:
+    """Non-blocking X-UI panel client.
+
+    Instances are long-lived (see get_xui_client) and keep one pooled, keep-alive
+    httpx session per panel. Login happens lazily on first use and again only when
+    the panel rejects a request.
+    """
+
     def __init__(self, server_config):
         self.base_url = server_config['panel_url'].rstrip('/')
         self.username = server_config['username']
         self.password = server_config['password']
         self.inbound_id = server_config['inbound_id']
         self.api_token = str(server_config.get('api_token', '') or '').strip()
-        self.session = requests.Session()
+        self.server_name = server_config.get('name', self.base_url)
 
         self.base_roots = [self.base_url]
         try:
@@ -349,22 +519,105 @@ class XUIClient:
         except Exception:
             pass
 
+        headers = {}
         if self.api_token:
-            self.session.headers.update({
+            headers.update({
                 'Authorization': f'Bearer {self.api_token}',
                 'X-API-Key': self.api_token,
                 'x-ui-token': self.api_token,
             })
 
-        self.login()
+        self.http = httpx.AsyncClient(
+            verify=False,
+            headers=headers,
+            timeout=XUI_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=XUI_POOL_MAXSIZE, max_keepalive_connections=XUI_POOL_MAXSIZE),
+        )
+        self._login_lock = asyncio.Lock()
+        self._session_generation = 0
+        self._logged_in = False
+        self._reads = SingleFlight(ttl=XUI_READ_FRESHNESS_SECONDS)
+        # Last inbound seen by get_inbound(); claim_warm_client builds links from it.
+        self._link_inbound = None
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def _http(self, method, url, **kwargs):
+        """Every panel request goes through the circuit breaker (raises PanelUnavailable while open)."""
+        return await guarded_request(PANEL_HEALTH, self.base_url, self.http, method, url, **kwargs)
+
+    async def login(self):
+        login_url = f"{self.base_url}/login"
+        payload = {'username': self.username, 'password': self.password}
+        try:
+            r = await self._http('POST', login_url, data=payload, timeout=XUI_LOGIN_TIMEOUT_SECONDS)
+            if r.json().get('success'):
+                logging.info(f"Logged in to {self.base_url}")
+                self._logged_in = True
+                self._session_generation += 1
+                return True
+        except Exception as e:
+            logging.error(f"Login failed: {e}")
+        return False
+
+    async def _relogin(self, seen_generation):
+        """Log in again unless a concurrent request already refreshed the session."""
+        async with self._login_lock:
+            if self._session_generation != seen_generation:
+                return True
+            return await self.login()
+
+    async def _ensure_login(self):
+        if not self._logged_in:
+            await self._relogin(self._session_generation)
 
-    def _api_get_json(self, url):
+    async def _api_get(self, url):
+        """GET url; returns (json_body_or_None, http_status_or_None).
+
+        Identical concurrent GETs share one request and its parsed body.
+        """
+        async def fetch():
+            try:
+                r = await self._http('GET', url)
+            except Exception:
+                return None, None
+            try:
+                if len(r.content) > LARGE_JSON_BYTES:
+                    return await JOBS.run_blocking(json.loads, r.content), r.status_code
+                return r.json(), r.status_code
+            except Exception:
+                return None, r.status_code
+
+        return await self._reads.do(url, fetch, cacheable=_successful_read)
+
+    async def _api_get_json(self, url):
+        return (await self._api_get(url))[0]
+
+    async def _api_post_json(self, url, payload=None):
+        try:
+            r = await self._http('POST', url, json=payload)
+        except Exception as e:
+            logging.error(f"POST {url} failed: {e}")
+            return None
+        finally:
+            self._reads.invalidate()
         try:
-            r = self.session.get(url, verify=False, timeout=15)
             return r.json()
         except Exception:
+            logging.error(f"POST {url} response is not JSON (status={r.status_code}): {r.text[:200]}")
             return None
 
+    async def _get_json_with_relogin(self, url):
+        await self._ensure_login()
+        generation = self._session_generation
+        data = await self._api_get_json(url)
+        if isinstance(data, dict) and data.get('success'):
+            return data
+        logging.debug(f"GET {url} rejected ({data}); re-logging in and retrying.")
+        await self._relogin(generation)
+        return await self._api_get_json(url)
+
     def _inbound_list_urls(self):
         urls = []
         for root in self.base_roots:
@@ -384,269 +637,124 @@ class XUIClient:
             ])
         return urls
 
-    def _fetch_inbounds_list(self):
-        # Try as-is, then re-login once and retry all routes.
-        for url in self._inbound_list_urls():
-            data = self._api_get_json(url)
-            if isinstance(data, dict) and data.get('success'):
-                obj = data.get('obj')
-                if isinstance(obj, list):
-                    return obj
-
-        self.login()
-        for url in self._inbound_list_urls():
-            data = self._api_get_json(url)
-            if isinstance(data, dict) and data.get('success'):
-                obj = data.get('obj')
-                if isinstance(obj, list):
-                    return obj
+    async def list_inbounds(self):
+        """Return every inbound on the panel, or None if no route answered."""
+        def accept(data):
+            return isinstance(data, dict) and data.get('success') and isinstance(data.get('obj'), list)
 
-        return []
+        async def send(url, encoding):
+            return await self._api_get(url)
 
-    def login(self):
-        login_url = f"{self.base_url}/login"
-        payload = {'username': self.username, 'password': self.password}
-        try:
-            r = self.session.post(login_url, data=payload, verify=False, timeout=10)
-            if r.json().get('success'):
-                logging.info(f"Logged in to {self.base_url}")
-                return True
-        except Exception as e:
-            logging.error(f"Login failed: {e}")
-        return False
+        # Try the remembered route, re-logging in once if it answers 404, and
+        # probe the others only if it is unknown or still gone.
+        await self._ensure_login()
+        generation = self._session_generation
+        relogged = []
 
-    def get_client_stats(self, target_uuid):
-        """Find a client by UUID and return stats (up, down, total, expiry)."""
-        try:
-            inbounds = self._fetch_inbounds_list()
-            for inbound in inbounds:
-                raw_settings = inbound.get('settings', '{}')
-                if isinstance(raw_settings, str):
-                    try:
-                        settings = json.loads(raw_settings)
-                    except Exception:
-                        settings = {'clients': []}
-                elif isinstance(raw_settings, dict):
-                    settings = raw_settings
-                else:
-                    settings = {'clients': []}
+        async def relogin():
+            relogged.append(True)
+            return await self._relogin(generation)
 
-                # 1. Find Client in Settings (Config)
-                target_client = None
-                for client in settings.get('clients', []):
-                    if str(client.get('id')) == str(target_uuid):
-                        target_client = client
-                        break
-
-                if target_client:
-                    # 2. Try to find REAL usage stats from 'clientStats' (dynamic)
-                    up = target_client.get('up', 0)
-                    down = target_client.get('down', 0)
-
-                    client_stats = inbound.get('clientStats')
-                    if client_stats:
-                        for stat in client_stats:
-                            if stat.get('email') == target_client.get('email'):
-                                up = stat.get('up', 0)
-                                down = stat.get('down', 0)
-                                break
-
-                    return {
-                        "email": target_client.get('email', ''),
-                        "up": up,
-                        "down": down,
-                        "total": target_client.get('totalGB', 0),
-                        "expiry": target_client.get('expiryTime', 0),
-                        "enable": target_client.get('enable', True)
-                    }
+        data = await call_with_dialect(
+            PANEL_DIALECTS, self.base_url, 'list', self._inbound_list_urls(), send, accept, relogin=relogin,
+        )
+        if not data and not relogged:
+            # No route was known and none answered; the session may have expired.
+            await relogin()
+            data = await call_with_dialect(
+                PANEL_DIALECTS, self.base_url, 'list', self._inbound_list_urls(), send, accept, relogin=relogin,
+            )
+        if not data:
             return None
+        obj = data['obj']
+        # Every full listing doubles as an index refresh for this server.
+        await JOBS.run_blocking(CLIENT_INDEX.replace_server, self.server_name, obj)
+        return obj
+
+    async def get_inbound(self):
+        """Return this server's configured inbound object, or None."""
+        url = f"{self.base_url}/panel/api/inbounds/get/{self.inbound_id}"
+        rj = await self._get_json_with_relogin(url)
+        if isinstance(rj, dict) and rj.get('success'):
+            if isinstance(rj.get('obj'), dict):
+                self._link_inbound = rj['obj']
+            return rj.get('obj')
+        logging.error(f"Inbound GET failed after retry on {self.base_url}: {rj}")
+        return None
+
+    async def get_client_stats(self, target_uuid):
+        """Find a client by UUID and return stats (up, down, total, expiry)."""
+        try:
+            return find_client_stats(await self.list_inbounds() or [], target_uuid=target_uuid)
         except Exception as e:
             logging.error(f"Error checking stats: {e}")
             return None
 
-    def get_client_stats_by_email(self, target_email):
+    async def get_client_stats_by_email(self, target_email):
         """Find a client by email and return stats (up, down, total, expiry)."""
         try:
-            inbounds = self._fetch_inbounds_list()
-            for inbound in inbounds:
-                raw_settings = inbound.get('settings', '{}')
-                if isinstance(raw_settings, str):
-                    try:
-                        settings = json.loads(raw_settings)
-                    except Exception:
-                        settings = {'clients': []}
-                elif isinstance(raw_settings, dict):
-                    settings = raw_settings
-                else:
-                    settings = {'clients': []}
-
-                target_client = None
-                for client in settings.get('clients', []):
-                    if str(client.get('email', '')) == str(target_email):
-                        target_client = client
-                        break
-
-                if target_client:
-                    up = target_client.get('up', 0)
-                    down = target_client.get('down', 0)
-                    client_stats = inbound.get('clientStats')
-                    if client_stats:
-                        for stat in client_stats:
-                            if stat.get('email') == target_client.get('email'):
-                                up = stat.get('up', 0)
-                                down = stat.get('down', 0)
-                                break
-
-                    return {
-                        "email": target_client.get('email', ''),
-                        "up": up,
-                        "down": down,
-                        "total": target_client.get('totalGB', 0),
-                        "expiry": target_client.get('expiryTime', 0),
-                        "enable": target_client.get('enable', True)
-                    }
-            return None
+            return find_client_stats(await self.list_inbounds() or [], target_email=target_email)
         except Exception as e:
             logging.error(f"Error checking stats by email: {e}")
             return None
 
-    def add_client(self, email, limit_gb=0, expire_days=0):
+    async def add_client(self, email, limit_gb=0, expire_days=0):
+        """Create (or return the existing) client; returns (link, existed)."""
+        started = time.monotonic()
+        result = (None, False)
+        try:
+            result = await self._add_client(email, limit_gb, expire_days)
+            return result
+        finally:
+            link, existed = result
+            SERVER_LOADS.record_add(self.server_name, time.monotonic() - started, bool(link), bool(link) and not existed)
+
+    async def _add_client(self, email, limit_gb=0, expire_days=0):
         # Validate panel URL
         if "vless://" in self.base_url:
             logging.error("Invalid Panel URL (vless link detected). Check config.json")
             return (None, False)
 
         # Fetch inbound info (with retry on session expiration)
-        list_url = f"{self.base_url}/panel/api/inbounds/get/{self.inbound_id}"
-        try:
-            r = self.session.get(list_url, verify=False, timeout=15)
-            rj = r.json()
-        except Exception as e:
-            logging.error(f"Failed to GET inbound info: {e}")
-            return (None, False)
-
-        if not rj.get('success'):
-            logging.debug(f"Inbound GET success=false, response={rj}. Attempting re-login and retry.")
-            self.login()
-            try:
-                r = self.session.get(list_url, verify=False, timeout=15)
-                rj = r.json()
-            except Exception as e:
-                logging.error(f"Retry GET inbound failed: {e}")
-                return (None, False)
-
-        if not rj.get('success'):
-            logging.error(f"Inbound GET failed after retry: {rj}")
+        inbound = await self.get_inbound()
+        if not isinstance(inbound, dict):
             return (None, False)
 
-        inbound = rj.get('obj')
-        logging.debug(f"Inbound object keys: {inbound.keys() if isinstance(inbound, dict) else 'not a dict'}")
-
-        try:
-            settings = json.loads(inbound.get('settings', '{}'))
-        except Exception as e:
-            logging.error(f"Failed to parse inbound settings JSON: {e}")
-            settings = {'clients': []}
-
-        try:
-            stream_settings = json.loads(inbound.get('streamSettings', '{}'))
-        except Exception as e:
-            logging.error(f"Failed to parse inbound streamSettings JSON: {e}")
-            stream_settings = {}
+        settings = parse_json_field(inbound.get('settings', '{}'))
+        stream_settings = parse_json_field(inbound.get('streamSettings', '{}'))
 
         expiry_time = 0
         if expire_days > 0:
-            import time
             expiry_time = int((time.time() * 1000) + (expire_days * 86400 * 1000))
 
         add_url = f"{self.base_url}/panel/api/inbounds/addClient"
 
-        def build_link_for_uuid(uuid_val, remark_val):
-            """Construct a vless link from uuid, using Reality settings if available."""
-            try:
-                reality = stream_settings.get('realitySettings') if isinstance(stream_settings, dict) else None
-                rsettings = reality.get('settings') if reality else None
-                if isinstance(rsettings, str):
-                    try:
-                        rsettings = json.loads(rsettings)
-                    except Exception:
-                        rsettings = None
-
-                pbk = sni = sid = None
-                if isinstance(rsettings, dict):
-                    pbk = rsettings.get('publicKey')
-                if reality and reality.get('serverNames'):
-                    sni = reality.get('serverNames')[0]
-                if reality and reality.get('shortIds'):
-                    sid = reality.get('shortIds')[0]
-
-                ip = self.base_url.split('://')[1].split(':')[0]
-                port = inbound.get('port')
-
-                if pbk and sni and sid:
-                    return (f"vless://{uuid_val}@{ip}:{port}"
-                            f"?type=tcp&security=reality&encryption=none&pbk={pbk}&fp=chrome"
-                            f"&sni={sni}&sid={sid}&spx=%2F&flow=xtls-rprx-vision#{remark_val}")
-                else:
-                    # Fallback for ws or tcp without reality
-                    network = stream_settings.get('network') if isinstance(stream_settings, dict) else None
-                    if network == 'ws':
-                        ws = stream_settings.get('wsSettings') or {}
-                        path = ws.get('path', '/')
-                        headers = ws.get('headers') or {}
-                        host = headers.get('Host') or None
-                        params = f"type=ws&security=none&encryption=none&path={path}"
-                        if host:
-                            params += f"&host={host}"
-                    else:
-                        params = "type=tcp&security=none&encryption=none"
-                    return f"vless://{uuid_val}@{ip}:{port}?{params}#{remark_val}"
-            except Exception as e:
-                logging.error(f"Failed to build link: {e}")
-                return None
-
         # Try adding the client
         try:
-            new_uuid = str(uuid.uuid4())
-            sub_id = ''.join(secrets.choice(string.ascii_lowercase + string.digits) for _ in range(16))
-            
+            new_client = new_panel_client(email, limit_gb, expiry_time)
+            new_uuid = new_client['id']
             client_data = {
                 "id": self.inbound_id,
-                "settings": json.dumps({
-                    "clients": [{
-                        "id": new_uuid,
-                        "email": email,
-                        "flow": "xtls-rprx-vision",
-                        "totalGB": limit_gb * 1024 * 1024 * 1024,
-                        "expiryTime": expiry_time,
-                        "enable": True,
-                        "tgId": "",
-                        "subId": sub_id,
-                        "limitIp": 1
-                    }]
-                })
+                "settings": json.dumps({"clients": [new_client]})
             }
 
-            r = self.session.post(add_url, json=client_data, verify=False, timeout=15)
-            logging.debug(f"addClient POST {add_url} email={email} returned status={r.status_code}")
-
-            try:
-                resp_json = r.json()
-            except Exception as e:
-                logging.error(f"addClient response is not JSON: {r.text[:200]}")
+            resp_json = await self._api_post_json(add_url, client_data)
+            logging.debug(f"addClient POST {add_url} email={email} returned {resp_json}")
+            if not isinstance(resp_json, dict):
                 return (None, False)
 
-            if resp_json and resp_json.get('success'):
-                link = build_link_for_uuid(new_uuid, email)
+            if resp_json.get('success'):
+                CLIENT_INDEX.upsert(self.server_name, self.inbound_id, new_client)
+                link = build_vless_link(self.base_url, inbound, stream_settings, new_uuid, email)
                 return (link, False) if link else (None, False)
 
             # Check for duplicate email
-            if resp_json and not resp_json.get('success') and 'duplicate' in str(resp_json.get('msg', '')).lower():
+            if 'duplicate' in str(resp_json.get('msg', '')).lower():
                 logging.info(f"Duplicate email detected for {email}, searching for existing client...")
                 for c in settings.get('clients', []):
                     if c.get('email') == email:
-                        existing_uuid = c.get('id')
-                        link = build_link_for_uuid(existing_uuid, email)
+                        CLIENT_INDEX.upsert(self.server_name, self.inbound_id, c)
+                        link = build_vless_link(self.base_url, inbound, stream_settings, c.get('id'), email)
                         if link:
                             logging.info(f"Found existing client for {email}, returning existing link")
                             return (link, True)
@@ -658,79 +766,115 @@ class XUIClient:
             logging.error(f"Exception in add_client: {e}")
             return (None, False)
 
-    def delete_client_by_email(self, email):
+    async def add_warm_clients(self, count, limit_gb):
+        """Create `count` disabled, ownerless trial clients in one addClient call.
+
+        Returns how many were added. They have no expiry until claimed.
+        """
+        inbound = await self.get_inbound()
+        if not isinstance(inbound, dict) or count <= 0:
+            return 0
+        clients = [new_panel_client(f"{WARM_TRIAL_PREFIX}{secrets.token_hex(6)}", limit_gb, 0, enable=False)
+                   for _ in range(count)]
+        add_url = f"{self.base_url}/panel/api/inbounds/addClient"
+        resp = await self._api_post_json(add_url, {
+            "id": self.inbound_id,
+            "settings": json.dumps({"clients": clients})
+        })
+        if not isinstance(resp, dict) or not resp.get('success'):
+            logging.warning(f"Warm trial pool fill failed on {self.server_name}: {resp}")
+            return 0
+        for c in clients:
+            CLIENT_INDEX.upsert(self.server_name, self.inbound_id, c)
+        return len(clients)
+
+    async def claim_warm_client(self, record, email, limit_gb, expire_days):
+        """Turn a warm pool client (a CLIENT_INDEX record) into `email`'s key.
+
+        One updateClient call renames, enables and dates the client. Returns the
+        link, or None if the panel refused (e.g. the client is already gone).
+        """
+        started = time.monotonic()
+        inbound = self._link_inbound or await self.get_inbound()
+        if not isinstance(inbound, dict):
+            return None
+        expiry_ms = int((time.time() * 1000) + (expire_days * 86400 * 1000))
+        client = new_panel_client(email, limit_gb, expiry_ms, client_uuid=record['uuid'])
+        update_url = f"{self.base_url}/panel/api/inbounds/updateClient/{record['uuid']}"
+        resp = await self._api_post_json(update_url, {
+            "id": record['inbound_id'],
+            "settings": json.dumps({"clients": [client]})
+        })
+        if not isinstance(resp, dict) or not resp.get('success'):
+            logging.warning(f"Claiming warm client {record['email']} on {self.server_name} failed: {resp}")
+            return None
+        CLIENT_INDEX.remove(self.server_name, record['email'])
+        CLIENT_INDEX.upsert(self.server_name, record['inbound_id'], client)
+        SERVER_LOADS.record_add(self.server_name, time.monotonic() - started, True, True)
+        stream_settings = parse_json_field(inbound.get('streamSettings', '{}'))
+        return build_vless_link(self.base_url, inbound, stream_settings, record['uuid'], email)
+
+    async def delete_client_by_email(self, email):
         """Delete a client from the inbound by email address."""
+        return email in await self.delete_clients_by_emails([email])
+
+    async def delete_clients_by_emails(self, emails):
+        """Delete several clients with one inbound fetch and one settings update.
+
+        Returns the set of emails that were removed; emails not on this inbound
+        are simply absent from the result.
+        """
+        wanted = {str(e) for e in emails if e}
+        if not wanted:
+            return set()
         try:
-            list_url = f"{self.base_url}/panel/api/inbounds/get/{self.inbound_id}"
-            r = self.session.get(list_url, verify=False, timeout=15)
-            rj = r.json()
-            
-            if not rj.get('success'):
-                logging.debug(f"Session expired, re-logging in for delete operation...")
-                self.login()
-                r = self.session.get(list_url, verify=False, timeout=15)
-                rj = r.json()
-            
-            if not rj.get('success'):
-                logging.error(f"Failed to fetch inbound for deletion: {rj}")
-                return False
-            
-            inbound = rj.get('obj')
-            settings = json.loads(inbound.get('settings', '{}'))
-            
-            # Find and remove the client
-            target_uuid = None
-            for client in settings.get('clients', []):
-                if client.get('email') == email:
-                    target_uuid = client.get('id')
-                    settings['clients'].remove(client)
-                    logging.info(f"Found client {email} with UUID {target_uuid}, removing...")
-                    break
-            
-            if not target_uuid:
-                logging.warning(f"Client {email} not found on server {self.base_url}")
-                return False
-            
-            # Update the inbound with the modified settings (client removed)
+            inbound = await self.get_inbound()
+            if not isinstance(inbound, dict):
+                logging.error(f"Failed to fetch inbound for deletion on {self.base_url}")
+                return set()
+
+            # Panel reads are shared (SingleFlight); copy the one dict we change.
+            settings = dict(parse_json_field(inbound.get('settings', '{}')))
+            clients = settings.get('clients', [])
+            kept = [c for c in clients if str(c.get('email', '')) not in wanted]
+            removed = {str(c.get('email', '')) for c in clients} & wanted
+
+            missing = wanted - removed
+            if missing:
+                logging.warning(f"{len(missing)} client(s) not found on server {self.base_url}: {sorted(missing)[:5]}")
+            if not removed:
+                return set()
+
+            # Update the inbound with the modified settings (clients removed)
+            settings['clients'] = kept
             update_url = f"{self.base_url}/panel/api/inbounds/{self.inbound_id}"
             update_data = {
                 "id": self.inbound_id,
                 "settings": json.dumps(settings)
             }
-            
-            r = self.session.post(update_url, json=update_data, verify=False, timeout=15)
-            resp_json = r.json()
-            
-            if resp_json.get('success'):
-                logging.info(f"Successfully deleted client {email} (UUID: {target_uuid}) from {self.base_url}")
-                return True
-            else:
-                logging.error(f"Failed to delete client {email}: {resp_json}")
-                return False
-                
+
+            resp_json = await self._api_post_json(update_url, update_data)
+            if isinstance(resp_json, dict) and resp_json.get('success'):
+                for email in removed:
+                    CLIENT_INDEX.remove(self.server_name, email)
+                logging.info(f"Successfully deleted {len(removed)} client(s) from {self.base_url}")
+                return removed
+            logging.error(f"Failed to delete {len(removed)} client(s) from {self.base_url}: {resp_json}")
+            return set()
+
         except Exception as e:
-            logging.error(f"Exception in delete_client_by_email: {e}")
-            return False
+            logging.error(f"Exception in delete_clients_by_emails: {e}")
+            return set()
 
-    def reset_and_extend_client(self, target_uuid: str, expire_days: int = 30, limit_gb: int = 100):
+    async def reset_and_extend_client(self, target_uuid: str, expire_days: int = 30, limit_gb: int = 100):
         """Reset traffic counters to 0 and extend expiry by expire_days from now.
         Returns (True, new_expiry_date_str) on success, (False, error_msg) on failure."""
-        import time as _time
-        from datetime import datetime as _dt
-
-        list_url = f"{self.base_url}/panel/api/inbounds/get/{self.inbound_id}"
         try:
-            r = self.session.get(list_url, verify=False, timeout=15)
-            rj = r.json()
-            if not rj.get('success'):
-                self.login()
-                r = self.session.get(list_url, verify=False, timeout=15)
-                rj = r.json()
-            if not rj.get('success'):
+            inbound = await self.get_inbound()
+            if not isinstance(inbound, dict):
                 return False, "Failed to fetch inbound data"
 
-            inbound  = rj['obj']
-            settings = json.loads(inbound.get('settings', '{}'))
+            settings = parse_json_field(inbound.get('settings', '{}'))
             clients  = settings.get('clients', [])
 
             target_client = None
@@ -745,7 +889,7 @@ class XUIClient:
             email = target_client['email']
 
             # Set new expiry (from now)
-            new_expiry_ms = int((_time.time() * 1000) + (expire_days * 86400 * 1000))
+            new_expiry_ms = int((time.time() * 1000) + (expire_days * 86400 * 1000))
             target_client['expiryTime'] = new_expiry_ms
             target_client['totalGB']    = int(limit_gb) * 1024 * 1024 * 1024
             target_client['enable']     = True
@@ -756,22 +900,22 @@ class XUIClient:
                 "id":       self.inbound_id,
                 "settings": json.dumps({"clients": [target_client]})
             }
-            r    = self.session.post(update_url, json=update_data, verify=False, timeout=15)
-            resp = r.json()
-            if not resp.get('success'):
-                return False, f"Update failed: {resp.get('msg', resp)}"
+            resp = await self._api_post_json(update_url, update_data)
+            if not isinstance(resp, dict) or not resp.get('success'):
+                msg = resp.get('msg', resp) if isinstance(resp, dict) else resp
+                return False, f"Update failed: {msg}"
 
             # Reset traffic counters
             reset_url = (
                 f"{self.base_url}/panel/api/inbounds/"
                 f"{self.inbound_id}/resetClientTraffic/{email}"
             )
-            r    = self.session.post(reset_url, verify=False, timeout=15)
-            resp = r.json()
-            if not resp.get('success'):
+            resp = await self._api_post_json(reset_url)
+            if not isinstance(resp, dict) or not resp.get('success'):
                 logging.warning(f"Traffic reset non-success for {email}: {resp}")
+            CLIENT_INDEX.upsert(self.server_name, self.inbound_id, target_client)
 
-            expiry_date = _dt.fromtimestamp(new_expiry_ms / 1000).strftime('%Y-%m-%d')
+            expiry_date = datetime.fromtimestamp(new_expiry_ms / 1000).strftime('%Y-%m-%d')
             return True, expiry_date
 
         except Exception as e:
@@ -781,91 +925,584 @@ class XUIClient:
 from datetime import datetime, timedelta
 import re
 import time
+import heapq
 
-# --- TRIAL TRACKING HELPERS ---
+# --- X-UI CLIENT POOL ---
 """
-Tracking file format (claimed_users.json):
-{
-    "8130396030": {
-        "link": "vless://...",
-        "timestamp": 1710086400,  # unix timestamp when trial was issued
-        "trial_type": "free",     # "free" or "premium"
-        "email": "FreeTrial_8130396030",
-        "server_name": "Server 1"
-    }
-}
-
-This allows us to:
-1. Track when each free trial was created
-2. Auto-delete accounts after 3 days
-3. Prevent users from getting multiple free trials
+One AsyncXUIClient per panel for the whole process. Building a client costs a
+TLS handshake plus a login POST, so handlers borrow the pooled instance
+instead. Entries are replaced when the server's credentials change and dropped
+when the server disappears from config.json.
 """
+_XUI_CLIENTS = {}
+_XUI_CLIENTS_LOCK = threading.Lock()
+
 
-def load_trial_tracking():
-    """Load trial tracking data with support for legacy format."""
+def _server_pool_key(server):
+    # Display names are not unique; the panel and inbound are.
+    return str(server.get('panel_url', '')).rstrip('/'), server.get('inbound_id')
+
+
+def _server_fingerprint(server):
+    return (
+        str(server.get('panel_url', '')).rstrip('/'),
+        server.get('username'),
+        server.get('password'),
+        server.get('inbound_id'),
+        str(server.get('api_token', '') or '').strip(),
+    )
+
+
+def _close_xui_client(client):
+    logging.info(f"Dropping pooled X-UI session for {client.base_url}")
     try:
-        with open('claimed_users.json', 'r') as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        return {}
-    
-    # Legacy format migration: if data contains strings (old format), convert to new format
-    migrated = False
-    for user_id, value in list(data.items()):
-        if isinstance(value, str):
-            # Old format: {user_id: link} -> new format
-            data[user_id] = {
-                "link": value,
-                "timestamp": int(time.time()),  # Assume "now" for legacy entries
-                "trial_type": "free",
-                "email": f"FreeTrial_{user_id}",
-                "server_name": "Unknown"
-            }
-            migrated = True
-    
-    if migrated:
-        save_trial_tracking(data)
-        logging.info("Migrated trial tracking data to new format")
-    
-    return data
+        asyncio.get_running_loop().create_task(client.aclose())
+    except RuntimeError:
+        # No running loop (startup/shutdown): sockets are released with the process.
+        pass
+
+
+def get_xui_client(server):
+    """Return the shared AsyncXUIClient for a server."""
+    key = _server_pool_key(server)
+    fingerprint = _server_fingerprint(server)
+    with _XUI_CLIENTS_LOCK:
+        entry = _XUI_CLIENTS.get(key)
+        if entry and entry[0] == fingerprint:
+            return entry[1]
+        client = AsyncXUIClient(server)
+        _XUI_CLIENTS[key] = (fingerprint, client)
+    if entry:
+        _close_xui_client(entry[1])
+    return client
+
+
+def invalidate_xui_clients(servers):
+    """Drop pooled clients for removed servers or servers whose credentials changed."""
+    wanted = {_server_pool_key(s): _server_fingerprint(s) for s in servers}
+    with _XUI_CLIENTS_LOCK:
+        stale = [key for key, (fingerprint, _) in _XUI_CLIENTS.items() if wanted.get(key) != fingerprint]
+        dropped = [_XUI_CLIENTS.pop(key)[1] for key in stale]
+    for client in dropped:
+        _close_xui_client(client)
+
+# --- CLIENT INDEX ---
+class ClientIndex:
+    """In-memory map of UUID / email / Telegram user ID -> where a client lives.
+
+    Entries are client records (common/panel_scan.py) keyed by (server_name,
+    email): inbound id, owner, quota, expiry and the usage seen in the last
+    snapshot. Every successful inbounds/list fetch is applied per server as a
+    diff, and our own add/delete/renew calls patch the index straight away, so
+    lookups no longer need to download every inbound.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}      # (server_name, email) -> entry
+        self._by_uuid = {}      # uuid -> {keys}
+        self._by_email = {}     # email -> {keys}
+        self._by_user = {}      # telegram user id -> {keys}
+        self._server_keys = {}  # server_name -> {keys}
+        self._changed = set()   # keys added/changed/removed since drain_changes()
+        self.refreshed_at = {}  # server_name -> unix time of last full snapshot
+
+    def _unlink(self, key, entry):
+        for mapping, value in ((self._by_uuid, entry['uuid']),
+                               (self._by_email, entry['email']),
+                               (self._by_user, entry['user_id'])):
+            keys = mapping.get(value)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    mapping.pop(value, None)
+
+    def _put(self, key, entry):
+        old = self._entries.get(key)
+        if old == entry:
+            return False
+        if old:
+            self._unlink(key, old)
+        self._entries[key] = entry
+        self._changed.add(key)
+        if entry['uuid']:
+            self._by_uuid.setdefault(entry['uuid'], set()).add(key)
+        self._by_email.setdefault(entry['email'], set()).add(key)
+        if entry['user_id']:
+            self._by_user.setdefault(entry['user_id'], set()).add(key)
+        self._server_keys.setdefault(entry['server_name'], set()).add(key)
+        return True
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._changed.add(key)
+            self._unlink(key, entry)
+            self._server_keys.get(entry['server_name'], set()).discard(key)
+        return entry
+
+    def replace_server(self, server_name, inbounds):
+        """Apply a full inbounds/list snapshot for one server. Returns (changed, removed)."""
+        fresh = {}
+        for inbound in inbounds:
+            for entry in inbound_records(server_name, inbound):
+                if entry['email']:
+                    fresh[(server_name, entry['email'])] = entry
+
+        with self._lock:
+            stale = set(self._server_keys.get(server_name, ())) - set(fresh)
+            changed = sum(1 for key, entry in fresh.items() if self._put(key, entry))
+            for key in stale:
+                self._drop(key)
+            self.refreshed_at[server_name] = int(time.time())
+        return changed, len(stale)
+
+    def upsert(self, server_name, inbound_id, client, stat=None):
+        entry = client_record(server_name, inbound_id, client, stat)
+        if not entry['email']:
+            return
+        with self._lock:
+            self._put((server_name, entry['email']), entry)
+
+    def remove(self, server_name, email):
+        with self._lock:
+            self._drop((server_name, str(email)))
+
+    def retain_servers(self, server_names):
+        """Forget servers that are no longer configured."""
+        keep = set(server_names)
+        with self._lock:
+            for server_name in [n for n in self._server_keys if n not in keep]:
+                for key in list(self._server_keys.pop(server_name, ())):
+                    self._drop(key)
+                self.refreshed_at.pop(server_name, None)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return dict(entry) if entry else None
+
+    def drain_changes(self):
+        """{key: entry copy, or None if removed} for everything changed since the last call."""
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            return {key: (dict(self._entries[key]) if key in self._entries else None) for key in changed}
+
+    def find(self, uuid=None, email=None):
+        """Return one entry matching uuid (preferred) or email, or None."""
+        with self._lock:
+            keys = self._by_uuid.get(str(uuid)) if uuid else None
+            if not keys and email:
+                keys = self._by_email.get(str(email))
+            if not keys:
+                return None
+            return dict(self._entries[sorted(keys)[0]])
+
+    def entries_for_user(self, user_id):
+        with self._lock:
+            return [dict(self._entries[k]) for k in sorted(self._by_user.get(int(user_id), ()))]
+
+    def servers_for_email(self, email):
+        with self._lock:
+            return {server_name for server_name, _ in self._by_email.get(str(email), ())}
+
+    def entries_on_server(self, server_name, prefix=''):
+        """Entries on one server whose email starts with `prefix`."""
+        with self._lock:
+            return [dict(self._entries[k]) for k in sorted(self._server_keys.get(server_name, ()))
+                    if k[1].startswith(prefix)]
+
+    def covers(self, server_names):
+        """True when every given server has had at least one full snapshot."""
+        return all(name in self.refreshed_at for name in server_names)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+CLIENT_INDEX = ClientIndex()
+
+
+async def refresh_client_index(context: ContextTypes.DEFAULT_TYPE):
+    """Background task: pull inbounds/list from every panel into CLIENT_INDEX."""
+    refresh_runtime_config()
+    CLIENT_INDEX.retain_servers([s.get('name') for s in SERVERS])
+
+    async def refresh_one(server):
+        # list_inbounds() applies the snapshot to the index on success.
+        inbounds = await get_xui_client(server).list_inbounds()
+        if inbounds is None:
+            logging.warning(f"Client index refresh failed on {server.get('name')}")
+
+    await gather_bounded(SERVERS, refresh_one, PANEL_SCAN_CONCURRENCY)
+    logging.info(f"📇 Client index refreshed: {len(CLIENT_INDEX)} clients on {len(CLIENT_INDEX.refreshed_at)} servers")
+
+    dropped = compact_notice_state(int(time.time()))
+    if dropped:
+        logging.info(f"🔔 Compacted {dropped} stale notice dedup entries")
+
+
+class NoticeScheduler:
+    """Min-heap of when each indexed client next needs an expiry or low-data reminder.
+
+    The next time is the earlier of:
+
+    * EXPIRY_NOTICE_DAYS before expiry;
+    * when the remaining data is projected to drop to LOW_DATA_NOTICE_GB, using
+      the usage rate seen between index snapshots;
+
+    never earlier than the NOTICE_COOLDOWN_SECONDS after the last reminder. The
+    heap is fed from CLIENT_INDEX.drain_changes(), so only clients whose panel
+    data changed are re-planned. Stale heap items are skipped lazily.
+    """
 
-def save_trial_tracking(data):
-    """Save trial tracking data."""
+    def __init__(self):
+        self._heap = []      # (fire_at, key)
+        self._due = {}       # key -> fire_at of its live heap item
+        self._usage = {}     # key -> (used_bytes, seen_at)
+        self._rate = {}      # key -> bytes per second
+
+    def _track_usage(self, key, entry, now):
+        used = entry['up'] + entry['down']
+        prev = self._usage.get(key)
+        self._usage[key] = (used, now)
+        if not prev or now <= prev[1]:
+            return
+        if used < prev[0]:
+            self._rate.pop(key, None)  # traffic reset (renewal)
+        elif used > prev[0]:
+            rate = (used - prev[0]) / (now - prev[1])
+            old = self._rate.get(key)
+            self._rate[key] = rate if old is None else (rate + old) / 2
+
+    def next_time(self, key, entry, now):
+        if not entry or not entry['user_id']:
+            return None
+        state = NOTICE_STATE.data.get(f"{entry['user_id']}:{entry['email']}", {})
+        times = []
+
+        expiry_s = entry['expiry'] // 1000
+        if expiry_s > now:
+            after = int(state.get('last_expiry_notice', 0) or 0) + NOTICE_COOLDOWN_SECONDS
+            at = max(expiry_s - EXPIRY_NOTICE_DAYS * 86400, after)
+            if at < expiry_s:
+                times.append(at)
+
+        if entry['total'] > 0:
+            margin = entry['total'] - entry['up'] - entry['down'] - LOW_DATA_NOTICE_GB * 1024 ** 3
+            rate = self._rate.get(key)
+            at = now if margin <= 0 else (now + int(margin / rate) if rate else None)
+            if at is not None:
+                times.append(max(at, int(state.get('last_low_data_notice', 0) or 0) + NOTICE_COOLDOWN_SECONDS))
+
+        return min(times) if times else None
+
+    def schedule(self, key, entry, now, at=None):
+        """(Re)plan one client; `at` overrides the computed time."""
+        at = self.next_time(key, entry, now) if at is None else at
+        if at is None:
+            self._due.pop(key, None)
+            return
+        if self._due.get(key) != at:
+            self._due[key] = at
+            heapq.heappush(self._heap, (at, key))
+
+    def apply_changes(self, changes, now):
+        for key, entry in changes.items():
+            if entry is None:
+                self._due.pop(key, None)
+                self._usage.pop(key, None)
+                self._rate.pop(key, None)
+                continue
+            self._track_usage(key, entry, now)
+            self.schedule(key, entry, now)
+        # Lazy deletion leaves dead items behind; rebuild once they dominate.
+        if len(self._heap) > 2 * len(self._due) + 1024:
+            self._heap = [(at, key) for key, at in self._due.items()]
+            heapq.heapify(self._heap)
+
+    def pop_due(self, now):
+        keys = []
+        while self._heap and self._heap[0][0] <= now:
+            at, key = heapq.heappop(self._heap)
+            if self._due.get(key) == at:
+                del self._due[key]
+                keys.append(key)
+        return keys
+
+    def __len__(self):
+        return len(self._due)
+
+
+NOTICE_SCHEDULER = NoticeScheduler()
+
+
+def build_notice_alert(entry, now):
+    """The reminder a client needs right now, or None (same rules as the old full scan)."""
+    gb = 1024 * 1024 * 1024
+    remaining = max(0, entry['total'] - entry['up'] - entry['down'])
+
+    days_left = None
+    expiring_soon = False
+    if entry['expiry'] > 0:
+        seconds_left = int(entry['expiry'] / 1000) - now
+        if seconds_left > 0:
+            days_left = max(0, seconds_left // 86400)
+            expiring_soon = seconds_left <= (EXPIRY_NOTICE_DAYS * 86400)
+
+    low_data_soon = entry['total'] > 0 and remaining <= (LOW_DATA_NOTICE_GB * gb)
+
+    if not (expiring_soon or low_data_soon):
+        return None
+    return {
+        'user_id': entry['user_id'],
+        'email': entry['email'],
+        'server_name': entry['server_name'],
+        'days_left': days_left,
+        'remaining_gb': round(remaining / gb, 2),
+        'reasons': {
+            'expiry': expiring_soon,
+            'low_data': low_data_soon,
+        }
+    }
+
+
+class ServerLoadTracker:
+    """In-memory per-server load used to pick where new keys go.
+
+    Tracks the active-client count, whether the panel answered the last time we
+    asked, and a moving average of add_client latency. refresh_server_loads
+    updates it in the background and every add_client call reports into it,
+    so server selection never has to wait on the network.
+    """
+
+    LATENCY_SMOOTHING = 0.3
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers = {}  # server_name -> load dict
+
+    def _load(self, server_name):
+        return self._servers.setdefault(server_name, {
+            'active_count': None,
+            'reachable': False,
+            'add_latency': None,
+            'updated_at': 0,
+        })
+
+    def record_count(self, server_name, active_count):
+        with self._lock:
+            load = self._load(server_name)
+            load.update(active_count=active_count, reachable=True, updated_at=int(time.time()))
+
+    def record_failure(self, server_name):
+        with self._lock:
+            load = self._load(server_name)
+            load.update(reachable=False, updated_at=int(time.time()))
+
+    def record_add(self, server_name, seconds, ok, created):
+        """Fold one add_client call in; `created` is True when a new client was added."""
+        with self._lock:
+            load = self._load(server_name)
+            prev = load['add_latency']
+            a = self.LATENCY_SMOOTHING
+            load['add_latency'] = seconds if prev is None else (a * seconds + (1 - a) * prev)
+            if created and load['active_count'] is not None:
+                load['active_count'] += 1
+            load['reachable'] = ok
+
+    def get(self, server_name):
+        with self._lock:
+            load = self._servers.get(server_name)
+            return dict(load) if load else None
+
+    def retain_servers(self, server_names):
+        keep = set(server_names)
+        with self._lock:
+            for server_name in [n for n in self._servers if n not in keep]:
+                self._servers.pop(server_name, None)
+
+
+SERVER_LOADS = ServerLoadTracker()
+
+
+async def refresh_server_loads(context: ContextTypes.DEFAULT_TYPE):
+    """Background task: measure every profile-generation server concurrently."""
+    servers = get_profile_generation_servers()
+    SERVER_LOADS.retain_servers([get_xui_client(s).server_name for s in SERVERS])
+    await asyncio.gather(*(get_server_active_client_count(s) for s in servers), return_exceptions=True)
+
+
+class TrialPool:
+    """Disabled, ownerless trial clients kept ready on every generation server.
+
+    fill() tops each server up to TRIAL_POOL_SIZE WarmTrial_ clients with one
+    addClient call. claim() binds one to a user with a single updateClient call
+    and refills that server in the background. The pool is simply the
+    WarmTrial_ clients CLIENT_INDEX sees on the panels, so it survives restarts
+    without a store of its own.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._reserved = set()  # (server_name, email) being claimed right now
+        self._filling = set()   # server names with a fill in flight
+        self._tasks = set()
+        self.claimed = 0
+        self.missed = 0
+
+    def available(self, server_name):
+        return [e for e in CLIENT_INDEX.entries_on_server(server_name, WARM_TRIAL_PREFIX)
+                if not e['enable'] and (server_name, e['email']) not in self._reserved]
+
+    async def fill_server(self, server):
+        client = get_xui_client(server)
+        name = client.server_name
+        # Without a full snapshot we cannot tell how many are already there.
+        if name in self._filling or server_is_down(server) or name not in CLIENT_INDEX.refreshed_at:
+            return 0
+        missing = self.size - len(self.available(name))
+        if missing <= 0:
+            return 0
+        self._filling.add(name)
+        try:
+            added = await client.add_warm_clients(missing, FREE_TRIAL_LIMIT_GB)
+        finally:
+            self._filling.discard(name)
+        if added:
+            logging.info(f"🧊 Added {added} warm trial key(s) on {name}")
+        return added
+
+    async def fill(self, context: ContextTypes.DEFAULT_TYPE = None):
+        """Background task: top up the pool on every profile-generation server."""
+        await gather_bounded(get_profile_generation_servers(), self.fill_server, PANEL_SCAN_CONCURRENCY)
+
+    def _refill_soon(self, server):
+        task = asyncio.get_running_loop().create_task(self.fill_server(server))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def claim(self, email):
+        """Hand a warm client to `email`; returns (link, server), or (None, None) on a miss.
+
+        Picks the least-loaded server that has one ready, from SERVER_LOADS only.
+        """
+        ready = []
+        for server in get_profile_generation_servers():
+            name = get_xui_client(server).server_name
+            records = [] if server_is_down(server) else self.available(name)
+            if records:
+                count = (SERVER_LOADS.get(name) or {}).get('active_count')
+                ready.append((count if count is not None else 10 ** 9, server, records[0]))
+        if not ready:
+            self.missed += 1
+            return None, None
+
+        _, server, record = min(ready, key=lambda item: item[0])
+        client = get_xui_client(server)
+        key = (client.server_name, record['email'])
+        self._reserved.add(key)
+        try:
+            link = await client.claim_warm_client(record, email, FREE_TRIAL_LIMIT_GB, FREE_TRIAL_EXPIRE_DAYS)
+        except Exception as e:
+            logging.warning(f"Warm trial claim on {client.server_name} failed: {e}")
+            link = None
+        finally:
+            self._reserved.discard(key)
+        self._refill_soon(server)
+        if not link:
+            self.missed += 1
+            return None, None
+        self.claimed += 1
+        return link, server
+
+
+TRIAL_POOL = TrialPool(TRIAL_POOL_SIZE)
+
+
+# --- TRIAL TRACKING ---
+# One row per Telegram user in trials.db (see common/trial_store.py): link,
+# email, server_name, trial_type ("free" or "premium") and the unix timestamp
+# the trial was issued. Used to auto-delete free trials after 3 days and to
+# stop users from claiming more than one.
+TRIALS = TrialStore()
+
+
+async def find_first_across_servers(servers, probe, deadline=LOOKUP_DEADLINE_SECONDS):
+    """Run `probe(server)` on all servers concurrently and return (server, result) for
+    the first truthy result, cancelling the remaining probes.
+
+    Returns (None, None) when nothing matches or the deadline expires, so a dead
+    panel costs at most `deadline` seconds instead of adding to every lookup.
+    """
+    down = [s.get('name') for s in servers if server_is_down(s)]
+    if down:
+        logging.info(f"Cross-server lookup skipping circuit-open panels: {down}")
+        servers = [s for s in servers if not server_is_down(s)]
+    if not servers:
+        return None, None
+
+    loop = asyncio.get_running_loop()
+    tasks = {asyncio.create_task(probe(server)): server for server in servers}
+    pending = set(tasks)
+    give_up_at = loop.time() + deadline
     try:
-        with open('claimed_users.json', 'w') as f:
-            json.dump(data, f, indent=2)
-    except Exception as e:
-        logging.error(f"Failed to save trial tracking: {e}")
+        while pending:
+            remaining = give_up_at - loop.time()
+            if remaining <= 0:
+                waiting = [tasks[t].get('name') for t in pending]
+                logging.warning(f"Cross-server lookup deadline hit; still waiting on {waiting}")
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    continue
+                if task.exception():
+                    logging.warning(f"Lookup on {tasks[task].get('name')} failed: {task.exception()}")
+                    continue
+                result = task.result()
+                if result:
+                    return tasks[task], result
+        return None, None
+    finally:
+        for task in pending:
+            task.cancel()
 
 
-def find_client_by_uuid(target_uuid: str):
+async def find_client_by_uuid(target_uuid: str):
     """Search every server for a client UUID.
-    Returns (server_config, XUIClient_instance, email) or (None, None, None)."""
+    Returns (server_config, AsyncXUIClient_instance, email) or (None, None, None)."""
     refresh_runtime_config()
-    for server in SERVERS:
-        try:
-            client = XUIClient(server)
-            stats  = client.get_client_stats(target_uuid)
-            if stats:
-                return server, client, stats['email']
-        except Exception:
-            continue
+    entry = CLIENT_INDEX.find(uuid=target_uuid)
+    server = find_server_by_name(entry['server_name']) if entry else None
+    if server:
+        return server, get_xui_client(server), entry['email']
+
+    async def probe(server):
+        return await get_xui_client(server).get_client_stats(target_uuid)
+
+    server, stats = await find_first_across_servers(SERVERS, probe)
+    if server:
+        return server, get_xui_client(server), stats['email']
     return None, None, None
 
 
-def find_client_by_email(target_email: str):
+async def find_client_by_email(target_email: str):
     """Search every server for a client by email/remark."""
     if not target_email:
         return None, None, None
     refresh_runtime_config()
-    for server in SERVERS:
-        try:
-            client = XUIClient(server)
-            stats = client.get_client_stats_by_email(target_email)
-            if stats:
-                return server, client, stats['email']
-        except Exception:
-            continue
+    entry = CLIENT_INDEX.find(email=target_email)
+    server = find_server_by_name(entry['server_name']) if entry else None
+    if server:
+        return server, get_xui_client(server), entry['email']
+
+    async def probe(server):
+        return await get_xui_client(server).get_client_stats_by_email(target_email)
+
+    server, stats = await find_first_across_servers(SERVERS, probe)
+    if server:
+        return server, get_xui_client(server), stats['email']
     return None, None, None
 
 
@@ -884,14 +1521,14 @@ def parse_vless_identifiers(link_text: str):
     return uuid_val, email_val
 
 
-def find_client_from_vless(link_text: str):
+async def find_client_from_vless(link_text: str):
     uuid_val, email_val = parse_vless_identifiers(link_text)
     if uuid_val:
-        s, c, e = find_client_by_uuid(uuid_val)
+        s, c, e = await find_client_by_uuid(uuid_val)
         if s:
             return s, c, e, uuid_val
     if email_val:
-        s, c, e = find_client_by_email(email_val)
+        s, c, e = await find_client_by_email(email_val)
         if s:
             return s, c, e, uuid_val
     return None, None, None, uuid_val
@@ -905,56 +1542,93 @@ async def cleanup_expired_trials(application: Application):
     logging.info("🧹 Starting expired trial cleanup task...")
     
     try:
-        tracking = load_trial_tracking()
         current_time = int(time.time())
         three_days_seconds = 3 * 24 * 60 * 60  # 259200 seconds
         
         deleted_count = 0
-        
-        for user_id, trial_info in list(tracking.items()):
-            if isinstance(trial_info, dict):
-                trial_timestamp = trial_info.get('timestamp', 0)
-                email = trial_info.get('email', '')
-                server_name = trial_info.get('server_name', '')
-                trial_type = trial_info.get('trial_type', 'free')
-                
-                # Only auto-delete FREE trials after 3 days
-                if trial_type == 'free' and (current_time - trial_timestamp) >= three_days_seconds:
-                    logging.info(f"Deleting expired trial for user {user_id} (email: {email}, age: {(current_time - trial_timestamp)/86400:.1f} days)")
-                    
-                    # Find and delete the account from all servers
-                    delete_success = False
-                    for server in SERVERS:
-                        try:
-                            client = XUIClient(server)
-                            if client.delete_client_by_email(email):
-                                delete_success = True
-                                logging.info(f"✅ Deleted {email} from {server.get('name')}")
-                        except Exception as e:
-                            logging.warning(f"Failed to delete from {server.get('name')}: {e}")
-                    
-                    if delete_success:
-                        # Remove from tracking
-                        del tracking[user_id]
-                        deleted_count += 1
-                        
-                        # Try to notify user
-                        try:
-                            await application.bot.send_message(
-                                chat_id=int(user_id),
-                                text=(
-                                    "⏰ <b>Free Trial Expired</b>\n\n"
-                                    "Your 3-day free trial has expired and the account has been deleted.\n\n"
-                                    "💎 Want to continue using VPN?\n"
-                                    "👉 /start and select 'Premium' to get a 1-month plan!"
-                                ),
-                                parse_mode='HTML'
-                            )
-                        except Exception as e:
-                            logging.warning(f"Failed to notify user {user_id} about trial expiration: {e}")
+        expired = {}  # email -> (user_id, recorded server_name)
+
+        # Only auto-delete FREE trials after 3 days
+        for trial in TRIALS.older_than('free', current_time - three_days_seconds):
+            user_id, email = trial['user_id'], trial['email']
+            if email:
+                logging.info(f"Deleting expired trial for user {user_id} (email: {email}, age: {(current_time - trial['timestamp'])/86400:.1f} days)")
+                expired[email] = (user_id, trial['server_name'])
+
+        # Group by the server each trial lives on (index first, then the recorded
+        # server_name) so every server gets one inbound fetch and one update.
+        # Only emails a confirmed inbound update removed count as deleted; one
+        # the index doesn't know is looked for on the panels, and if no panel
+        # removes it, it stays tracked for the next run.
+        servers_by_name = {s.get('name'): s for s in SERVERS}
+        groups = {}     # server_name -> [emails]
+        tried = {}      # email -> {server_name}
+        deleted = set()
+        deferred = set()
+        for email, (user_id, recorded) in expired.items():
+            names = CLIENT_INDEX.servers_for_email(email) & set(servers_by_name)
+            if not names and recorded in servers_by_name:
+                names = {recorded}
+            for name in names:
+                groups.setdefault(name, []).append(email)
+                tried.setdefault(email, set()).add(name)
+
+        async def delete_batch(server, emails):
+            if not emails:
+                return set()
+            if server_is_down(server):
+                # Leave these for the next run rather than waiting on a dead panel.
+                logging.warning(f"Skipping delete of {len(emails)} trial(s) on {server.get('name')}: panel circuit open")
+                deferred.update(emails)
+                return set()
+            try:
+                removed = await get_xui_client(server).delete_clients_by_emails(emails)
+            except Exception as e:
+                logging.warning(f"Failed to delete from {server.get('name')}: {e}")
+                return set()
+            if removed:
+                logging.info(f"✅ Deleted {len(removed)} expired trial(s) from {server.get('name')}")
+            return removed
+
+        for removed in await asyncio.gather(*(delete_batch(servers_by_name[n], em) for n, em in groups.items())):
+            deleted |= removed
+
+        # Anything not found where we expected it: one batch per remaining server.
+        leftover = [e for e in expired if e not in deleted and e not in deferred]
+        if leftover:
+            fallback = [
+                delete_batch(server, [e for e in leftover if name not in tried.get(e, ())])
+                for name, server in servers_by_name.items()
+            ]
+            for removed in await asyncio.gather(*fallback):
+                deleted |= removed
+
+        # Remove from tracking
+        TRIALS.delete(expired[email][0] for email in deleted)
+        notices = {}
+        for email in deleted:
+            user_id = expired[email][0]
+            deleted_count += 1
+
+            # Try to notify user
+            notices[user_id] = OUTBOX.submit(
+                application.bot.send_message,
+                int(user_id),
+                priority=PRIORITY_NOTICE,
+                text=(
+                    "⏰ <b>Free Trial Expired</b>\n\n"
+                    "Your 3-day free trial has expired and the account has been deleted.\n\n"
+                    "💎 Want to continue using VPN?\n"
+                    "👉 /start and select 'Premium' to get a 1-month plan!"
+                ),
+                parse_mode='HTML'
+            )
+        results = await asyncio.gather(*notices.values(), return_exceptions=True)
+        for user_id, result in zip(notices, results):
+            if isinstance(result, Exception):
+                logging.warning(f"Failed to notify user {user_id} about trial expiration: {result}")
         
         if deleted_count > 0:
-            save_trial_tracking(tracking)
             logging.info(f"✅ Cleanup complete: {deleted_count} expired trials deleted")
         else:
             logging.info("✅ Cleanup complete: No expired trials found")
@@ -964,63 +1638,98 @@ async def cleanup_expired_trials(application: Application):
 
 
 async def notify_expiring_or_low_data_keys(context: ContextTypes.DEFAULT_TYPE):
-    """Background task: notify customers before key expiry or data depletion."""
-    try:
-        alerts = collect_notice_candidates()
-        if not alerts:
-            logging.info("🔔 Notice job: no users need reminder")
-            return
+    """Background task: notify customers before key expiry or data depletion.
 
-        notice_state = load_notice_state()
+    Runs every NOTICE_TICK_SECONDS but only looks at clients NOTICE_SCHEDULER
+    says are due; the panel data comes from CLIENT_INDEX, not a fresh scan.
+    """
+    try:
         now = int(time.time())
-        sent_count = 0
-
-        for alert in alerts:
-            user_id = alert['user_id']
-            email = alert['email']
-            dedup_key = f"{user_id}:{email}"
+        NOTICE_SCHEDULER.apply_changes(CLIENT_INDEX.drain_changes(), now)
+        due = NOTICE_SCHEDULER.pop_due(now)
+        if not due:
+            return
 
-            user_state = notice_state.get(dedup_key, {})
-            expiry_ok = True
-            low_data_ok = True
+        active = {s.get('name') for s in get_active_servers()}
+        alerts = []
+        for key in due:
+            entry = CLIENT_INDEX.get(key)
+            if entry and entry['server_name'] not in active:
+                NOTICE_SCHEDULER.schedule(key, entry, now, at=now + NOTICE_RETRY_SECONDS)
+                continue
+            alert = build_notice_alert(entry, now) if entry else None
+            if alert:
+                alert['key'] = key
+                alerts.append(alert)
+            else:
+                # Woken by a usage projection that hasn't come true (yet).
+                NOTICE_SCHEDULER.schedule(key, entry, now)
 
-            if alert['reasons']['expiry']:
-                last_expiry = int(user_state.get('last_expiry_notice', 0) or 0)
-                expiry_ok = (now - last_expiry) >= NOTICE_COOLDOWN_SECONDS
-            if alert['reasons']['low_data']:
-                last_data = int(user_state.get('last_low_data_notice', 0) or 0)
-                low_data_ok = (now - last_data) >= NOTICE_COOLDOWN_SECONDS
+        notice_state = NOTICE_STATE.data
+        sent_count = 0
+        queued = []  # (alert, dedup_key, expiry_ok, low_data_ok, future)
+        queued_keys = set()
 
-            if not (expiry_ok or low_data_ok):
-                continue
+        try:
+            for alert in alerts:
+                user_id = alert['user_id']
+                email = alert['email']
+                dedup_key = f"{user_id}:{email}"
+                if dedup_key in queued_keys:
+                    continue  # same key on two servers: one reminder is enough
+
+                user_state = notice_state.get(dedup_key, {})
+                expiry_ok = True
+                low_data_ok = True
+
+                if alert['reasons']['expiry']:
+                    last_expiry = int(user_state.get('last_expiry_notice', 0) or 0)
+                    expiry_ok = (now - last_expiry) >= NOTICE_COOLDOWN_SECONDS
+                if alert['reasons']['low_data']:
+                    last_data = int(user_state.get('last_low_data_notice', 0) or 0)
+                    low_data_ok = (now - last_data) >= NOTICE_COOLDOWN_SECONDS
+
+                if not (expiry_ok or low_data_ok):
+                    continue
 
-            reasons_text = []
-            if alert['reasons']['expiry'] and expiry_ok:
-                days_left = alert.get('days_left')
-                if days_left is not None:
-                    reasons_text.append(f"⏳ Key သက်တမ်း {days_left} ရက်ခန့်သာ ကျန်ပါသည်")
-            if alert['reasons']['low_data'] and low_data_ok:
-                reasons_text.append(f"📉 Data လက်ကျန် {alert.get('remaining_gb', 0)} GB ခန့်သာ ကျန်ပါသည်")
+                reasons_text = []
+                if alert['reasons']['expiry'] and expiry_ok:
+                    days_left = alert.get('days_left')
+                    if days_left is not None:
+                        reasons_text.append(f"⏳ Key သက်တမ်း {days_left} ရက်ခန့်သာ ကျန်ပါသည်")
+                if alert['reasons']['low_data'] and low_data_ok:
+                    reasons_text.append(f"📉 Data လက်ကျန် {alert.get('remaining_gb', 0)} GB ခန့်သာ ကျန်ပါသည်")
 
-            if not reasons_text:
-                continue
+                if not reasons_text:
+                    continue
+                queued_keys.add(dedup_key)
 
-            msg = (
-                "🔔 <b>VPN အသိပေးချက်</b>\n\n"
-                f"🖥 <b>Server:</b> {alert['server_name']}\n"
-                f"👤 <b>Key:</b> <code>{email}</code>\n\n"
-                + "\n".join(reasons_text) +
-                "\n\n💎 <b>ဆက်လက်အသုံးပြုရန် Premium Plan (1-6 months) ဝယ်နိုင်ပါသည်။</b>\n"
-                "👉 /start ကိုနှိပ်ပြီး <b>Premium ဝယ်ယူမယ် (1-6 months)</b> ကိုရွေးပါ။"
-            )
+                msg = (
+                    "🔔 <b>VPN အသိပေးချက်</b>\n\n"
+                    f"🖥 <b>Server:</b> {alert['server_name']}\n"
+                    f"👤 <b>Key:</b> <code>{email}</code>\n\n"
+                    + "\n".join(reasons_text) +
+                    "\n\n💎 <b>ဆက်လက်အသုံးပြုရန် Premium Plan (1-6 months) ဝယ်နိုင်ပါသည်။</b>\n"
+                    "👉 /start ကိုနှိပ်ပြီး <b>Premium ဝယ်ယူမယ် (1-6 months)</b> ကိုရွေးပါ။"
+                )
 
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
+                future = OUTBOX.submit(
+                    context.bot.send_message,
+                    user_id,
+                    priority=PRIORITY_NOTICE,
                     text=msg,
                     parse_mode='HTML',
                     reply_markup=MAIN_MENU_KB
                 )
+                queued.append((alert, dedup_key, expiry_ok, low_data_ok, future))
+
+            # Sent in parallel within Telegram's limits; only delivered notices start a cooldown.
+            results = await asyncio.gather(*(q[-1] for q in queued), return_exceptions=True)
+            for (alert, dedup_key, expiry_ok, low_data_ok, _), result in zip(queued, results):
+                if isinstance(result, Exception):
+                    logging.warning(f"Failed to send notice to {alert['user_id']} for {alert['email']}: {result}")
+                    alert['retry'] = True
+                    continue
                 sent_count += 1
 
                 state_item = notice_state.setdefault(dedup_key, {})
@@ -1029,12 +1738,15 @@ async def notify_expiring_or_low_data_keys(context: ContextTypes.DEFAULT_TYPE):
                 if alert['reasons']['low_data'] and low_data_ok:
                     state_item['last_low_data_notice'] = now
 
-            except Exception as e:
-                logging.warning(f"Failed to send notice to {user_id} for {email}: {e}")
-
-        if sent_count > 0:
-            save_notice_state(notice_state)
-        logging.info(f"🔔 Notice job complete. Sent reminders: {sent_count}")
+            if sent_count > 0:
+                NOTICE_STATE.mark_dirty()
+        finally:
+            # Plan each client's next reminder from the cooldowns just recorded,
+            # even when the run is cut short by its time budget.
+            for alert in alerts:
+                retry_at = now + NOTICE_RETRY_SECONDS if alert.get('retry') else None
+                NOTICE_SCHEDULER.schedule(alert['key'], CLIENT_INDEX.get(alert['key']), now, at=retry_at)
+        logging.info(f"🔔 Notice job: {len(due)} due, sent reminders: {sent_count}, {len(NOTICE_SCHEDULER)} scheduled")
 
     except Exception as e:
         logging.error(f"Error in notify_expiring_or_low_data_keys: {e}")
@@ -1056,13 +1768,64 @@ def parse_payment_slip(text_from_image):
 
 # --- TELEGRAM BOT LOGIC ---
 
+async def send_to_admins(call, what, **kwargs):
+    """Send the same message to every admin at once, through OUTBOX.
+
+    Returns [(chat_id, message_id)] of the copies that were delivered.
+    """
+    futures = [OUTBOX.submit(call, admin_id, priority=PRIORITY_ADMIN, **kwargs) for admin_id in ADMIN_IDS]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    copies = []
+    for admin_id, result in zip(ADMIN_IDS, results):
+        if isinstance(result, Exception):
+            logging.error(f"Failed to send {what} to admin {admin_id}: {result}")
+        else:
+            logging.info(f"Sent {what} to admin {admin_id}")
+            copies.append((admin_id, result.message_id))
+    return copies
+
+
+async def forward_slip(kind, user_id, pending, reply, call, what, **kwargs):
+    """Confirm to the customer and send the slip to every admin, all at once.
+
+    The admins' message ids are saved with the pending slip so approval and
+    decline can update every copy, not just the one that was tapped.
+    """
+    _, copies = await asyncio.gather(reply, send_to_admins(call, what, **kwargs))
+    current = PENDING.get(kind, user_id)
+    # Unless an admin already acted on it (or a newer slip replaced it).
+    if current and current.get('slip_id') == pending.get('slip_id'):
+        PENDING.put(kind, user_id, dict(current, admin_copies=copies))
+
+
+def slip_copies(pending, query):
+    """(chat_id, message_id) of every admin's copy of a slip, including the tapped one."""
+    copies = {tuple(c) for c in (pending or {}).get('admin_copies', [])}
+    copies.add((query.message.chat_id, query.message.message_id))
+    return sorted(copies)
+
+
+async def edit_slip_copies(bot, copies, caption):
+    """Set the same caption (and drop the buttons) on every admin's copy of a slip."""
+    futures = [
+        OUTBOX.submit(bot.edit_message_caption, chat_id, priority=PRIORITY_ADMIN,
+                      message_id=message_id, caption=caption, parse_mode='HTML')
+        for chat_id, message_id in copies
+    ]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    for (chat_id, message_id), result in zip(copies, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Caption edit failed on admin {chat_id}'s slip {message_id}: {result}")
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Send the greeting and inline menu as a single message.
     await update.message.reply_html(GREETING_TEXT, reply_markup=InlineKeyboardMarkup(MAIN_INLINE_KB))
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    photo_file = await update.message.photo[-1].get_file()
+    # Only the file_id is forwarded, so there is no need for a get_file() round trip.
+    photo_file_id = update.message.photo[-1].file_id
 
     # ── Renewal slip ──────────────────────────────────────────────────────────
     if context.user_data.get('state') == 'awaiting_renew_slip':
@@ -1070,10 +1833,11 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.pop('state', None)
         context.user_data.pop('renew_info', None)
 
-        # Store pending renewal in bot_data so approval_handler can access it
-        context.bot_data.setdefault('renew_pending', {})[str(user.id)] = renew_info
+        # Store pending renewal durably so approval_handler can access it, even after a restart
+        renew_info['slip_id'] = secrets.token_hex(4)
+        PENDING.put('renew', user.id, renew_info)
 
-        await update.message.reply_text(
+        reply = update.message.reply_text(
             "⏳ <b>ငွေလွှဲပြေစာကို Admin သို့ ပေးပို့ပြီးပါပြီ။</b>\n\n"
             "Admin မှ စစ်ဆေးပြီးပါက Key သက်တမ်း အလိုအလျောက် တိုးပေးပါမည်။\n"
             "Admin ကိုဆက်သွယ်ရန် @payifyoulike",
@@ -1091,33 +1855,33 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"💵 <b>Expected Amount:</b> {renew_info.get('total_ks', 5000):,} Ks"
         )
         keyboard = [[
-            InlineKeyboardButton("✅ Approve Renewal", callback_data=f'rnw_ok_{user.id}'),
-            InlineKeyboardButton("❌ Decline",         callback_data=f'rnw_no_{user.id}')
+            InlineKeyboardButton("✅ Approve Renewal", callback_data=f"rnw_ok_{user.id}_{renew_info['slip_id']}"),
+            InlineKeyboardButton("❌ Decline",         callback_data=f"rnw_no_{user.id}_{renew_info['slip_id']}")
         ]]
-        for admin_id in ADMIN_IDS:
-            try:
-                await context.bot.send_photo(
-                    chat_id=admin_id, photo=photo_file.file_id,
-                    caption=caption, parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-            except Exception as e:
-                logging.error(f"Failed to send renewal slip to admin {admin_id}: {e}")
+        await forward_slip(
+            'renew', user.id, renew_info, reply,
+            context.bot.send_photo, "renewal slip",
+            photo=photo_file_id, caption=caption, parse_mode='HTML',
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
         return
 
     # ── Normal new-purchase slip ───────────────────────────────────────────────
     selected_months = int(context.user_data.get('purchase_months', 1))
     plan = calculate_plan(selected_months)
-    context.bot_data.setdefault('purchase_pending', {})[str(user.id)] = {
+    slip_id = secrets.token_hex(4)
+    pending = {
+        'slip_id': slip_id,
         'months': plan['months'],
         'total_ks': plan['total_ks'],
         'total_gb': plan['total_gb'],
         'total_days': plan['total_days'],
     }
+    PENDING.put('purchase', user.id, pending)
     context.user_data.pop('state', None)
     context.user_data.pop('purchase_months', None)
 
-    await update.message.reply_text(
+    reply = update.message.reply_text(
         "⏳ <b>ငွေလွှဲပြေစာကို Admin သို့ ပေးပို့ထားပါသည်။</b>\n\n"
         "Admin မှ စစ်ဆေးပြီးပါက Key အလိုအလျောက် ရောက်ရှိလာပါမည်။ ခေတ္တစောင့်ဆိုင်းပေးပါ။\n\n"
         "Admin ကိုဆက်သွယ်ရန် နှိပ်ပါ 👇\n@payifyoulike",
@@ -1133,44 +1897,230 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"💵 <b>Expected Amount:</b> {plan['total_ks']:,} Ks"
     )
     keyboard = [[
-        InlineKeyboardButton("✅ Approve", callback_data=f"approve_{user.id}_{plan['months']}"),
-        InlineKeyboardButton("❌ Decline", callback_data=f'decline_{user.id}')
+        InlineKeyboardButton("✅ Approve", callback_data=f"approve_{user.id}_{plan['months']}_{slip_id}"),
+        InlineKeyboardButton("❌ Decline", callback_data=f'decline_{user.id}_{slip_id}')
     ]]
-    for admin_id in ADMIN_IDS:
+    await forward_slip(
+        'purchase', user.id, pending, reply,
+        context.bot.send_photo, "payment slip",
+        photo=photo_file_id,
+        caption=caption,
+        parse_mode='HTML',
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def provision_purchase(bot, job):
+    """Issue the premium key for an approved slip and send it to the customer."""
+    payload = job['payload']
+    plan, email, user_id = payload['plan'], payload['email'], job['user_id']
+
+    # A server the index already shows this client on goes first: add_client
+    # returns it there as a duplicate instead of issuing a second key. The
+    # server an earlier attempt pinned comes next, unless its circuit is open;
+    # the rest follow in load order.
+    indexed = CLIENT_INDEX.servers_for_email(email)
+    pinned = payload.get('server')
+    servers = sorted(
+        await get_round_robin_servers(),
+        key=lambda s: (s.get('name') not in indexed, s.get('name') != pinned),
+    )
+
+    link = target_server = None
+    for server in servers:
+        name = server.get('name')
+        if name not in indexed and server_is_down(server):
+            continue
+        if name != payload.get('server'):
+            PROVISIONING.update_payload(job['job_key'], server=name)
+            payload['server'] = name
         try:
-            await context.bot.send_photo(
-                chat_id=admin_id,
-                photo=photo_file.file_id,
-                caption=caption,
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
+            link, _existed = await get_xui_client(server).add_client(
+                email=email,
+                limit_gb=plan['total_gb'],
+                expire_days=plan['total_days']
+            )
+        except Exception as server_error:
+            logging.warning(f"Premium key generation failed on {name}: {server_error}")
+            link = None
+        if link:
+            target_server = server
+            break
+        if name in indexed:
+            # The client exists on this panel; retry it later rather than
+            # creating another one elsewhere.
+            break
+    if not link:
+        raise RuntimeError("no server could issue the key")
+
+    try:
+        await OUTBOX.send(
+            bot.send_message, user_id,
+            text=(
+                "✅ <b>ငွေလွှဲအောင်မြင်ပါသည်။</b>\n\n"
+                f"💎 <b>Premium Key ({plan['months']} Month / {plan['total_gb']}GB):</b>\n"
+                f"Server: {target_server.get('name')}\n"
+                f"Duration: {plan['total_days']} days\n"
+                "👇 <b>အောက်ပါ Key ကို Copy ယူပါ:</b>"
+            ),
+            parse_mode='HTML'
+        )
+        await OUTBOX.send(bot.send_message, user_id, text=f"<code>{link}</code>", parse_mode='HTML')
+        await OUTBOX.send(
+            bot.send_message, user_id,
+            text="👆 <b>Key ကို Copy ယူပါ။</b>\n\nအသုံးပြုနည်းကြည့်ရန် /start ကိုနှိပ်ပြီး\n'❓ ဘယ်လိုသုံးရမလဲ' ကို ရွေးပါ။",
+            parse_mode='HTML',
+            reply_markup=MAIN_MENU_KB
+        )
+        delivered = True
+    except telegram.error.Forbidden:
+        delivered = False
+    return {'server': target_server.get('name'), 'link': link, 'delivered': delivered}
+
+
+async def provision_renewal(bot, job):
+    """Extend an approved renewal's key and tell the customer."""
+    payload = job['payload']
+    user_id = job['user_id']
+    target_uuid = payload['uuid']
+    server_name = payload.get('server_name', '')
+    renew_days = int(payload.get('total_days', 30))
+    renew_gb = int(payload.get('total_gb', 100))
+
+    # Find the right server and extend
+    success = False
+    expiry_date = ''
+    server = find_server_by_name(server_name)
+    if server:
+        try:
+            success, expiry_date = await get_xui_client(server).reset_and_extend_client(
+                target_uuid,
+                expire_days=renew_days,
+                limit_gb=renew_gb
             )
         except Exception as e:
-            logging.error(f"Failed to send to admin {admin_id}: {e}")
+            logging.error(f"Renew on {server_name} failed: {e}")
+
+    # Fallback: try other servers if name didn't match or failed
+    if not success:
+        server_obj, xui, resolved_email = await find_client_by_uuid(target_uuid)
+        if server_obj and server_obj.get('vpn_block_renewals', False):
+            xui = None
+        if xui:
+            success, expiry_date = await xui.reset_and_extend_client(
+                target_uuid,
+                expire_days=renew_days,
+                limit_gb=renew_gb
+            )
+    if not success:
+        raise RuntimeError(f"extend failed for UUID {target_uuid}: {expiry_date}")
+
+    try:
+        await OUTBOX.send(
+            bot.send_message, user_id,
+            text=(
+                "✅ <b>Key သက်တမ်းတိုးခြင်း အောင်မြင်ပါသည်။</b>\n\n"
+                f"👤 <b>Email:</b> <code>{payload.get('email', '')}</code>\n"
+                f"📅 <b>Plan:</b> {int(payload.get('months', 1))} month(s)\n"
+                f"📅 <b>New Expiry:</b> {expiry_date}\n"
+                f"📦 <b>Data:</b> {renew_gb}GB (Reset to 0)\n\n"
+                "Key အတူတူပဲ ဆက်သုံးနိုင်ပါပြီ။"
+            ),
+            parse_mode='HTML',
+            reply_markup=MAIN_MENU_KB
+        )
+        delivered = True
+    except telegram.error.Forbidden:
+        delivered = False
+    return {'expiry': expiry_date, 'delivered': delivered}
+
+
+async def run_provision_job(bot, job):
+    """PROVISION_WORKERS handler: raising makes the worker retry the job later."""
+    if job['kind'] == 'renew':
+        return await provision_renewal(bot, job)
+    return await provision_purchase(bot, job)
+
+
+async def finish_provision_job(bot, job):
+    """Report a finished job on every admin's copy of the slip (and to the customer if it failed)."""
+    payload, result = job['payload'], job['result']
+    if job['status'] == 'done' and job['kind'] == 'renew':
+        status = f"✅ <b>RENEWAL APPROVED</b>\n📅 Extended until {result.get('expiry')}"
+    elif job['status'] == 'done':
+        status = f"✅ <b>APPROVED</b>\n🔑 Key issued on {html.escape(str(result.get('server')))}"
+    else:
+        status = (f"❌ <b>{'RENEWAL' if job['kind'] == 'renew' else 'KEY'} FAILED</b> "
+                  f"after {job['attempts']} attempt(s)\n{html.escape(job['error'][:200])}")
+    if job['status'] == 'done' and not result.get('delivered', True):
+        status += "\n⚠️ Customer has blocked the bot; message not delivered."
+
+    copies = {tuple(c) for c in payload.get('admin_copies', [])}
+    if job['chat_id'] and job['message_id']:
+        copies.add((job['chat_id'], job['message_id']))
+    await edit_slip_copies(bot, sorted(copies), f"{payload.get('caption', '')}\n\n{status}")
+
+    if job['status'] == 'failed':
+        if job['kind'] == 'renew':
+            failure_text = "❌ Key သက်တမ်းတိုး မအောင်မြင်ပါ။ Admin ကိုဆက်သွယ်ပါ @payifyoulike"
+        else:
+            failure_text = "❌ Key ထုတ်ပေးရာတွင် အခက်အခဲရှိနေပါသည်။ Admin ကိုဆက်သွယ်ပါ @payifyoulike"
+        OUTBOX.submit(bot.send_message, job['user_id'], priority=PRIORITY_KEY,
+                      text=failure_text, parse_mode='HTML', reply_markup=MAIN_MENU_KB)
+
+
+def slip_job_key(kind, user_id, slip_id, query):
+    """Queue key for one slip; older buttons without a slip id fall back to the admin message."""
+    return f"{kind}:{user_id}:{slip_id or query.message.message_id}"
+
+
+def pending_for_slip(kind, user_id, slip_id):
+    """The pending payload for this slip, or None if it is gone or belongs to a newer slip."""
+    pending = PENDING.get(kind, user_id)
+    if pending and slip_id and pending.get('slip_id') not in (None, slip_id):
+        return None
+    return pending
+
+
+async def answer_existing_job(query, job):
+    """Tell an admin who tapped an already-handled slip what happened to it."""
+    status = {'queued': '⏳ queued', 'running': '⏳ in progress', 'done': '✅ done', 'failed': '❌ failed'}
+    try:
+        await query.answer(f"Already approved ({status.get(job['status'], job['status'])}).", show_alert=True)
+    except telegram.error.BadRequest:
+        pass  # a concurrent tap already answered this query
+
 
 async def approval_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global CONFIG, SERVERS
+    """Approve/decline slips. Approvals only queue a job; PROVISION_WORKERS does the panel work."""
     refresh_runtime_config()
     query = update.callback_query
-    await query.answer()
-    
     data = query.data
 
-    # ── Renewal approval (rnw_ok_USERID / rnw_no_USERID) ──────────────────────
+    # ── Renewal approval (rnw_ok_USERID_SLIP / rnw_no_USERID_SLIP) ────────────
     if data.startswith('rnw_'):
-        _, sub_action, uid_str = data.split('_', 2)
-        user_id = int(uid_str)
+        parts = data.split('_')
+        sub_action = parts[1]
+        user_id = int(parts[2])
+        slip_id = parts[3] if len(parts) > 3 else None
+        job_key = slip_job_key('renew', user_id, slip_id, query)
+
+        existing = PROVISIONING.get(job_key)
+        if existing:
+            await answer_existing_job(query, existing)
+            return
+        await query.answer()
 
         if sub_action == 'no':
-            try:
-                await query.edit_message_caption(
-                    caption=f"{query.message.caption}\n\n❌ <b>RENEWAL DECLINED</b>",
-                    parse_mode='HTML'
-                )
-            except Exception:
-                pass
-            await context.bot.send_message(
-                chat_id=user_id,
+            pending = pending_for_slip('renew', user_id, slip_id)
+            if pending:
+                # A declined slip must not stay approvable until the pending TTL.
+                PENDING.pop('renew', user_id)
+            await edit_slip_copies(
+                context.bot, slip_copies(pending, query),
+                f"{html.escape(query.message.caption or '')}\n\n❌ <b>RENEWAL DECLINED</b>"
+            )
+            await OUTBOX.send(
+                context.bot.send_message, user_id,
                 text=(
                     "❌ <b>Key သက်တမ်းတိုး မအောင်မြင်ပါ။</b>\n\n"
                     "ငွေလွှဲပြေစာ မှားယွင်းနေသည် သို့မဟုတ် Admin မှ ငြင်းပယ်ပါသည်။\n"
@@ -1182,7 +2132,7 @@ async def approval_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # sub_action == 'ok'
-        pending = context.bot_data.get('renew_pending', {}).get(str(user_id))
+        pending = pending_for_slip('renew', user_id, slip_id)
         if not pending:
             await context.bot.send_message(
                 chat_id=query.message.chat_id,
@@ -1190,26 +2140,12 @@ async def approval_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        try:
-            await query.edit_message_caption(
-                caption=f"{query.message.caption}\n\n✅ <b>RENEWAL APPROVED</b>",
-                parse_mode='HTML'
-            )
-        except Exception:
-            pass
-
-        target_uuid  = pending['uuid']
-        server_name  = pending.get('server_name', '')
-        email        = pending.get('email', '')
-        renew_months = int(pending.get('months', 1))
-        renew_days   = int(pending.get('total_days', 30))
-        renew_gb     = int(pending.get('total_gb', 100))
-
+        server_name = pending.get('server_name', '')
         server_for_renew = find_server_by_name(server_name)
         if server_for_renew and server_for_renew.get('vpn_block_renewals', False):
-            context.bot_data.get('renew_pending', {}).pop(str(user_id), None)
-            await context.bot.send_message(
-                chat_id=user_id,
+            PENDING.pop('renew', user_id)
+            await OUTBOX.send(
+                context.bot.send_message, user_id,
                 text=(
                     "⛔ <b>Renewal is disabled for this server.</b>\n\n"
                     f"🖥 <b>Server:</b> {server_name}\n"
@@ -1224,73 +2160,39 @@ async def approval_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        # Find the right server and extend
-        success = False
-        expiry_date = ''
-        for server in SERVERS:
-            if server.get('name') == server_name:
-                try:
-                    xui = XUIClient(server)
-                    success, expiry_date = xui.reset_and_extend_client(
-                        target_uuid,
-                        expire_days=renew_days,
-                        limit_gb=renew_gb
-                    )
-                    if success:
-                        break
-                except Exception as e:
-                    logging.error(f"Renew on {server_name} failed: {e}")
-
-        # Fallback: try other servers if name didn't match or failed
-        if not success:
-            server_obj, xui, resolved_email = find_client_by_uuid(target_uuid)
-            if server_obj and server_obj.get('vpn_block_renewals', False):
-                xui = None
-            if xui:
-                success, expiry_date = xui.reset_and_extend_client(
-                    target_uuid,
-                    expire_days=renew_days,
-                    limit_gb=renew_gb
-                )
-
-        # Clean up pending
-        context.bot_data.get('renew_pending', {}).pop(str(user_id), None)
-
-        if success:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=(
-                    "✅ <b>Key သက်တမ်းတိုးခြင်း အောင်မြင်ပါသည်။</b>\n\n"
-                    f"👤 <b>Email:</b> <code>{email}</code>\n"
-                    f"📅 <b>Plan:</b> {renew_months} month(s)\n"
-                    f"📅 <b>New Expiry:</b> {expiry_date}\n"
-                    f"📦 <b>Data:</b> {renew_gb}GB (Reset to 0)\n\n"
-                    "Key အတူတူပဲ ဆက်သုံးနိုင်ပါပြီ။"
-                ),
-                parse_mode='HTML',
-                reply_markup=MAIN_MENU_KB
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="❌ Key သက်တမ်းတိုး မအောင်မြင်ပါ။ Admin ကိုဆက်သွယ်ပါ @payifyoulike",
-                parse_mode='HTML',
-                reply_markup=MAIN_MENU_KB
-            )
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=f"⚠️ Renewal extend failed for user {user_id} / UUID {target_uuid}"
-            )
+        caption = html.escape(query.message.caption or '')
+        job, created = PROVISIONING.enqueue(
+            job_key, 'renew', user_id, dict(pending, caption=caption, admin_copies=slip_copies(pending, query)),
+            chat_id=query.message.chat_id, message_id=query.message.message_id
+        )
+        if not created:
+            await answer_existing_job(query, job)
+            return
+        PENDING.pop('renew', user_id)
+        PROVISION_WORKERS.kick()
+        await edit_slip_copies(context.bot, job['payload']['admin_copies'],
+                               f"{caption}\n\n⏳ <b>RENEWAL APPROVED</b> — extending...")
         return
 
-    # ── New premium key approval (approve_USERID / decline_USERID) ────────────
+    # ── New premium key approval (approve_USERID_MONTHS_SLIP / decline_USERID_SLIP) ──
     parts = data.split('_')
     action = parts[0]
     user_id = int(parts[1])
-    selected_months = int(parts[2]) if len(parts) >= 3 and parts[2].isdigit() else None
+    if action == 'approve':
+        selected_months = int(parts[2]) if len(parts) >= 3 and parts[2].isdigit() else None
+        slip_id = parts[3] if len(parts) > 3 else None
+    else:
+        slip_id = parts[2] if len(parts) > 2 else None
+    job_key = slip_job_key('purchase', user_id, slip_id, query)
+
+    existing = PROVISIONING.get(job_key)
+    if existing:
+        await answer_existing_job(query, existing)
+        return
+    await query.answer()
 
     if action == 'approve':
-        pending_plan = context.bot_data.get('purchase_pending', {}).pop(str(user_id), None)
+        pending_plan = pending_for_slip('purchase', user_id, slip_id)
         if pending_plan:
             plan = calculate_plan(int(pending_plan.get('months', 1)))
         elif selected_months:
@@ -1300,101 +2202,48 @@ async def approval_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Reconstruct caption with link
         old_text = query.message.caption
-        import re
         try:
             match = re.search(r"User: (.+) \(ID: (\d+)\)", old_text)
             user_name = match.group(1) if match else "User"
         except Exception:
             user_name = "User"
 
-        new_caption = (
+        caption = (
             f"📩 <b>New Payment Slip!</b>\n\n"
-            f"👤 User: {user_name} (ID: <code>{user_id}</code>)\n"
+            f"👤 User: {html.escape(user_name)} (ID: <code>{user_id}</code>)\n"
             f"🔗 <a href='tg://user?id={user_id}'>Chat with User</a>\n\n"
             f"📅 <b>Months:</b> {plan['months']}\n"
             f"📦 <b>Entitlement:</b> {plan['total_gb']}GB / {plan['total_days']} days\n"
-            f"💵 <b>Expected Amount:</b> {plan['total_ks']:,} Ks\n\n"
-            f"✅ <b>APPROVED</b>"
+            f"💵 <b>Expected Amount:</b> {plan['total_ks']:,} Ks"
         )
+        # The email is fixed per job, so a retried job finds the client it already made.
+        job, created = PROVISIONING.enqueue(
+            job_key, 'purchase', user_id,
+            {'plan': plan, 'email': f"Premium_{user_id}_{secrets.token_hex(2)}", 'caption': caption,
+             'admin_copies': slip_copies(pending_plan, query)},
+            chat_id=query.message.chat_id, message_id=query.message.message_id
+        )
+        if not created:
+            await answer_existing_job(query, job)
+            return
+        if pending_plan:
+            PENDING.pop('purchase', user_id)
+        PROVISION_WORKERS.kick()
 
-        try:
-            await query.edit_message_caption(caption=new_caption, parse_mode='HTML')
-        except Exception as e:
-            logging.warning(f"Caption edit failed: {e}")
-
-        # Generate Key
-        try:
-            username = f"Premium_{user_id}_{secrets.token_hex(2)}"
-            target_server = None
-            link = None
-            existed = False
-
-            candidate_servers = get_round_robin_servers()
-            for server in candidate_servers:
-                try:
-                    client = XUIClient(server)
-                    result = client.add_client(
-                        email=username,
-                        limit_gb=plan['total_gb'],
-                        expire_days=plan['total_days']
-                    )
-                    if isinstance(result, tuple):
-                        link, existed = result
-                    else:
-                        link = result
-                        existed = False
-                    if link:
-                        target_server = server
-                        break
-                except Exception as server_error:
-                    logging.warning(f"Premium key generation failed on {server.get('name')}: {server_error}")
-
-            if link:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=(
-                        "✅ <b>ငွေလွှဲအောင်မြင်ပါသည်။</b>\n\n"
-                        f"💎 <b>Premium Key ({plan['months']} Month / {plan['total_gb']}GB):</b>\n"
-                        f"Server: {target_server.get('name')}\n"
-                        f"Duration: {plan['total_days']} days\n"
-                        "👇 <b>အောက်ပါ Key ကို Copy ယူပါ:</b>"
-                    ),
-                    parse_mode='HTML'
-                )
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"<code>{link}</code>",
-                    parse_mode='HTML'
-                )
-                if existed:
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text="⚠️ You already have an existing key; a new key cannot be issued.",
-                        parse_mode='HTML'
-                    )
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text="👆 <b>Key ကို Copy ယူပါ။</b>\n\nအသုံးပြုနည်းကြည့်ရန် /start ကိုနှိပ်ပြီး\n'❓ ဘယ်လိုသုံးရမလဲ' ကို ရွေးပါ။",
-                    parse_mode='HTML',
-                    reply_markup=MAIN_MENU_KB
-                )
-            else:
-                await context.bot.send_message(chat_id=query.message.chat_id, text="❌ Error generating key.")
-
-        except Exception as e:
-            logging.error(f"Approval Error: {e}")
-            await context.bot.send_message(chat_id=query.message.chat_id, text=f"❌ System Error: {e}")
+        await edit_slip_copies(context.bot, job['payload']['admin_copies'],
+                               f"{caption}\n\n⏳ <b>APPROVED</b> — issuing key...")
 
     elif action == 'decline':
-        try:
-            await query.edit_message_caption(
-                caption=f"{query.message.caption}\n\n❌ <b>DECLINED</b>",
-                parse_mode='HTML'
-            )
-        except Exception:
-            pass
-        await context.bot.send_message(
-            chat_id=user_id,
+        pending = pending_for_slip('purchase', user_id, slip_id)
+        if pending:
+            # A declined slip must not stay approvable until the pending TTL.
+            PENDING.pop('purchase', user_id)
+        await edit_slip_copies(
+            context.bot, slip_copies(pending, query),
+            f"{html.escape(query.message.caption or '')}\n\n❌ <b>DECLINED</b>"
+        )
+        await OUTBOX.send(
+            context.bot.send_message, user_id,
             text=(
                 "❌ <b>ငွေလွှဲမအောင်မြင်ပါ။</b>\n\n"
                 "အသေးစိတ်သိရှိလိုပါက Admin ကို ဆက်သွယ်ပါ။\n\n"
@@ -1404,22 +2253,48 @@ async def approval_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=MAIN_MENU_KB
         )
 
+async def send_free_trial_key(query, context, link, server):
+    """Deliver a newly issued free trial key with the instructions and upsell."""
+    await query.edit_message_text(
+        "✅ <b>အောင်မြင်ပါတယ်!</b>\n\n"
+        f"Server: {server.get('name')}\n"
+        "လူကြီးမင်း၏ 24-နာရီ Free Trial Key (2GB):\n"
+        "👇 <b>အောက်ပါ Vpn Key Copy ကူးယူပါ:</b>",
+        parse_mode='HTML'
+    )
+    await context.bot.send_message(
+        chat_id=query.message.chat_id,
+        text=f"`{link}`",
+        parse_mode='MarkdownV2'
+    )
+    # Combined Instructions + Upsell
+    final_msg = (
+        "👆 <b>Key ကို Copy ယူပါ။</b>\n\n"
+        "အသုံးပြုနည်းကြည့်ရန် /start ကိုနှိပ်ပြီး\n"
+        "'❓ ဘယ်လိုသုံးရမလဲ' ကို ရွေးပါ။\n\n"
+        "💡 <b>Free Trial သက်တမ်းကုန်ဆုံးပါက Premium ဝယ်ယူအသုံးပြုနိုင်ပါသည်။</b>"
+    )
+    upsell_kb = [[InlineKeyboardButton("💎 Premium ဝယ်ယူမယ် (1-6 months)", callback_data='buy_premium')]]
+
+    await context.bot.send_message(
+        chat_id=query.message.chat_id,
+        text=final_msg,
+        parse_mode='HTML',
+        reply_markup=InlineKeyboardMarkup(upsell_kb)
+    )
+
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     if query.data == 'get_free':
         # Check if user already has a key using new tracking system
-        tracking = load_trial_tracking()
         user_id = str(query.from_user.id)
+        trial_info = TRIALS.get(user_id)
         
-        if user_id in tracking:
-            trial_info = tracking[user_id]
-            if isinstance(trial_info, dict):
-                old_link = trial_info.get('link', '')
-            else:
-                # Fallback for old format
-                old_link = trial_info
+        if trial_info:
+            old_link = trial_info.get('link', '')
 
             # 1. Edit existing message (Warning)
             await query.edit_message_text(
@@ -1454,7 +2329,17 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await query.edit_message_text("⚙️ <b>Key ထုတ်ပေးနေပါသည်... ခဏစောင့်ပါ...</b>", parse_mode='HTML')
 
-        candidate_servers = get_round_robin_servers()
+        username = f"FreeTrial_{query.from_user.id}"
+        # A user who still has a trial client goes through add_client below, which
+        # finds it as a duplicate; everyone else gets a warm pool key.
+        if not CLIENT_INDEX.servers_for_email(username):
+            link, selected_server = await TRIAL_POOL.claim(username)
+            if link:
+                TRIALS.put(user_id, link, username, selected_server.get('name'), trial_type='free')
+                await send_free_trial_key(query, context, link, selected_server)
+                return
+
+        candidate_servers = await get_round_robin_servers()
         logging.info(f"Load-balanced candidates for free trial: {[s.get('name') for s in candidate_servers]}")
 
         if not candidate_servers:
@@ -1467,15 +2352,14 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
         # Generate on round-robin server order
         try:
-            username = f"FreeTrial_{query.from_user.id}"
             selected_server = None
             link = None
             existed = False
 
             for server in candidate_servers:
                 try:
-                    client = XUIClient(server)
-                    result = client.add_client(email=username, limit_gb=2, expire_days=1)
+                    client = get_xui_client(server)
+                    result = await client.add_client(email=username, limit_gb=FREE_TRIAL_LIMIT_GB, expire_days=FREE_TRIAL_EXPIRE_DAYS)
                     if isinstance(result, tuple):
                         link, existed = result
                     else:
@@ -1490,16 +2374,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             if link:
                 if existed:
-                    # User already has a free trial - update tracking with current timestamp
-                    if user_id not in tracking:
-                        tracking[user_id] = {
-                            "link": link,
-                            "timestamp": int(time.time()),
-                            "trial_type": "free",
-                            "email": username,
-                            "server_name": selected_server.get('name')
-                        }
-                        save_trial_tracking(tracking)
+                    # User already has a free trial - start tracking it from now
+                    TRIALS.add_if_absent(user_id, link, username, selected_server.get('name'), trial_type='free')
 
                     await query.edit_message_text(
                         "⚠️ <b>လူကြီးမင်းသည် အရင်ကပဲ Free Trial ရယူထားပြီးပါပြီ။</b>\n\n"
@@ -1511,42 +2387,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     return
 
                 # New key issued - save with timestamp
-                tracking[user_id] = {
-                    "link": link,
-                    "timestamp": int(time.time()),
-                    "trial_type": "free",
-                    "email": username,
-                    "server_name": selected_server.get('name')
-                }
-                save_trial_tracking(tracking)
-
-                await query.edit_message_text(
-                    "✅ <b>အောင်မြင်ပါတယ်!</b>\n\n"
-                    f"Server: {selected_server.get('name')}\n"
-                    "လူကြီးမင်း၏ 24-နာရီ Free Trial Key (2GB):\n"
-                    "👇 <b>အောက်ပါ Vpn Key Copy ကူးယူပါ:</b>",
-                    parse_mode='HTML'
-                )
-                await context.bot.send_message(
-                    chat_id=query.message.chat_id,
-                    text=f"`{link}`",
-                    parse_mode='MarkdownV2'
-                )
-                # Combined Instructions + Upsell
-                final_msg = (
-                    "👆 <b>Key ကို Copy ယူပါ။</b>\n\n"
-                    "အသုံးပြုနည်းကြည့်ရန် /start ကိုနှိပ်ပြီး\n"
-                    "'❓ ဘယ်လိုသုံးရမလဲ' ကို ရွေးပါ။\n\n"
-                    "💡 <b>Free Trial သက်တမ်းကုန်ဆုံးပါက Premium ဝယ်ယူအသုံးပြုနိုင်ပါသည်။</b>"
-                )
-                upsell_kb = [[InlineKeyboardButton("💎 Premium ဝယ်ယူမယ် (1-6 months)", callback_data='buy_premium')]]
-                
-                await context.bot.send_message(
-                    chat_id=query.message.chat_id,
-                    text=final_msg,
-                    parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup(upsell_kb)
-                )
+                TRIALS.put(user_id, link, username, selected_server.get('name'), trial_type='free')
+                await send_free_trial_key(query, context, link, selected_server)
             else:
                 logging.error(f"Link generation failed on {selected_server.get('name')}")
                 await query.edit_message_text("❌ Error: Server returned no link. Please contact admin.")
@@ -1672,59 +2514,18 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data in ['guide_android', 'guide_ios', 'guide_pc']:
         device = "Android" if "android" in query.data else "iOS" if "ios" in query.data else "PC"
         
-        # Guide Content
-        if device == "Android":
-            # Step 1: Install
-            caption1 = "<b>အဆင့် (၁) - Install V2Box</b>\n\nPlayStore မှ <b>V2Box - V2ray Client</b> ကို ရှာပြီး Install လုပ်ပါ။"
-            try:
-                with open('images/android_1.jpg', 'rb') as photo:
-                    await context.bot.send_photo(
-                        chat_id=query.message.chat_id,
-                        photo=photo,
-                        caption=caption1,
-                        parse_mode='HTML'
-                    )
-            except FileNotFoundError:
-                pass
-
-            # Step 2: Import & Connect
-            caption2 = "<b>အဆင့် (၂) - Import & Connect</b>\n\nအရင်ဦးဆုံး ပေးပို့ထားသော VPN Key ကို Telegram မှ Copy ယူပါ။\n\nV2Box App ထဲသို့ဝင်ပြီး ပုံပါအတိုင်း တစ်ဆင့်ခြင်းစီ ပြုလုပ်ပြီးပါက အသုံးပြုနိုင်ပါပြီ။"
-            try:
-                with open('images/android_2.jpg', 'rb') as photo:
-                    await context.bot.send_photo(
-                        chat_id=query.message.chat_id,
-                        photo=photo,
-                        caption=caption2,
-                        parse_mode='HTML'
-                    )
-            except FileNotFoundError:
-                pass
-        elif device == "iOS":
+        # Guide Content: both steps go out as one album, by cached file_id after the first upload.
+        if device in ("Android", "iOS"):
+            store = "PlayStore" if device == "Android" else "AppStore"
+            prefix = "android" if device == "Android" else "ios"
             # Step 1: Install
-            caption1 = "<b>အဆင့် (၁) - Install V2Box</b>\n\nAppStore မှ <b>V2Box - V2ray Client</b> ကို ရှာပြီး Install လုပ်ပါ။"
-            try:
-                with open('images/ios_1.jpg', 'rb') as photo:
-                    await context.bot.send_photo(
-                        chat_id=query.message.chat_id,
-                        photo=photo,
-                        caption=caption1,
-                        parse_mode='HTML'
-                    )
-            except FileNotFoundError:
-                pass
-
+            caption1 = f"<b>အဆင့် (၁) - Install V2Box</b>\n\n{store} မှ <b>V2Box - V2ray Client</b> ကို ရှာပြီး Install လုပ်ပါ။"
             # Step 2: Import & Connect
             caption2 = "<b>အဆင့် (၂) - Import & Connect</b>\n\nအရင်ဦးဆုံး ပေးပို့ထားသော VPN Key ကို Telegram မှ Copy ယူပါ။\n\nV2Box App ထဲသို့ဝင်ပြီး ပုံပါအတိုင်း တစ်ဆင့်ခြင်းစီ ပြုလုပ်ပြီးပါက အသုံးပြုနိုင်ပါပြီ။"
-            try:
-                with open('images/ios_2.jpg', 'rb') as photo:
-                    await context.bot.send_photo(
-                        chat_id=query.message.chat_id,
-                        photo=photo,
-                        caption=caption2,
-                        parse_mode='HTML'
-                    )
-            except FileNotFoundError:
-                pass
+            await GUIDE_MEDIA.send_album(context.bot, query.message.chat_id, [
+                (f'images/{prefix}_1.jpg', caption1),
+                (f'images/{prefix}_2.jpg', caption2),
+            ])
         else:
             msg = f"<b>{device} အသုံးပြုနည်းလမ်းညွှန်</b>\n\n(ပုံနှင့်တကွ ရှင်းပြချက်များကို Admin မှ မကြာမီ ထည့်သွင်းပေးပါမည်။)"
             keyboard = [[InlineKeyboardButton("🔙 Back", callback_data='help')]]
@@ -1869,13 +2670,25 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not status_servers:
             msg += "No server selected for status monitoring."
         for idx, s in enumerate(status_servers):
-            try:
-                # Simple reachability check (login)
-                client = XUIClient(s)
-                status = "✅ Online"
-            except:
+            client = get_xui_client(s)
+            if server_is_down(s):
                 status = "❌ Offline"
+            else:
+                try:
+                    # Simple reachability check (login)
+                    status = "✅ Online" if await client.login() else "❌ Offline"
+                except:
+                    status = "❌ Offline"
             msg += f"{s.get('name', f'Server {idx+1}')}: {status}\n"
+            msg += f"   └ {html.escape(PANEL_HEALTH.describe(client.base_url))}\n"
+            msg += f"   └ Warm trial keys: {len(TRIAL_POOL.available(client.server_name))}/{TRIAL_POOL.size}\n"
+
+        jobs = PROVISIONING.counts()
+        msg += f"\n🧾 Provisioning: {jobs['queued']} queued, {jobs['running']} running, {jobs['failed']} failed\n"
+        msg += f"🧊 Trial pool: {TRIAL_POOL.claimed} claimed, {TRIAL_POOL.missed} missed\n"
+        msg += "\n⚙️ <b>Background Jobs:</b>\n"
+        for name in JOB_BUDGET_SECONDS:
+            msg += f"• {html.escape(JOBS.describe(name))}\n"
         
         keyboard = [[InlineKeyboardButton("🔙 Back", callback_data='admin_back')]]
         await query.edit_message_text(msg, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
@@ -1915,7 +2728,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await status_msg.edit_text("❌ Key ပုံစံ မမှန်ကန်ပါ (UUID မတွေ့ရပါ)။")
             return
 
-        server_obj, xui, email, resolved_uuid = find_client_from_vless(text)
+        server_obj, xui, email, resolved_uuid = await find_client_from_vless(text)
         target_uuid = resolved_uuid or target_uuid
 
         if not server_obj:
@@ -1969,7 +2782,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await status_msg.edit_text("❌ Invalid key format (UUID not found).")
             return
 
-        server_obj, xui, email, resolved_uuid = find_client_from_vless(text)
+        server_obj, xui, email, resolved_uuid = await find_client_from_vless(text)
         target_uuid = resolved_uuid or target_uuid
 
         if not xui:
@@ -1977,7 +2790,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         await status_msg.edit_text("⚙️ Extending...")
-        success, result = xui.reset_and_extend_client(target_uuid)
+        success, result = await xui.reset_and_extend_client(target_uuid)
 
         if success:
             await status_msg.edit_text(
@@ -2008,64 +2821,58 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await status_msg.edit_text("❌ Key ပုံစံမှားယွင်းနေပါသည်။")
                 return
 
-            found = False
-            
-            # Scan all servers
-            for s in SERVERS:
-                try:
-                    # Just use simple timeout, no complex logic
-                    client = XUIClient(s)
-                    # We need to manually add get_client_stats here if it's missing in older cached version
-                    # But assuming XUIClient has it now
-                    stats = client.get_client_stats(target_uuid) if target_uuid else None
-                    if not stats and target_email:
-                        stats = client.get_client_stats_by_email(target_email)
-                    
-                    if stats:
-                        found = True
-                        # Calculate Data
-                        total = stats['total']
-                        used = stats['up'] + stats['down']
-                        left = total - used
-                        
-                        # Helper for formatting bytes
-                        def sizeof_fmt(num, suffix="B"):
-                            for unit in ["", "Ki", "Mi", "Gi", "Ti"]:
-                                if abs(num) < 1024.0:
-                                    return f"{num:3.1f} {unit}{suffix}"
-                                num /= 1024.0
-                            return f"{num:.1f} Yi{suffix}"
-
-                        # Calculate Days
-                        import time
-                        from datetime import datetime
-                        if stats['expiry'] > 0:
-                            # Convert expiry timestamp (ms) to date
-                            expiry_ts = stats['expiry'] / 1000
-                            expiry_date = datetime.fromtimestamp(expiry_ts).strftime('%Y-%m-%d %H:%M')
-                            # User requested date ONLY
-                            days_str = expiry_date
-                        else:
-                            days_str = "Unlimited"
-
-                        msg = (
-                            f"📊 <b>အကောင့်အခြေအနေ</b>\n\n"
-                            f"👤 <b>Name:</b> {stats['email']}\n"
-                            f"🖥 <b>Server:</b> {s.get('name')}\n"
-                            f"🔋 <b>Status:</b> {'✅ Active' if stats['enable'] and days_str != 'Expired' else '❌ Disabled'}\n\n"
-                            f"📦 <b>Total:</b> {sizeof_fmt(total)}\n"
-                            f"📉 <b>Used:</b> {sizeof_fmt(used)}\n"
-                            f"📈 <b>Remaining:</b> {sizeof_fmt(left)}\n\n"
-                            f"⏳ <b>Expires:</b> {days_str}"
-                        )
-                        
-                        await status_msg.edit_text(msg, parse_mode='HTML')
-                        break # Stop searching
-                except Exception as e:
-                    logging.error(f"Error checking server {s.get('name')}: {e}")
-                    continue
-            
-            if not found:
+            # Query all servers at once; the first one that knows the key wins.
+            async def probe(server):
+                client = get_xui_client(server)
+                stats = await client.get_client_stats(target_uuid) if target_uuid else None
+                if not stats and target_email:
+                    stats = await client.get_client_stats_by_email(target_email)
+                return stats
+
+            # The index usually knows the server, so only that panel is asked for live numbers.
+            entry = CLIENT_INDEX.find(uuid=target_uuid, email=target_email)
+            indexed_server = find_server_by_name(entry['server_name']) if entry else None
+            s, stats = await find_first_across_servers([indexed_server] if indexed_server else SERVERS, probe)
+            if not stats and indexed_server:
+                s, stats = await find_first_across_servers(SERVERS, probe)
+
+            if stats:
+                # Calculate Data
+                total = stats['total']
+                used = stats['up'] + stats['down']
+                left = total - used
+
+                # Helper for formatting bytes
+                def sizeof_fmt(num, suffix="B"):
+                    for unit in ["", "Ki", "Mi", "Gi", "Ti"]:
+                        if abs(num) < 1024.0:
+                            return f"{num:3.1f} {unit}{suffix}"
+                        num /= 1024.0
+                    return f"{num:.1f} Yi{suffix}"
+
+                # Calculate Days
+                if stats['expiry'] > 0:
+                    # Convert expiry timestamp (ms) to date
+                    expiry_ts = stats['expiry'] / 1000
+                    expiry_date = datetime.fromtimestamp(expiry_ts).strftime('%Y-%m-%d %H:%M')
+                    # User requested date ONLY
+                    days_str = expiry_date
+                else:
+                    days_str = "Unlimited"
+
+                msg = (
+                    f"📊 <b>အကောင့်အခြေအနေ</b>\n\n"
+                    f"👤 <b>Name:</b> {stats['email']}\n"
+                    f"🖥 <b>Server:</b> {s.get('name')}\n"
+                    f"🔋 <b>Status:</b> {'✅ Active' if stats['enable'] and days_str != 'Expired' else '❌ Disabled'}\n\n"
+                    f"📦 <b>Total:</b> {sizeof_fmt(total)}\n"
+                    f"📉 <b>Used:</b> {sizeof_fmt(used)}\n"
+                    f"📈 <b>Remaining:</b> {sizeof_fmt(left)}\n\n"
+                    f"⏳ <b>Expires:</b> {days_str}"
+                )
+
+                await status_msg.edit_text(msg, parse_mode='HTML')
+            else:
                 await status_msg.edit_text("❌ Server ပေါ်တွင် ဤ Key ကိုမတွေ့ရှိပါ။")
                 
         except Exception as e:
@@ -2098,12 +2905,14 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "flow_limit_gb": 100,
                 "expire_days": 30
             }
-            SERVERS.append(new_server)
-            
-            # Save to config.json
-            CONFIG['servers'] = SERVERS
-            with open('../config.json', 'w') as f:
-                json.dump(CONFIG, f, indent=4)
+            # Save to config.json under the shared lock so admin_bot edits aren't lost
+            def append_server(config):
+                servers = config.setdefault('servers', [])
+                new_server['name'] = next_server_name(servers)
+                servers.append(new_server)
+
+            CONFIG_STORE.update(append_server)
+            refresh_runtime_config()
                 
             await update.message.reply_text(
                 f"✅ <b>Server Added!</b>\n"
@@ -2142,8 +2951,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
             
-            client = XUIClient(target_server)
-            result = client.add_client(email=username, limit_gb=limit_gb, expire_days=days)
+            client = get_xui_client(target_server)
+            result = await client.add_client(email=username, limit_gb=limit_gb, expire_days=days)
             if isinstance(result, tuple):
                 link, existed = result
             else:
@@ -2173,7 +2982,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Check if document is an image
     if update.message.document.mime_type and 'image' in update.message.document.mime_type:
-        document_file = await update.message.document.get_file()
+        document_file_id = update.message.document.file_id
 
         # ── Renewal slip (file) ────────────────────────────────────────────────
         if context.user_data.get('state') == 'awaiting_renew_slip':
@@ -2181,9 +2990,10 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data.pop('state', None)
             context.user_data.pop('renew_info', None)
 
-            context.bot_data.setdefault('renew_pending', {})[str(user.id)] = renew_info
+            renew_info['slip_id'] = secrets.token_hex(4)
+            PENDING.put('renew', user.id, renew_info)
 
-            await update.message.reply_text(
+            reply = update.message.reply_text(
                 "⏳ <b>ငွေလွှဲပြေစာကို Admin သို့ ပေးပို့ပြီးပါပြီ။</b>\n\n"
                 "Admin မှ စစ်ဆေးပြီးပါက Key သက်တမ်း အလိုအလျောက် တိုးပေးပါမည်。\n"
                 "Admin ကိုဆက်သွယ်ရန် @payifyoulike",
@@ -2198,33 +3008,34 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"🖥 <b>Server:</b> {renew_info.get('server_name', 'N/A')}"
             )
             keyboard = [[
-                InlineKeyboardButton("✅ Approve Renewal", callback_data=f'rnw_ok_{user.id}'),
-                InlineKeyboardButton("❌ Decline",         callback_data=f'rnw_no_{user.id}')
+                InlineKeyboardButton("✅ Approve Renewal", callback_data=f"rnw_ok_{user.id}_{renew_info['slip_id']}"),
+                InlineKeyboardButton("❌ Decline",         callback_data=f"rnw_no_{user.id}_{renew_info['slip_id']}")
             ]]
-            for admin_id in ADMIN_IDS:
-                try:
-                    await context.bot.send_document(
-                        chat_id=admin_id, document=document_file.file_id,
-                        caption=caption, parse_mode='HTML',
-                        reply_markup=InlineKeyboardMarkup(keyboard)
-                    )
-                except Exception as e:
-                    logging.error(f"Failed to send renewal doc to admin {admin_id}: {e}")
+            await forward_slip(
+                'renew', user.id, renew_info, reply,
+                context.bot.send_document, "renewal doc",
+                document=document_file_id,
+                caption=caption, parse_mode='HTML',
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
             return
 
         # ── New purchase slip (file) ───────────────────────────────────────────
         selected_months = int(context.user_data.get('purchase_months', 1))
         plan = calculate_plan(selected_months)
-        context.bot_data.setdefault('purchase_pending', {})[str(user.id)] = {
+        slip_id = secrets.token_hex(4)
+        pending = {
+            'slip_id': slip_id,
             'months': plan['months'],
             'total_ks': plan['total_ks'],
             'total_gb': plan['total_gb'],
             'total_days': plan['total_days'],
         }
+        PENDING.put('purchase', user.id, pending)
         context.user_data.pop('state', None)
         context.user_data.pop('purchase_months', None)
 
-        await update.message.reply_text(
+        reply = update.message.reply_text(
             "⏳ <b>ငွေလွှဲပြေစာကို Admin သို့ ပေးပို့ထားပါသည်။</b>\n\n"
             "Admin မှ စစ်ဆေးပြီးပါက Key အလိုအလျောက် ရောက်ရှိလာပါမည်။ ခေတ္တစောင့်ဆိုင်းပေးပါ။\n\n"
             "Admin ကိုဆက်သွယ်ရန် နှိပ်ပါ 👇\n@payifyoulike",
@@ -2240,32 +3051,36 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"💵 <b>Expected Amount:</b> {plan['total_ks']:,} Ks"
         )
         keyboard = [[
-            InlineKeyboardButton("✅ Approve", callback_data=f"approve_{user.id}_{plan['months']}"),
-            InlineKeyboardButton("❌ Decline", callback_data=f'decline_{user.id}')
+            InlineKeyboardButton("✅ Approve", callback_data=f"approve_{user.id}_{plan['months']}_{slip_id}"),
+            InlineKeyboardButton("❌ Decline", callback_data=f'decline_{user.id}_{slip_id}')
         ]]
-        for admin_id in ADMIN_IDS:
-            try:
-                await context.bot.send_document(
-                    chat_id=admin_id,
-                    document=document_file.file_id,
-                    caption=caption,
-                    parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-                logging.info(f"Sent document approval to admin {admin_id}")
-            except Exception as e:
-                logging.error(f"Failed to send document to admin {admin_id}: {e}")
+        await forward_slip(
+            'purchase', user.id, pending, reply,
+            context.bot.send_document, "document approval",
+            document=document_file_id,
+            caption=caption,
+            parse_mode='HTML',
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
     else:
         await update.message.reply_text("❌ Image files only, please. (PNG, JPG, etc.)")
 
 def main():
-    app = Application.builder().token(CONFIG['bot_token']).build()
+    app = (
+        Application.builder()
+        .token(CONFIG['bot_token'])
+        .persistence(SqliteUserDataPersistence(PENDING, ttl_seconds=PENDING_TTL_SECONDS))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Handlers
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("admin", admin_panel))
     app.add_handler(CallbackQueryHandler(button_handler, pattern='^(get_|buy_|renew_|help|guide_|main_|check_)'))
-    app.add_handler(CallbackQueryHandler(approval_handler, pattern='^(approve_|decline_|rnw_ok_|rnw_no_)'))
+    # Non-blocking: key delivery waits on OUTBOX per-chat pacing, which must not stall other updates.
+    app.add_handler(CallbackQueryHandler(approval_handler, pattern='^(approve_|decline_|rnw_ok_|rnw_no_)', block=False))
     app.add_handler(CallbackQueryHandler(admin_handler, pattern='^admin_'))
     app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
@@ -2280,7 +3095,7 @@ def main():
 
         err = getattr(context, 'error', None)
         if err and isinstance(err, telegram.error.Conflict):
-            logging.error("Conflict: terminated by other getUpdates request; ensure only one bot instance is running or switch to webhooks.")
+            logging.error("Conflict: terminated by other getUpdates request; ensure only one bot instance is running or enable webhook mode for this bot in config.json (see common/serving.py).")
 
     app.add_error_handler(error_handler)
     
@@ -2288,7 +3103,39 @@ def main():
     job_queue = app.job_queue
     if job_queue is not None:
         job_queue.run_repeating(
-            cleanup_expired_trials,
+            JOBS.wrap(refresh_client_index, JOB_BUDGET_SECONDS['refresh_client_index']),
+            interval=CLIENT_INDEX_REFRESH_SECONDS,
+            first=5,
+            name='refresh_client_index'
+        )
+        logging.info("✅ Scheduled refresh_client_index job")
+
+        job_queue.run_repeating(
+            purge_abandoned_sessions,
+            interval=3600,
+            first=120,
+            name='purge_abandoned_sessions'
+        )
+        logging.info("✅ Scheduled purge_abandoned_sessions job")
+
+        job_queue.run_repeating(
+            flush_state_files,
+            interval=STATE_FLUSH_SECONDS,
+            first=STATE_FLUSH_SECONDS,
+            name='flush_state_files'
+        )
+        logging.info("✅ Scheduled flush_state_files job")
+
+        job_queue.run_repeating(
+            JOBS.wrap(refresh_server_loads, JOB_BUDGET_SECONDS['refresh_server_loads']),
+            interval=SERVER_LOAD_REFRESH_SECONDS,
+            first=3,
+            name='refresh_server_loads'
+        )
+        logging.info("✅ Scheduled refresh_server_loads job")
+
+        job_queue.run_repeating(
+            JOBS.wrap(cleanup_expired_trials, JOB_BUDGET_SECONDS['cleanup_expired_trials']),
             interval=3600,  # 1 hour
             first=10,  # Start after 10 seconds
             name='cleanup_expired_trials'
@@ -2296,17 +3143,25 @@ def main():
         logging.info("✅ Scheduled cleanup_expired_trials job to run every hour")
 
         job_queue.run_repeating(
-            notify_expiring_or_low_data_keys,
-            interval=6 * 3600,  # every 6 hours
+            JOBS.wrap(notify_expiring_or_low_data_keys, JOB_BUDGET_SECONDS['notify_expiring_or_low_data_keys']),
+            interval=NOTICE_TICK_SECONDS,
             first=60,  # start after 1 minute
             name='notify_expiring_or_low_data_keys'
         )
-        logging.info("✅ Scheduled notify_expiring_or_low_data_keys job to run every 6 hours")
+        logging.info("✅ Scheduled notify_expiring_or_low_data_keys job")
+
+        job_queue.run_repeating(
+            JOBS.wrap(TRIAL_POOL.fill, JOB_BUDGET_SECONDS['fill_trial_pool'], name='fill_trial_pool'),
+            interval=TRIAL_POOL_REFILL_SECONDS,
+            first=30,  # after the first client index refresh
+            name='fill_trial_pool'
+        )
+        logging.info("✅ Scheduled fill_trial_pool job")
     else:
         logging.warning("⚠️  JobQueue not available. Install via: pip install 'python-telegram-bot[job-queue]'. Cleanup task will NOT run.")
     
     print("Bot is running...")
-    app.run_polling()
+    serving.run(app, CONFIG, 'vpn_bot')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file